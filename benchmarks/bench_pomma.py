@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# benchmarks of the hot paths of pomma: finding symbols and repeats, first-order
+# Markov models, statistics of sequences and their bootstrap error bounds,
+# and E-M, sampling and model search on the bl26lb16 dataset.
+# Synthetic corpora are generated with first_order_markov, scaled by number of
+# bouts, bout length and alphabet size, one at a time from a base corpus.
+# Results are written as JSON, and can be compared with results of an earlier
+# run to catch regressions. From the root of the repository, e.g.
+#
+#     python -m benchmarks.bench_pomma --output before.json
+#     (upgrade or change code)
+#     python -m benchmarks.bench_pomma --output after.json --compare before.json
+
+import argparse
+import json
+import platform
+import statistics as stats
+import string
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from pomma import first_order_markov, statistics, datasets
+from pomma.baum_welch import init_state_model, make_run_batches, e_step, em_steps
+from pomma.bootstrap import bootstrap_error_bounds_encoded
+from pomma.derive_initial_state_model import (derive_initial_state_model,
+                                              state_symbols_and_max_repeat_nums)
+from pomma.determine_symbols_and_max_repeats import determine_symbols_and_max_repeats
+from pomma.encoding import encode_strings
+from pomma.sampling import sample_sequences
+
+STARTCHAR = 'S'
+ENDCHAR = 'E'
+# characters that can be labels, leaving out start and end characters
+LABEL_CHARS = ''.join(char for char in string.ascii_letters + string.digits
+                      if char not in (STARTCHAR, ENDCHAR))
+
+BASE_SIZE = {'num_bouts': 1000, 'bout_length': 50, 'alphabet_size': 10}
+SIZES = {
+    'num_bouts': [100, 1000, 10000],
+    'bout_length': [10, 50, 200],
+    'alphabet_size': [5, 10, 40],
+}
+QUICK_SIZES = {
+    'num_bouts': [100, 1000],
+    'bout_length': [10, 50],
+    'alphabet_size': [5, 10],
+}
+
+
+def synthetic_trans_mat(alphabet_size, bout_length, seed=0):
+    """random first-order Markov transition matrix with some of the structure
+    of song: labels often repeat, most transitions never occur, and bouts end
+    after bout_length labels on average
+
+    Returns
+    -------
+    trans_mat : ndarray
+        as returned by first_order_markov.make_trans_mat
+    labelset : str
+        start character, labels and end character
+    """
+    rng = np.random.default_rng(seed)
+    labels = LABEL_CHARS[:alphabet_size]
+    labelset = STARTCHAR + labels + ENDCHAR
+    size = len(labelset)
+    trans_mat = np.zeros((size - 1, size))
+    # each label goes to a few other labels, and to itself
+    for row in range(1, size - 1):
+        cols = rng.choice(np.arange(1, size - 1), size=min(3, alphabet_size), replace=False)
+        trans_mat[row, cols] = rng.random(cols.shape[0])
+        trans_mat[row, row] += rng.random()
+    trans_mat[1:] *= (1 - 1 / bout_length) / trans_mat[1:].sum(axis=1, keepdims=True)
+    trans_mat[1:, -1] = 1 / bout_length
+    trans_mat[0, 1:-1] = rng.dirichlet(np.ones(alphabet_size))
+    return trans_mat, labelset
+
+
+def synthetic_corpus(num_bouts, bout_length, alphabet_size, seed=0):
+    """sequences generated by a random first-order Markov model
+
+    Returns
+    -------
+    corpus : dict
+        with keys 'sequences' (list of str, without start and end characters),
+        'labels' (list of str, with them), 'labelset' and 'trans_mat'
+    """
+    trans_mat, labelset = synthetic_trans_mat(alphabet_size, bout_length, seed)
+    sequences = first_order_markov.generate_sequences(trans_mat, labelset, num=num_bouts,
+                                                      seed=seed)
+    return {'sequences': sequences,
+            'labels': [STARTCHAR + seq + ENDCHAR for seq in sequences],
+            'labelset': labelset,
+            'trans_mat': trans_mat}
+
+
+def time_func(func, repeat=5, warmup=1):
+    """times calls of func, in seconds"""
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times),
+            'median': stats.median(times),
+            'mean': stats.mean(times),
+            'stdev': stats.stdev(times) if len(times) > 1 else 0.,
+            'repeat': repeat}
+
+
+def corpus_benchmarks(corpus, num_boot=20):
+    """benchmarks run on every synthetic corpus, as (name, function) pairs"""
+    sequences, labels, labelset = corpus['sequences'], corpus['labels'], corpus['labelset']
+    label_chars = labelset[1:-1]
+    flat, offsets = encode_strings(sequences, label_chars, startchar='', endchar='')
+    trans_mat = corpus['trans_mat']
+    symbol_lists = [list(seq) for seq in sequences]
+    return [
+        ('determine_symbols_and_max_repeats',
+         lambda: determine_symbols_and_max_repeats(symbol_lists)),
+        ('first_order_markov.make_trans_mat',
+         lambda: first_order_markov.make_trans_mat(labels, labelset)),
+        ('first_order_markov.generate_sequences',
+         lambda: first_order_markov.generate_sequences(trans_mat, labelset,
+                                                       num=len(sequences), seed=1)),
+        ('statistics.get_ngram_distribs',
+         lambda: statistics.get_ngram_distribs(labels, labelset)),
+        ('statistics.get_step_prob',
+         lambda: statistics.get_step_prob(labels, labelset)),
+        ('statistics.get_repeat_distribs',
+         lambda: statistics.get_repeat_distribs(sequences, label_chars)),
+        (f'bootstrap.bootstrap_error_bounds_encoded.{num_boot}_splits',
+         lambda: bootstrap_error_bounds_encoded(flat, offsets, len(label_chars),
+                                                num_boot=num_boot, seed=0)),
+    ]
+
+
+def em_benchmarks(num_extra_states=1, num_steps=5, batch_size=256, num_samples=10000, seed=0):
+    """benchmarks of E-M, sampling and model search on the bl26lb16 dataset,
+    as (name, function) pairs. E-M runs a fixed number of steps from the same
+    random start every time, with tolerance 0 so it never stops early."""
+    sequences = [list(seq.strip()[1:-1]) for seq in datasets.load()['bl26lb16']]
+    symbols = determine_symbols_and_max_repeats(sequences)
+    max_repeats = {symbols['symbols_int_map'][symbol]: max_repeat
+                   for symbol, max_repeat in symbols['max_repeats'].items()}
+    state_symbols, max_repeat_nums = state_symbols_and_max_repeat_nums(
+        max_repeats, len(symbols['symbols']), num_extra_states)
+    state_model = init_state_model(state_symbols, max_repeat_nums, np.random.default_rng(seed))
+    batches = make_run_batches(symbols['seqs_mapped'], batch_size)
+    return [
+        ('baum_welch.make_run_batches.bl26lb16',
+         lambda: make_run_batches(symbols['seqs_mapped'], batch_size)),
+        ('baum_welch.e_step.bl26lb16',
+         lambda: e_step(state_model, batches)),
+        (f'baum_welch.em_steps.bl26lb16.{num_steps}_steps',
+         lambda: em_steps(state_model, batches, num_steps, tolerance=0.)),
+        (f'sampling.sample_sequences.bl26lb16.{num_samples}',
+         lambda: sample_sequences(state_model, num_samples, seed=seed)),
+        (f'derive_initial_state_model.halving.bl26lb16.{num_steps}_steps',
+         lambda: derive_initial_state_model(symbols['seqs_mapped'], max_repeats,
+                                            len(symbols['symbols']),
+                                            max_extra_states=num_extra_states,
+                                            num_random_starts=4, max_steps=num_steps,
+                                            tolerance=0., seed=seed, search='halving',
+                                            halving_steps=1)),
+    ]
+
+
+def run(sizes, repeat=5, name_filter=None, em=True):
+    """runs every benchmark
+
+    Returns
+    -------
+    results : list
+        of dicts, each with the name of the benchmark, the corpus size
+        (or the dataset) and the times returned by time_func
+    """
+    results = []
+    corpus_sizes = [dict(BASE_SIZE)]
+    for axis, values in sizes.items():
+        for value in values:
+            size = dict(BASE_SIZE, **{axis: value})
+            if size not in corpus_sizes:
+                corpus_sizes.append(size)
+
+    for size in corpus_sizes:
+        corpus = synthetic_corpus(**size)
+        for name, func in corpus_benchmarks(corpus):
+            if name_filter and name_filter not in name:
+                continue
+            results.append(dict(name=name, params=size, **time_func(func, repeat)))
+            _report(results[-1])
+
+    if em:
+        for name, func in em_benchmarks():
+            if name_filter and name_filter not in name:
+                continue
+            results.append(dict(name=name, params={'dataset': 'bl26lb16'},
+                                **time_func(func, repeat)))
+            _report(results[-1])
+    return results
+
+
+def _key(result):
+    return result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(results, baseline, threshold=1.2):
+    """benchmarks whose median time is more than threshold times
+    the median time of the same benchmark in baseline
+
+    Returns
+    -------
+    regressions : list
+        of dicts with keys name, params, baseline, current and ratio
+    """
+    baseline_medians = {_key(result): result['median'] for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = baseline_medians.get(_key(result))
+        if before and result['median'] > threshold * before:
+            regressions.append({'name': result['name'], 'params': result['params'],
+                                'baseline': before, 'current': result['median'],
+                                'ratio': result['median'] / before})
+    return regressions
+
+
+def environment():
+    """versions of what was benchmarked, stored with results"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'commit': commit}
+
+
+def _report(result):
+    print(f"{result['name']:<45} {json.dumps(result['params']):<70} "
+          f"{result['median'] * 1e3:10.2f} ms", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmarks of pomma hot paths')
+    parser.add_argument('--output', help='file to write results to, as JSON. '
+                                         'Default is to write them to stdout.')
+    parser.add_argument('--compare', help='JSON file with results of an earlier run. '
+                                          'Exits with status 1 if any benchmark is slower.')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='ratio of median times counted as slower. Default is 1.2.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of timed calls of each benchmark. Default is 5.')
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this')
+    parser.add_argument('--quick', action='store_true', help='smaller corpora only')
+    parser.add_argument('--no-em', action='store_true', help='skip E-M, sampling and search on bl26lb16')
+    args = parser.parse_args(argv)
+
+    results = run(QUICK_SIZES if args.quick else SIZES, repeat=args.repeat,
+                  name_filter=args.filter, em=not args.no_em)
+    output = {'environment': environment(), 'results': results}
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            output['regressions'] = compare(results, json.load(baseline_file), args.threshold)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+
+    for regression in output.get('regressions', []):
+        print(f"slower: {regression['name']} {json.dumps(regression['params'])} "
+              f"{regression['ratio']:.2f}x", file=sys.stderr)
+    return 1 if output.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+# accumulators that compute the statistics in statistics.py from chunks of
+# sequences, so that statistics of many generated sequences can be computed
+# as they are generated, without keeping every sequence in memory.
+# Accumulators from different processes can be merged, then finalized into
+# the same dicts returned by the functions in statistics.py.
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from .encoding import encode_strings, decode_ngram_keys
+from .ngram_index import NgramIndex
+from .statistics import (repeat_counts, step_counts, ngram_distrib,
+                         repeat_distribs_from_counts, step_probs_from_counts)
+
+
+def _add_padded(counts, new_counts):
+    """adds two count matrices with the same number of rows,
+    padding the narrower one with columns of zeros"""
+    if counts.shape[1] < new_counts.shape[1]:
+        counts, new_counts = new_counts, counts
+    counts = counts.copy()
+    counts[:, :new_counts.shape[1]] += new_counts
+    return counts
+
+
+def _add_sorted_counts(keys, counts, new_keys, new_counts):
+    """adds counts of keys in two sorted arrays of unique keys"""
+    all_keys, inverse = np.unique(np.concatenate((keys, new_keys)), return_inverse=True)
+    all_counts = np.bincount(inverse, weights=np.concatenate((counts, new_counts)),
+                             minlength=all_keys.shape[0])
+    return all_keys, all_counts.astype(np.int64)
+
+
+class _Accumulator(ABC):
+    """base class with what all accumulators share.
+    Subclasses define _config, _update and _merge."""
+
+    @abstractmethod
+    def _config(self):
+        """parameters that have to be equal for two accumulators to be merged"""
+
+    @abstractmethod
+    def _update(self, sequences):
+        """adds counts of a chunk of sequences"""
+
+    @abstractmethod
+    def _merge(self, other):
+        """adds counts of another accumulator, already checked to have the same _config"""
+
+    def update(self, sequences):
+        """adds a chunk of sequences
+
+        Parameters
+        ----------
+        sequences : list
+            of str, e.g. one chunk of sequences generated by
+            first_order_markov.generate_sequences
+
+        Returns
+        -------
+        self
+        """
+        self._update(sequences)
+        self.num_seq += len(sequences)
+        return self
+
+    def update_from(self, chunks):
+        """adds every chunk of sequences from an iterable, e.g. a generator
+
+        Returns
+        -------
+        self
+        """
+        for sequences in chunks:
+            self.update(sequences)
+        return self
+
+    def merge(self, other):
+        """adds counts from another accumulator with the same parameters,
+        e.g. one that was updated in another process
+
+        Returns
+        -------
+        self
+        """
+        if type(other) is not type(self) or other._config() != self._config():
+            raise ValueError('can only merge accumulators of the same type, '
+                             'with the same parameters')
+        self._merge(other)
+        self.num_seq += other.num_seq
+        return self
+
+
+class NgramAccumulator(_Accumulator):
+    """accumulates n-gram counts, see statistics.get_ngram_distribs
+
+    Parameters are the same as statistics.get_ngram_distribs.
+    If real_ngram_distribs is given, only the n-grams in it are counted,
+    so memory used does not grow with the number of sequences.
+
+    Examples
+    --------
+    >>> accumulator = NgramAccumulator(labelset, n_range=range(2, 8),
+    ...                                real_ngram_distribs=real_ngram_distribs)
+    >>> for chunk in chunks:
+    ...     accumulator.update(chunk)
+    >>> distribs = accumulator.finalize()
+    """
+
+    def __init__(self, labelset, n_range=range(2, 8), startchar='S', endchar='E',
+                 real_ngram_distribs=None):
+        self.n_range = list(n_range)
+        self.startchar = startchar
+        self.endchar = endchar
+        labels = set(labelset) - {startchar, endchar}
+        if real_ngram_distribs:
+            self.ngrams = {n: [ngram for ngram, _ in real_ngram_distribs[n]['counts']]
+                           for n in self.n_range}
+            for ngrams in self.ngrams.values():
+                labels.update(*ngrams)
+            self.counts = {n: np.zeros(len(self.ngrams[n]), dtype=np.int64)
+                           for n in self.n_range}
+        else:
+            self.ngrams = None
+            # sorted keys of n-grams found so far, see encoding.ngram_keys
+            self.keys = {n: np.zeros(0, dtype=np.int64) for n in self.n_range}
+            self.counts = {n: np.zeros(0, dtype=np.int64) for n in self.n_range}
+        self.labels = ''.join(sorted(labels))
+        self.num_seq = 0
+
+    def _config(self):
+        return self.n_range, self.startchar, self.endchar, self.labels, self.ngrams
+
+    def _update(self, sequences):
+        flat, offsets = encode_strings(sequences, self.labels, self.startchar, self.endchar)
+        index = NgramIndex(flat, offsets, self.labels, max(self.n_range))
+        for n in self.n_range:
+            if self.ngrams is not None:
+                self.counts[n] += index.count_many(self.ngrams[n])
+            else:
+                self.keys[n], self.counts[n] = _add_sorted_counts(
+                    self.keys[n], self.counts[n], *index.counts(n))
+
+    def _merge(self, other):
+        for n in self.n_range:
+            if self.ngrams is not None:
+                self.counts[n] += other.counts[n]
+            else:
+                self.keys[n], self.counts[n] = _add_sorted_counts(
+                    self.keys[n], self.counts[n], other.keys[n], other.counts[n])
+
+    def finalize(self):
+        """distributions of n-grams in every sequence added,
+        as returned by statistics.get_ngram_distribs"""
+        distribs = {}
+        for n in self.n_range:
+            if self.ngrams is not None:
+                ngrams = self.ngrams[n]
+            else:
+                ngrams = decode_ngram_keys(self.keys[n], n, self.labels)
+            distribs[n] = ngram_distrib(ngrams, self.counts[n])
+        return distribs
+
+
+class StepProbAccumulator(_Accumulator):
+    """accumulates counts of labels at each step, see statistics.get_step_prob
+
+    Parameters are the same as statistics.get_step_prob. If max_steps is None,
+    the number of steps grows to the length of the longest sequence added.
+    """
+
+    def __init__(self, labelset, startchar='S', endchar='E', max_steps=None):
+        self.labels = ''.join(sorted(set(labelset) - set(startchar)))
+        self.max_steps = max_steps
+        self.counts = np.zeros((len(self.labels), max_steps or 0), dtype=np.int64)
+        self.num_seq = 0
+
+    def _config(self):
+        return self.labels, self.max_steps
+
+    def _update(self, sequences):
+        # start characters are not stripped, see statistics.get_step_prob
+        flat, offsets = encode_strings(sequences, self.labels, startchar='', endchar='')
+        self.counts = _add_padded(self.counts, step_counts(flat, offsets, len(self.labels),
+                                                           self.max_steps))
+
+    def _merge(self, other):
+        self.counts = _add_padded(self.counts, other.counts)
+
+    def finalize(self, as_matrix=False):
+        """step probabilities of every sequence added,
+        as returned by statistics.get_step_prob"""
+        step_probs = step_probs_from_counts(self.counts)
+        if as_matrix:
+            return self.labels, step_probs
+        return dict(zip(self.labels, step_probs))
+
+
+class RepeatAccumulator(_Accumulator):
+    """accumulates counts of run lengths, see statistics.get_repeat_distribs
+
+    Parameters are the same as statistics.get_repeat_distribs.
+    """
+
+    def __init__(self, labels):
+        self.labels = ''.join(labels)
+        self.counts = np.zeros((len(self.labels), 0), dtype=np.int64)
+        self.num_seq = 0
+
+    def _config(self):
+        return self.labels
+
+    def _update(self, sequences):
+        flat, offsets = encode_strings(sequences, self.labels, startchar='', endchar='')
+        self.counts = _add_padded(self.counts, repeat_counts(flat, offsets, len(self.labels)))
+
+    def _merge(self, other):
+        self.counts = _add_padded(self.counts, other.counts)
+
+    def finalize(self, return_strings=True):
+        """distributions of repeats in every sequence added,
+        as returned by statistics.get_repeat_distribs"""
+        return repeat_distribs_from_counts(self.labels, self.counts, return_strings)
@@ -0,0 +1,299 @@
+# fits POMMA models to many birds at once. Each bird is split into three stages,
+# bootstrap error bounds, fitting the model, and comparing statistics of the fit
+# model with the data, and stages of every bird run on one shared process pool.
+# Each stage writes a checkpoint to the bird's output directory when it is done,
+# so a run that crashes can be started again and only does what is left.
+
+import csv
+import json
+import logging
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from .corpus import open_corpus, FLAT_FILENAME
+from .datasets import corpus_dirs
+from .pommafitter import POMMAfitter, _dict_items, _items_dict
+
+ERROR_BOUNDS_FILENAME = 'error_bounds.json'
+FIT_FILENAME = 'fit.npz'
+FIT_DONE_FILENAME = 'fit.json'
+MODEL_FILENAME = 'model.npz'
+SUMMARY_FILENAME = 'summary.json'
+SUMMARY_TABLE_FILENAME = 'summary.csv'
+
+SUMMARY_COLUMNS = [
+    'bird_ID',
+    'status',
+    'num_sequences',
+    'num_syllables',
+    'num_symbols',
+    'num_states',
+    'num_extra_states',
+    'log_likelihood',
+    'num_em_steps',
+    'step_prob_diff',
+    'step_prob_bound',
+    'within_error_bounds',
+    'bootstrap_seconds',
+    'fit_seconds',
+    'statistics_seconds',
+    'error',
+]
+
+
+def find_corpora(corpora=None, corpus_dir=None):
+    """corpus directory of each bird
+
+    Parameters
+    ----------
+    corpora : str or dict
+        a directory where each subdirectory is a corpus written by
+        corpus.write_corpus and named by bird ID, or a dict where keys are
+        bird IDs and values are corpus directories. Default is None,
+        in which case the birds in the datasets registry are used,
+        see datasets.corpus_dirs.
+    corpus_dir : str
+        directory the datasets registry is converted into when corpora is None.
+        Default is None, in which case datasets.default_corpus_dir() is used,
+        a directory in the user's cache, never the installed package.
+
+    Returns
+    -------
+    corpora : dict
+        where keys are bird IDs and values are corpus directories
+    """
+    if corpora is None:
+        return corpus_dirs(corpus_dir)
+    if isinstance(corpora, dict):
+        return dict(corpora)
+    return {name: os.path.join(corpora, name)
+            for name in sorted(os.listdir(corpora))
+            if os.path.isfile(os.path.join(corpora, name, FLAT_FILENAME))}
+
+
+def corpus_size(corpus_dir):
+    """number of syllables in a corpus, used to estimate how long it takes to fit.
+    0 if the corpus cannot be read, so the error is reported when its stages run."""
+    try:
+        return np.load(os.path.join(corpus_dir, FLAT_FILENAME), mmap_mode='r').shape[0]
+    except (OSError, ValueError):
+        return 0
+
+
+def _write_json(filename, obj):
+    # written to a temporary file first, so a crash never leaves half a checkpoint
+    with open(filename + '.tmp', 'w') as fp:
+        json.dump(obj, fp)
+    os.replace(filename + '.tmp', filename)
+
+
+def _read_json(filename):
+    with open(filename) as fp:
+        return json.load(fp)
+
+
+def _save_model(fitter, filename):
+    tmp_filename = filename[:-len('.npz')] + '.tmp.npz'
+    fitter.save(tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def _fitter_for_corpus(corpus_dir, params):
+    corpus = open_corpus(corpus_dir)
+    fitter = POMMAfitter(**params)
+    fitter._determine_symbols_and_max_repeats(corpus)
+    return fitter, corpus
+
+
+def bootstrap_stage(corpus_dir, bird_dir, params):
+    """estimates error bounds for one bird, see POMMAfitter._bootstrap_error_bounds"""
+    start = time.perf_counter()
+    fitter, _ = _fitter_for_corpus(corpus_dir, params)
+    fitter._bootstrap_error_bounds()
+    _write_json(os.path.join(bird_dir, ERROR_BOUNDS_FILENAME),
+                {'error_bounds': _dict_items(fitter.error_bounds),
+                 'seconds': time.perf_counter() - start})
+
+
+def fit_stage(corpus_dir, bird_dir, params):
+    """fits and prunes the model of one bird, without error bounds or statistics"""
+    start = time.perf_counter()
+    fitter, _ = _fitter_for_corpus(corpus_dir, params)
+    fitter._derive_initial_state_model()
+    fitter._prune()
+    fitter._sufficient_stats()
+    _save_model(fitter, os.path.join(bird_dir, FIT_FILENAME))
+    _write_json(os.path.join(bird_dir, FIT_DONE_FILENAME),
+                {'seconds': time.perf_counter() - start})
+
+
+def statistics_stage(corpus_dir, bird_dir, params):
+    """compares statistics of sequences generated by the fit model of one bird
+    with the bird's sequences, after bootstrap_stage and fit_stage are done.
+    Saves the complete model, and returns the bird's row of the summary table."""
+    start = time.perf_counter()
+    fitter = POMMAfitter.load(os.path.join(bird_dir, FIT_FILENAME))
+    from_corpus, corpus = _fitter_for_corpus(corpus_dir, params)
+    if from_corpus.symbols_int_map != fitter.symbols_int_map:
+        raise ValueError(f'corpus in {corpus_dir} changed since the model in {bird_dir} was fit')
+    fitter.seqs_mapped = from_corpus.seqs_mapped
+    bootstrap = _read_json(os.path.join(bird_dir, ERROR_BOUNDS_FILENAME))
+    fitter.error_bounds = _items_dict(bootstrap['error_bounds'])
+    fitter._compare_statistics()
+    _save_model(fitter, os.path.join(bird_dir, MODEL_FILENAME))
+
+    row = summary_row(fitter, corpus)
+    row.update(bootstrap_seconds=bootstrap['seconds'],
+               fit_seconds=_read_json(os.path.join(bird_dir, FIT_DONE_FILENAME))['seconds'],
+               statistics_seconds=time.perf_counter() - start)
+    _write_json(os.path.join(bird_dir, SUMMARY_FILENAME), row)
+    return row
+
+
+def within_error_bounds(res_diff, error_bounds):
+    """True if every difference in res_diff is no more than its error bound"""
+    within = res_diff['step_prob'] <= error_bounds['step_prob']
+    for key in ('ngram', 'repeat'):
+        for sub_key, bound in error_bounds[key].items():
+            within = within and res_diff[key].get(sub_key, 0.) <= bound
+    return bool(within)
+
+
+def summary_row(fitter, corpus):
+    """one row of the summary table for a fit model, see SUMMARY_COLUMNS"""
+    state_model = fitter.initial_state_model
+    return {
+        'status': 'done',
+        'num_sequences': int(corpus['offsets'].shape[0] - 1),
+        'num_syllables': int(corpus['flat'].shape[0]),
+        'num_symbols': len(fitter.symbols),
+        'num_states': int(np.asarray(state_model['state_symbols']).shape[0]),
+        'num_extra_states': int(state_model['num_extra_states']),
+        'log_likelihood': float(state_model['log_likelihood']),
+        'num_em_steps': int(state_model['num_em_steps']),
+        'step_prob_diff': fitter.res_diff['step_prob'],
+        'step_prob_bound': float(fitter.error_bounds['step_prob']),
+        'within_error_bounds': within_error_bounds(fitter.res_diff, fitter.error_bounds),
+    }
+
+
+def _run_now(func, *args):
+    """runs func now and returns a Future that is already done,
+    so that fit_birds schedules stages the same way without a pool"""
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as error:
+        future.set_exception(error)
+    return future
+
+
+def fit_birds(output_dir, corpora=None, n_jobs=1, corpus_dir=None, **params):
+    """fits a POMMA model to each of many birds
+
+    The error bounds, the fit model and the comparison of statistics of each bird
+    are separate stages, run on one pool of n_jobs worker processes.
+    Error bounds and fitting do not depend on each other, so they run at the same
+    time, and statistics are compared once both are done. Birds with the largest
+    corpora are submitted first, so no worker is left with a large bird at the end.
+
+    Each bird gets a directory in output_dir, and each stage writes a checkpoint
+    there when it is done. If output_dir already has checkpoints from an earlier run,
+    e.g. one that crashed, stages that are done are skipped. The complete model of
+    each bird is saved as model.npz, see POMMAfitter.save and POMMAfitter.load.
+    A bird that fails does not stop the others; its row in the summary has status
+    'failed' and the error, and it is tried again by the next run.
+
+    Parameters
+    ----------
+    output_dir : str
+        directory to write models, checkpoints and the summary table to.
+        Created if it does not exist.
+    corpora : str or dict
+        corpus directory of each bird, see find_corpora. Default is None,
+        in which case the birds in the datasets registry are fit.
+    n_jobs : int
+        Number of worker processes shared by all birds. Default is 1,
+        which runs every stage in this process. If -1, use all CPUs.
+    corpus_dir : str
+        directory the datasets registry is converted into, see find_corpora.
+    **params
+        passed to POMMAfitter for every bird. n_jobs of each POMMAfitter is
+        always 1, since birds already run in parallel.
+
+    Returns
+    -------
+    summary : list
+        of dicts, one per bird sorted by bird ID, with keys SUMMARY_COLUMNS.
+        Also written to summary.csv in output_dir.
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    params = dict(params, n_jobs=1)
+    corpora = find_corpora(corpora, corpus_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    bird_dirs = {bird_ID: os.path.join(output_dir, bird_ID) for bird_ID in corpora}
+    for bird_dir in bird_dirs.values():
+        os.makedirs(bird_dir, exist_ok=True)
+
+    summary = {}
+    first_stages = []
+    for bird_ID in sorted(corpora, key=lambda bird_ID: -corpus_size(corpora[bird_ID])):
+        bird_dir = bird_dirs[bird_ID]
+        if os.path.isfile(os.path.join(bird_dir, SUMMARY_FILENAME)):
+            summary[bird_ID] = _read_json(os.path.join(bird_dir, SUMMARY_FILENAME))
+            logging.info(f'{bird_ID} was already fit, skipping.')
+            continue
+        if not os.path.isfile(os.path.join(bird_dir, FIT_DONE_FILENAME)):
+            first_stages.append((bird_ID, 'fit', fit_stage))
+        if not os.path.isfile(os.path.join(bird_dir, ERROR_BOUNDS_FILENAME)):
+            first_stages.append((bird_ID, 'bootstrap', bootstrap_stage))
+        if not any(stage[0] == bird_ID for stage in first_stages):
+            first_stages.append((bird_ID, 'statistics', statistics_stage))
+    # fits take longest, so they go first, largest birds first
+    first_stages.sort(key=lambda stage: stage[1] != 'fit')
+
+    executor = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs > 1 else None
+    submit = executor.submit if executor is not None else _run_now
+    try:
+        pending = {}
+        waiting = {}
+        for bird_ID, stage, func in first_stages:
+            pending[submit(func, corpora[bird_ID], bird_dirs[bird_ID], params)] = bird_ID, stage
+            waiting[bird_ID] = waiting.get(bird_ID, 0) + (stage != 'statistics')
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                bird_ID, stage = pending.pop(future)
+                error = future.exception()
+                if error is not None:
+                    logging.error(f'{stage} of {bird_ID} failed: {error!r}')
+                    summary[bird_ID] = {'status': 'failed', 'error': f'{stage}: {error!r}'}
+                elif stage == 'statistics':
+                    summary[bird_ID] = future.result()
+                    logging.info(f'{bird_ID} done.')
+                elif bird_ID not in summary:
+                    waiting[bird_ID] -= 1
+                    if waiting[bird_ID] == 0:
+                        pending[submit(statistics_stage, corpora[bird_ID], bird_dirs[bird_ID],
+                                       params)] = bird_ID, 'statistics'
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    rows = [dict({column: None for column in SUMMARY_COLUMNS}, bird_ID=bird_ID,
+                 **summary[bird_ID])
+            for bird_ID in sorted(summary)]
+    write_summary_table(os.path.join(output_dir, SUMMARY_TABLE_FILENAME), rows)
+    return rows
+
+
+def write_summary_table(filename, rows):
+    """writes rows returned by fit_birds as a CSV file"""
+    with open(filename, 'w', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
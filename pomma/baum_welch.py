@@ -0,0 +1,1300 @@
+# forward-backward (Baum-Welch) engine used to fit POMMA state models
+# with Expectation-Maximization (E-M)
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+from scipy import sparse
+
+from .instrumentation import em_step_event
+
+# by convention the first two states of every state model
+# are the start state and the end state
+START_STATE = 0
+END_STATE = 1
+
+
+def init_state_model(state_symbols, max_repeat_nums, rng=None):
+    """makes a state model with random transition and repeat probabilities,
+    used as a starting point for E-M
+
+    Parameters
+    ----------
+    state_symbols : list
+        of int, symbol emitted by each state. The first two states are
+        the start state and the end state.
+    max_repeat_nums : list
+        of int, maximum number of consecutive repeats for each state.
+        0 for the start and end states.
+    rng : numpy.random.Generator
+        used to draw random probabilities. Default is None,
+        in which case a new Generator is created with no seed.
+
+    Returns
+    -------
+    state_model : dict
+        with following key, value pairs:
+            state_symbols : ndarray
+                of int, symbol emitted by each state
+            max_repeat_nums : ndarray
+                of int, maximum number of consecutive repeats for each state
+            trans : ndarray
+                num_states x num_states matrix, where element i,j is the
+                probability of leaving state i for state j
+            repeat_probs : ndarray
+                num_states x max(max_repeat_nums) matrix, where element i,r
+                is the probability that state i emits its symbol again
+                after emitting it r + 1 times in a row.
+                This is how states "adapt" to repeats.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    state_symbols = np.asarray(state_symbols)
+    max_repeat_nums = np.asarray(max_repeat_nums)
+    num_states = state_symbols.shape[0]
+
+    trans = rng.uniform(size=(num_states, num_states))
+    trans = normalize_rows(np.where(allowed_transitions(num_states), trans, 0.))
+
+    max_repeat = max(max_repeat_nums.max(), 1)
+    repeat_probs = rng.uniform(size=(num_states, max_repeat))
+    repeat_probs[~allowed_repeats(max_repeat_nums, max_repeat)] = 0.
+
+    return {
+        'state_symbols': state_symbols,
+        'max_repeat_nums': max_repeat_nums,
+        'trans': trans,
+        'repeat_probs': repeat_probs,
+    }
+
+
+def allowed_transitions(num_states):
+    """mask of transitions a state model can have: none into the start state,
+    none out of the end state, and none from a state to itself (handled by repeat_probs).
+    The start state can go directly to the end state, which is an empty bout."""
+    allowed = ~np.eye(num_states, dtype=bool)
+    allowed[:, START_STATE] = False
+    allowed[END_STATE, :] = False
+    allowed[START_STATE, END_STATE] = True
+    return allowed
+
+
+def allowed_repeats(max_repeat_nums, max_repeat):
+    """mask of repeat probabilities a state model can have,
+    given the maximum number of repeats of each state"""
+    return np.arange(max_repeat) < np.asarray(max_repeat_nums)[:, np.newaxis] - 1
+
+
+def dense_trans(trans):
+    """transition matrix as a dense array, whether it is stored dense or sparse"""
+    if sparse.issparse(trans):
+        return trans.toarray()
+    return trans
+
+
+def sparse_state_model(state_model):
+    """copy of a state model with transitions stored as a scipy.sparse.csr_matrix,
+    e.g. after pruning, when most transition probabilities are zero.
+
+    Any function that takes a state model accepts either one. For a sparse
+    state model, kernel_tables and sampling.sampling_tables only store its
+    non-zero transitions, forward-backward and Viterbi only go through those,
+    and e_step and m_step only count and re-estimate those, so memory and time
+    of each step of E-M grow with the number of transitions, not states squared.
+    m_step keeps transitions sparse.
+    """
+    return dict(state_model, trans=sparse.csr_matrix(state_model['trans']))
+
+
+def smooth_state_model(state_model, smoothing=1e-3):
+    """mixes a small uniform probability into every allowed transition and repeat.
+
+    Used before fitting a state model to sequences it was not fit to,
+    since any transition those sequences need but the model gives probability
+    zero would make them impossible, and E-M could never recover it.
+
+    Parameters
+    ----------
+    state_model : dict
+        as returned by init_state_model or fit_em
+    smoothing : float
+        weight of uniform probabilities. Default is 0.001.
+
+    Returns
+    -------
+    smoothed : dict
+        copy of state_model with smoothed probabilities
+    """
+    trans = dense_trans(state_model['trans'])
+    allowed = allowed_transitions(trans.shape[0])
+    uniform = normalize_rows(allowed.astype(float))
+    repeat_probs = state_model['repeat_probs']
+    repeats = allowed_repeats(state_model['max_repeat_nums'], repeat_probs.shape[1])
+
+    smoothed = dict(state_model)
+    smoothed['trans'] = (1 - smoothing) * trans + smoothing * uniform
+    smoothed['repeat_probs'] = np.where(repeats,
+                                        (1 - smoothing) * repeat_probs + smoothing * 0.5,
+                                        0.)
+    return smoothed
+
+
+def normalize_rows(mat):
+    """divides each row by its sum, so rows sum to one. Rows that sum to zero stay zero.
+    Rows are along the last axis, so a stack of matrices is normalized matrix by matrix.
+    A sparse matrix is normalized without making it dense, and stays sparse."""
+    if sparse.issparse(mat):
+        totals = np.asarray(mat.sum(axis=1)).ravel()
+        scale = np.divide(1., totals, out=np.zeros(totals.shape), where=totals > 0)
+        return sparse.csr_matrix(sparse.diags(scale) @ mat)
+    totals = mat.sum(axis=-1, keepdims=True)
+    out = np.zeros(mat.shape, dtype=np.result_type(mat, float))
+    return np.divide(mat, totals, out=out, where=totals > 0)
+
+
+def pad_sequences(sequences, pad_value=0):
+    """pads sequences of mapped symbols into one 2-D array
+
+    Parameters
+    ----------
+    sequences : list
+        of lists (or 1-D arrays) of int, e.g. seqs_mapped
+        as returned by determine_symbols_and_max_repeats.
+    pad_value : int
+        used to fill positions after the end of each sequence. Default is 0.
+
+    Returns
+    -------
+    padded : ndarray
+        num_sequences x max sequence length array of int
+    lengths : ndarray
+        length of each sequence
+    """
+    lengths = np.asarray([len(seq) for seq in sequences], dtype=np.intp)
+    max_length = lengths.max() if lengths.size else 0
+    padded = np.full((lengths.shape[0], max_length), pad_value, dtype=np.intp)
+    mask = np.arange(max_length) < lengths[:, np.newaxis]
+    if lengths.size:
+        padded[mask] = np.concatenate([np.asarray(seq, dtype=np.intp)
+                                       for seq in sequences])
+    return padded, lengths
+
+
+def make_batches(sequences, batch_size=256):
+    """splits sequences into padded batches for the forward-backward kernels.
+
+    Sequences are sorted by decreasing length before they are split,
+    so each batch wastes little space on padding and the sequences still
+    "alive" at any step of a batch are always its first rows.
+
+    Parameters
+    ----------
+    sequences : list
+        of lists (or 1-D arrays) of int. Empty sequences are sorted last,
+        and have no steps; they go directly from the start state to the end state.
+    batch_size : int
+        maximum number of sequences per batch. Default is 256.
+
+    Returns
+    -------
+    batches : list
+        of tuples (inds, padded, lengths, layouts), where inds are the indices of
+        the sequences in the batch, padded and lengths are as returned
+        by pad_sequences, and layouts are as returned by step_layouts.
+        Layouts only depend on the sequences, so they are computed once here
+        instead of on every step of E-M.
+    """
+    lengths = np.asarray([len(seq) for seq in sequences], dtype=np.intp)
+    order = np.argsort(-lengths, kind='stable')
+    batches = []
+    for start in range(0, order.shape[0], batch_size):
+        inds = order[start:start + batch_size]
+        padded, batch_lengths = pad_sequences([sequences[ind] for ind in inds])
+        batches.append((inds, padded, batch_lengths,
+                        step_layouts(padded, batch_lengths)))
+    return batches
+
+
+def kernel_tables(state_model):
+    """re-arranges a state model into the tables used by the forward-backward kernels.
+
+    Each state emits exactly one symbol, so at any step of a sequence only
+    the states of the symbol observed at that step can be occupied.
+    The tables group states by symbol: slot s of symbol a is the s-th state
+    that emits a. Transitions are stored as one small block per pair of symbols,
+    so each step of the forward or backward pass only touches the block
+    for the two symbols actually observed.
+
+    For a state model with sparse transitions, there are no dense blocks.
+    Instead, the non-zero transitions between emitting states are stored as
+    a list of edges, grouped by pair of symbols, see pair_edges, and
+    the kernels only go through the edges of the pairs actually observed.
+
+    Parameters
+    ----------
+    state_model : dict
+        as returned by init_state_model
+
+    Returns
+    -------
+    tables : dict
+        with following key, value pairs:
+            symbol_states : ndarray
+                num_symbols x max slots array of state indices, -1 where
+                a symbol has fewer states than max slots
+            trans_blocks : ndarray
+                num_symbols x num_symbols x max slots x max slots,
+                probability of leaving the state in slot s of symbol a
+                for the state in slot k of symbol b.
+                Only for state models with dense transitions.
+            edge_ptr, edge_src, edge_dst, edge_probs : ndarray
+                instead of trans_blocks, for state models with sparse transitions.
+                The edges of symbols a and b are edge_ptr[a * num_symbols + b]
+                up to edge_ptr[a * num_symbols + b + 1], sorted by edge_dst and
+                then edge_src, where edge_src and edge_dst are the slots of
+                the states each edge leaves and enters, and edge_probs
+                their transition probabilities.
+            within_blocks : ndarray
+                num_symbols x max slots x max slots, transitions between states
+                of the same symbol, i.e. trans_blocks[a, a] for each symbol a
+            start_probs : ndarray
+                num_symbols x max slots, probability of going from start state
+                to each state
+            end_probs : ndarray
+                num_symbols x max slots, probability of going from each state
+                to the end state
+            empty_prob : float
+                probability of going from the start state directly to the
+                end state, i.e. of an empty sequence
+            repeat_probs : ndarray
+                num_symbols x max slots x max repeats
+            exit_probs : ndarray
+                1 - repeat_probs, probability of leaving a state
+                after r + 1 repeats
+    """
+    state_symbols = state_model['state_symbols']
+    trans = state_model['trans']
+    repeat_probs = state_model['repeat_probs']
+
+    emitting = np.flatnonzero((np.arange(state_symbols.shape[0]) != START_STATE)
+                              & (np.arange(state_symbols.shape[0]) != END_STATE))
+    num_symbols = state_symbols[emitting].max() + 1
+    slots_per_symbol = np.bincount(state_symbols[emitting], minlength=num_symbols)
+    num_slots = slots_per_symbol.max()
+
+    symbol_states = np.full((num_symbols, num_slots), -1, dtype=np.intp)
+    for symbol in range(num_symbols):
+        states = emitting[state_symbols[emitting] == symbol]
+        symbol_states[symbol, :states.shape[0]] = states
+    valid = symbol_states > -1
+    states = np.where(valid, symbol_states, START_STATE)
+
+    if sparse.issparse(trans):
+        tables = _sparse_edge_tables(trans, state_symbols, symbol_states)
+    else:
+        trans_blocks = trans[states[:, np.newaxis, :, np.newaxis],
+                             states[np.newaxis, :, np.newaxis, :]]
+        trans_blocks *= (valid[:, np.newaxis, :, np.newaxis]
+                         & valid[np.newaxis, :, np.newaxis, :])
+        tables = {
+            'trans_blocks': trans_blocks,
+            'within_blocks': trans_blocks[np.arange(num_symbols), np.arange(num_symbols)],
+            'start_probs': trans[START_STATE, states] * valid,
+            'end_probs': trans[states, END_STATE] * valid,
+        }
+    block_repeat_probs = repeat_probs[states] * valid[:, :, np.newaxis]
+    exit_probs = (1. - block_repeat_probs) * valid[:, :, np.newaxis]
+
+    return dict(tables,
+                symbol_states=symbol_states,
+                empty_prob=float(trans[START_STATE, END_STATE]),
+                repeat_probs=block_repeat_probs,
+                exit_probs=exit_probs)
+
+
+def _sparse_edge_tables(trans, state_symbols, symbol_states):
+    """edge lists, within_blocks, start_probs and end_probs of kernel_tables,
+    from the non-zero transitions of a sparse matrix only"""
+    num_symbols, num_slots = symbol_states.shape
+    slot_of_state = np.zeros(state_symbols.shape[0], dtype=np.intp)
+    valid = symbol_states > -1
+    slot_of_state[symbol_states[valid]] = np.nonzero(valid)[1]
+    edges = trans.tocoo()
+    src, dst, probs = edges.row, edges.col, edges.data
+    nonzero = probs != 0
+    src, dst, probs = src[nonzero], dst[nonzero], probs[nonzero]
+    from_emitting = (src != START_STATE) & (src != END_STATE)
+    to_emitting = (dst != START_STATE) & (dst != END_STATE)
+
+    between = from_emitting & to_emitting
+    pairs = state_symbols[src[between]] * num_symbols + state_symbols[dst[between]]
+    edge_src = slot_of_state[src[between]]
+    edge_dst = slot_of_state[dst[between]]
+    order = np.lexsort((edge_src, edge_dst, pairs))
+    edge_ptr = np.zeros(num_symbols ** 2 + 1, dtype=np.intp)
+    np.cumsum(np.bincount(pairs, minlength=num_symbols ** 2), out=edge_ptr[1:])
+    edge_src, edge_dst, edge_probs = edge_src[order], edge_dst[order], probs[between][order]
+
+    within_blocks = np.zeros((num_symbols, num_slots, num_slots))
+    pairs = pairs[order]
+    within = pairs // num_symbols == pairs % num_symbols
+    within_blocks[pairs[within] // num_symbols, edge_src[within], edge_dst[within]] = \
+        edge_probs[within]
+    start_probs = np.zeros((num_symbols, num_slots))
+    from_start = (src == START_STATE) & to_emitting
+    start_probs[state_symbols[dst[from_start]], slot_of_state[dst[from_start]]] = probs[from_start]
+    end_probs = np.zeros((num_symbols, num_slots))
+    to_end = from_emitting & (dst == END_STATE)
+    end_probs[state_symbols[src[to_end]], slot_of_state[src[to_end]]] = probs[to_end]
+    return {
+        'edge_ptr': edge_ptr,
+        'edge_src': edge_src,
+        'edge_dst': edge_dst,
+        'edge_probs': edge_probs,
+        'within_blocks': within_blocks,
+        'start_probs': start_probs,
+        'end_probs': end_probs,
+    }
+
+
+def pair_edges(tables, src_symbols, dst_symbols):
+    """edges of a state model with sparse transitions from each symbol
+    in src_symbols to the symbol at the same index of dst_symbols
+
+    Parameters
+    ----------
+    tables : dict
+        as returned by kernel_tables for a state model with sparse transitions
+    src_symbols, dst_symbols : ndarray
+        of int, same length, e.g. the symbols of each sequence of a batch
+        at two consecutive steps
+
+    Returns
+    -------
+    rows : ndarray
+        index into src_symbols of each edge, in increasing order
+    edges : ndarray
+        index of each edge into the edge lists of tables.
+        Edges of each row are sorted by the slot they enter.
+    """
+    num_symbols = tables['symbol_states'].shape[0]
+    pairs = src_symbols * num_symbols + dst_symbols
+    starts = tables['edge_ptr'][pairs]
+    num_edges = tables['edge_ptr'][pairs + 1] - starts
+    rows = np.repeat(np.arange(pairs.shape[0]), num_edges)
+    edges = np.arange(rows.shape[0]) + np.repeat(starts - np.cumsum(num_edges) + num_edges,
+                                                 num_edges)
+    return rows, edges
+
+
+def _sum_by(keys, values, size):
+    """sums of values with the same key, for keys 0 to size - 1.
+    Unlike np.bincount, always float, even when there are no values"""
+    return np.bincount(keys, weights=values, minlength=size).astype(float, copy=False)
+
+
+def _enter_probs(tables, exits, src_symbols, dst_symbols):
+    """probability of entering each slot of dst_symbols, from probabilities
+    exits of leaving each slot of src_symbols, one row per sequence"""
+    if 'trans_blocks' in tables:
+        return np.einsum('ns,nsk->nk', exits, tables['trans_blocks'][src_symbols, dst_symbols])
+    rows, edges = pair_edges(tables, src_symbols, dst_symbols)
+    num_rows, num_slots = exits.shape
+    values = exits[rows, tables['edge_src'][edges]] * tables['edge_probs'][edges]
+    return _sum_by(rows * num_slots + tables['edge_dst'][edges], values,
+                   num_rows * num_slots).reshape((num_rows, num_slots))
+
+
+def _leave_probs(tables, counts, exits, entry, src_symbols, dst_symbols):
+    """backward step from entry, the scaled probability of the rest of each sequence
+    given it enters each slot of dst_symbols, to each slot of src_symbols it leaves.
+    Also adds expected counts of transitions, given exits, the scaled forward
+    probabilities of leaving each slot of src_symbols, to counts['trans']."""
+    if 'trans_blocks' in tables:
+        blocks = tables['trans_blocks'][src_symbols, dst_symbols]
+        num_symbols = tables['trans_blocks'].shape[0]
+        trans_counts = counts['trans'].reshape((num_symbols ** 2,) + blocks.shape[1:])
+        xi = exits[:, :, np.newaxis] * blocks * entry[:, np.newaxis, :]
+        _add_at(trans_counts, src_symbols * num_symbols + dst_symbols, xi)
+        return np.einsum('nsk,nk->ns', blocks, entry)
+    rows, edges = pair_edges(tables, src_symbols, dst_symbols)
+    num_rows, num_slots = exits.shape
+    edge_src = tables['edge_src'][edges]
+    to_rest = tables['edge_probs'][edges] * entry[rows, tables['edge_dst'][edges]]
+    counts['trans'] += _sum_by(edges, exits[rows, edge_src] * to_rest, counts['trans'].shape[0])
+    return _sum_by(rows * num_slots + edge_src, to_rest,
+                   num_rows * num_slots).reshape((num_rows, num_slots))
+
+
+def _add_within_counts(tables, counts, symbol, within_counts):
+    """adds expected counts of transitions between states of one symbol,
+    as a max slots x max slots array, to counts['trans']"""
+    if 'trans_blocks' in tables:
+        counts['trans'][symbol, symbol] += within_counts
+        return
+    pair = symbol * tables['symbol_states'].shape[0] + symbol
+    edges = np.arange(tables['edge_ptr'][pair], tables['edge_ptr'][pair + 1])
+    counts['trans'][edges] += within_counts[tables['edge_src'][edges], tables['edge_dst'][edges]]
+
+
+def run_positions(padded, lengths):
+    """position of each symbol within its run of repeats, starting from 1.
+    0 for padding after the end of a sequence."""
+    num_seqs, max_length = padded.shape
+    steps = np.arange(max_length)
+    new_run = np.ones(padded.shape, dtype=bool)
+    new_run[:, 1:] = padded[:, 1:] != padded[:, :-1]
+    run_starts = np.maximum.accumulate(np.where(new_run, steps, 0), axis=1)
+    positions = steps - run_starts + 1
+    positions[steps >= lengths[:, np.newaxis]] = 0
+    return positions
+
+
+def step_layouts(padded, lengths):
+    """layout of the forward and backward probabilities at each step of a batch.
+
+    A state can only have emitted its symbol r + 1 times in a row if the sequence
+    is at position r + 1 (or later) of a run of that symbol. So at each step,
+    each sequence only needs as many entries as its position in the current run,
+    instead of the maximum number of repeats of any symbol.
+    Entries are stored "ragged": all entries for the first sequence,
+    then all entries for the second, and so on.
+
+    Parameters
+    ----------
+    padded, lengths : ndarray
+        batch of sequences, as returned by make_batches
+
+    Returns
+    -------
+    layouts : list
+        of tuples (offsets, entry_rows, entry_reps), one per step, where
+        offsets is the index of the first entry of each sequence alive
+        at that step, and entry_rows and entry_reps are the sequence and
+        number of repeats (minus one) that each entry corresponds to.
+    """
+    positions = run_positions(padded, lengths)
+    layouts = []
+    for t in range(padded.shape[1]):
+        num_live = np.count_nonzero(lengths > t)
+        position = positions[:num_live, t]
+        offsets = np.cumsum(position) - position
+        entry_rows = np.repeat(np.arange(num_live), position)
+        entry_reps = np.arange(entry_rows.shape[0]) - offsets[entry_rows]
+        layouts.append((offsets, entry_rows, entry_reps))
+    return layouts
+
+
+def forward(tables, padded, lengths, layouts=None):
+    """forward pass with scaling, over one batch of padded sequences
+
+    Parameters
+    ----------
+    tables : dict
+        as returned by kernel_tables
+    padded : ndarray
+        num_sequences x max length array of mapped symbols
+    lengths : ndarray
+        lengths of sequences. Must be sorted in decreasing order,
+        as they are in batches returned by make_batches.
+    layouts : list
+        as returned by step_layouts. Default is None, in which case
+        they are computed from padded and lengths.
+
+    Returns
+    -------
+    alphas : list
+        of ndarray, one per step t, scaled forward probabilities of shape
+        number of entries at t x max slots, laid out as described in step_layouts.
+        Element e,s is the probability of being in slot s after
+        entry_reps[e] + 1 consecutive emissions, given the symbols up to step t.
+    scales : ndarray
+        max length x num_sequences, scaling factor of each step.
+        1 after the end of a sequence.
+    end_scales : ndarray
+        probability of going to the end state from the last step
+        of each sequence, or from the start state for empty sequences.
+        The log-likelihood of a sequence is
+        the sum of the log of its scales plus the log of its end scale.
+    layouts : list
+    """
+    if layouts is None:
+        layouts = step_layouts(padded, lengths)
+    repeat_probs = tables['repeat_probs']
+    exit_probs = tables['exit_probs']
+    num_slots = repeat_probs.shape[1]
+    num_seqs, max_length = padded.shape
+
+    alphas = []
+    scales = np.ones((max_length, num_seqs))
+    end_scales = np.ones(num_seqs)
+    end_scales[lengths == 0] = tables['empty_prob']
+    for t, (offsets, entry_rows, entry_reps) in enumerate(layouts):
+        num_live = offsets.shape[0]
+        cur = padded[:num_live, t]
+        alpha = np.zeros((entry_rows.shape[0], num_slots))
+        if t == 0:
+            alpha[offsets] = tables['start_probs'][cur]
+        else:
+            alpha_prev = alphas[t - 1]
+            prev_offsets, prev_rows, prev_reps = layouts[t - 1]
+            exits = np.add.reduceat(
+                alpha_prev * exit_probs[padded[prev_rows, t - 1], :, prev_reps],
+                prev_offsets, axis=0)[:num_live]
+            prev = padded[:num_live, t - 1]
+            alpha[offsets] = _enter_probs(tables, exits, prev, cur)
+            repeats = np.flatnonzero(entry_reps)
+            if repeats.size:
+                rows = entry_rows[repeats]
+                reps = entry_reps[repeats] - 1
+                alpha[repeats] = (alpha_prev[prev_offsets[rows] + reps]
+                                  * repeat_probs[cur[rows], :, reps])
+        scale = np.add.reduceat(alpha.sum(axis=1), offsets)
+        scales[t, :num_live] = scale
+        alpha /= np.where(scale > 0, scale, 1.)[entry_rows, np.newaxis]
+        alphas.append(alpha)
+
+        num_next = np.count_nonzero(lengths[:num_live] > t + 1)
+        if num_next < num_live:
+            # sequences that end at this step
+            split = offsets[num_next]
+            last = cur[entry_rows[split:]]
+            to_end = (alpha[split:] * exit_probs[last, :, entry_reps[split:]]
+                      * tables['end_probs'][last]).sum(axis=1)
+            end_scales[num_next:num_live] = np.add.reduceat(to_end, offsets[num_next:] - split)
+    return alphas, scales, end_scales, layouts
+
+
+def log_likelihoods(scales, end_scales):
+    """log-likelihood of each sequence, from scales returned by forward.
+    -inf for sequences that are impossible under the model."""
+    with np.errstate(divide='ignore'):
+        return np.log(scales).sum(axis=0) + np.log(end_scales)
+
+
+def empty_counts(tables):
+    """zeroed arrays to accumulate expected counts into.
+    Repeats and visits are stored as num_symbols x max repeats x max slots,
+    so they can be indexed by (symbol, number of repeats) pairs.
+    Transitions are stored like trans_blocks, or with one count per edge
+    for tables of a state model with sparse transitions, see kernel_tables.
+    'empty' counts transitions from the start state directly to the end state."""
+    num_symbols, num_slots, max_repeat = tables['repeat_probs'].shape
+    if 'trans_blocks' in tables:
+        trans_counts = np.zeros((num_symbols, num_symbols, num_slots, num_slots))
+    else:
+        trans_counts = np.zeros(tables['edge_probs'].shape[0])
+    return {
+        'trans': trans_counts,
+        'start': np.zeros((num_symbols, num_slots)),
+        'end': np.zeros((num_symbols, num_slots)),
+        'repeat': np.zeros((num_symbols, max_repeat, num_slots)),
+        'visits': np.zeros((num_symbols, max_repeat, num_slots)),
+        'empty': 0.,
+    }
+
+
+def _add_at(target, index, values):
+    """adds rows of values to rows of target selected by index, like np.add.at.
+    Sorting the index once and summing each run with reduceat is much faster
+    than np.add.at when the same rows are selected many times."""
+    order = np.argsort(index, kind='stable')
+    sorted_index = index[order]
+    starts = np.flatnonzero(np.r_[True, sorted_index[1:] != sorted_index[:-1]])
+    target[sorted_index[starts]] += np.add.reduceat(values[order], starts, axis=0)
+
+
+def backward(tables, padded, lengths, alphas, scales, end_scales, layouts, counts):
+    """backward pass that accumulates expected counts of transitions,
+    repeats and state visits for one batch of sequences
+
+    Parameters
+    ----------
+    tables : dict
+        as returned by kernel_tables
+    padded, lengths : ndarray
+        batch of sequences, as passed to forward
+    alphas, scales, end_scales, layouts :
+        as returned by forward
+    counts : dict
+        as returned by empty_counts. Modified in place.
+
+    Returns
+    -------
+    counts : dict
+    """
+    repeat_probs = tables['repeat_probs']
+    exit_probs = tables['exit_probs']
+    end_probs = tables['end_probs']
+    num_symbols, max_repeat, num_slots = counts['repeat'].shape
+    repeat_counts = counts['repeat'].reshape((num_symbols * max_repeat, num_slots))
+    visit_counts = counts['visits'].reshape((num_symbols * max_repeat, num_slots))
+    safe_scales = np.where(scales > 0, scales, 1.)
+    safe_end_scales = np.where(end_scales > 0, end_scales, 1.)
+    max_length = padded.shape[1]
+
+    beta_next = None
+    for t in range(max_length - 1, -1, -1):
+        offsets, entry_rows, entry_reps = layouts[t]
+        alpha = alphas[t]
+        num_live = offsets.shape[0]
+        num_next = layouts[t + 1][0].shape[0] if t + 1 < max_length else 0
+        split = offsets[num_next] if num_next < num_live else alpha.shape[0]
+        cur = padded[:num_live, t]
+        entry_symbols = cur[entry_rows]
+        exit_entries = exit_probs[entry_symbols, :, entry_reps]
+        beta = np.zeros(alpha.shape)
+
+        if num_next < num_live:
+            # sequences that end at this step
+            last = cur[num_next:]
+            to_end = end_probs[last] / safe_end_scales[num_next:num_live, np.newaxis]
+            beta[split:] = exit_entries[split:] * to_end[entry_rows[split:] - num_next]
+            exits = np.add.reduceat(alpha[split:] * exit_entries[split:],
+                                    offsets[num_next:] - split, axis=0)
+            _add_at(counts['end'], last, exits * to_end)
+
+        if num_next:
+            next_offsets, next_rows, next_reps = layouts[t + 1]
+            cur_next = cur[:num_next]
+            nxt = padded[:num_next, t + 1]
+            scale_next = safe_scales[t + 1, :num_next]
+            entry = beta_next[next_offsets] / scale_next[:, np.newaxis]
+            exits = np.add.reduceat(alpha[:split] * exit_entries[:split],
+                                    offsets[:num_next], axis=0)
+            leave = _leave_probs(tables, counts, exits, entry, cur_next, nxt)
+            beta[:split] = exit_entries[:split] * leave[entry_rows[:split]]
+
+            # entries with repeats at the next step come from
+            # the entry with one less repeat at this step
+            repeats = np.flatnonzero(next_reps)
+            if repeats.size:
+                rows = next_rows[repeats]
+                reps = next_reps[repeats] - 1
+                src = offsets[rows] + reps
+                symbols = cur_next[rows]
+                stay = (repeat_probs[symbols, :, reps] * beta_next[repeats]
+                        / scale_next[rows, np.newaxis])
+                beta[src] += stay
+                _add_at(repeat_counts, symbols * max_repeat + reps, alpha[src] * stay)
+
+        _add_at(visit_counts, entry_symbols * max_repeat + entry_reps, alpha * beta)
+        beta_next = beta
+
+    if max_length:
+        _add_at(counts['start'], padded[:alphas[0].shape[0], 0], alphas[0] * beta_next)
+    # an empty sequence can only go directly from the start state to the end state
+    counts['empty'] += np.count_nonzero((lengths == 0) & (end_scales > 0))
+    return counts
+
+
+def make_run_batches(sequences, batch_size=256):
+    """splits sequences into batches of runs, for the run-length compressed
+    forward-backward kernels (see forward_runs).
+
+    Each run of consecutive repeats of a symbol is stored once, as the symbol
+    and the length of the run, so a run of k repeats is one step
+    of forward-backward instead of k steps.
+    Sequences are sorted by decreasing number of runs, so the sequences still
+    "alive" at any step of a batch are always its first rows.
+
+    Parameters
+    ----------
+    sequences : list
+        of lists (or 1-D arrays) of int. Empty sequences have no runs,
+        see make_batches.
+    batch_size : int
+        maximum number of sequences per batch. Default is 256.
+
+    Returns
+    -------
+    batches : list
+        of tuples (inds, run_symbols, num_runs, run_lengths), where inds are
+        the indices of the sequences in the batch, run_symbols and run_lengths
+        are num_sequences x max number of runs arrays, padded with 0,
+        and num_runs is the number of runs in each sequence.
+        The tuples have the same layout as the ones returned by make_batches,
+        and can be used anywhere those can, e.g. by e_step.
+    """
+    lengths = np.asarray([len(seq) for seq in sequences], dtype=np.intp)
+    flat = np.concatenate([np.asarray(seq, dtype=np.intp) for seq in sequences])
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    new_run = np.ones(flat.shape[0], dtype=bool)
+    new_run[1:] = flat[1:] != flat[:-1]
+    new_run[offsets[:-1][lengths > 0]] = True
+    run_starts = np.flatnonzero(new_run)
+    all_run_symbols = flat[run_starts]
+    all_run_lengths = np.diff(np.append(run_starts, flat.shape[0]))
+    seq_of_run = np.repeat(np.arange(lengths.shape[0]), lengths)[run_starts]
+    num_runs = np.bincount(seq_of_run, minlength=lengths.shape[0]).astype(np.intp)
+    run_offsets = np.concatenate(([0], np.cumsum(num_runs)))
+
+    order = np.argsort(-num_runs, kind='stable')
+    batches = []
+    for start in range(0, order.shape[0], batch_size):
+        inds = order[start:start + batch_size]
+        batch_num_runs = num_runs[inds]
+        mask = np.arange(batch_num_runs.max()) < batch_num_runs[:, np.newaxis]
+        # index of each run of each sequence in the batch, in the arrays of all runs
+        run_inds = (run_offsets[inds][:, np.newaxis] + np.arange(mask.shape[1]))[mask]
+        run_symbols = np.zeros(mask.shape, dtype=np.intp)
+        run_symbols[mask] = all_run_symbols[run_inds]
+        run_lengths = np.zeros(mask.shape, dtype=np.intp)
+        run_lengths[mask] = all_run_lengths[run_inds]
+        batches.append((inds, run_symbols, batch_num_runs, run_lengths))
+    return batches
+
+
+def is_run_batch(batch):
+    """True if batch was made by make_run_batches instead of make_batches"""
+    return isinstance(batch[3], np.ndarray)
+
+
+def max_run_lengths(batches, num_symbols):
+    """length of the longest run of each symbol in batches made by make_run_batches"""
+    max_runs = np.zeros(num_symbols, dtype=np.intp)
+    for _, run_symbols, _, run_lengths in batches:
+        np.maximum.at(max_runs, run_symbols.ravel(), run_lengths.ravel())
+    return max_runs
+
+
+def run_tables(tables, max_runs):
+    """adds tables for runs of repeats to tables returned by kernel_tables.
+
+    A run of k repeats of symbol a can go through several states of a,
+    since a state can leave for another state of the same symbol.
+    Within a run, the model is a chain over (slot, number of repeats) pairs.
+    That chain is stepped forward once per symbol, up to the longest run
+    of each symbol, and the probability of each way through a run of length k
+    is kept, so that every run of length k is one step of forward_runs.
+
+    Parameters
+    ----------
+    tables : dict
+        as returned by kernel_tables. Modified in place.
+    max_runs : ndarray
+        longest run of each symbol, as returned by max_run_lengths
+
+    Returns
+    -------
+    tables : dict
+        with additional key, value pairs:
+            run_forwards : list
+                one per symbol, of lists of arrays, where element j of list a
+                has shape max slots x max slots x min(j + 1, max repeats)
+                and element s0,s,r is the probability of being in slot s after
+                r + 1 repeats at position j + 1 of a run, given
+                the run started in slot s0
+            run_exits : ndarray
+                num_symbols x max(max_runs) + 1 x max slots x max slots,
+                element a,k,s0,s is the probability that a run of a that starts
+                in slot s0 emits a exactly k times and leaves from slot s
+    """
+    repeat_probs = tables['repeat_probs']
+    exit_probs = tables['exit_probs']
+    num_symbols, num_slots, max_repeat = repeat_probs.shape
+    run_exits = np.zeros((num_symbols, max(max_runs.max(), 1) + 1, num_slots, num_slots))
+    run_forwards = []
+    for symbol in range(num_symbols):
+        within = tables['within_blocks'][symbol]
+        forwards = []
+        run_forward = np.eye(num_slots)[:, :, np.newaxis]
+        for j in range(1, max_runs[symbol] + 1):
+            width = run_forward.shape[2]
+            forwards.append(run_forward)
+            run_exits[symbol, j] = (run_forward * exit_probs[symbol, :, :width]).sum(axis=2)
+            if j == max_runs[symbol]:
+                break
+            next_forward = np.zeros((num_slots, num_slots, min(width + 1, max_repeat)))
+            num_stay = min(width, max_repeat - 1)
+            next_forward[:, :, 1:num_stay + 1] = (run_forward[:, :, :num_stay]
+                                                  * repeat_probs[symbol, :, :num_stay])
+            next_forward[:, :, 0] = run_exits[symbol, j] @ within
+            run_forward = next_forward
+        run_forwards.append(forwards)
+    tables['run_forwards'] = run_forwards
+    tables['run_exits'] = run_exits
+    return tables
+
+
+def forward_runs(tables, run_symbols, num_runs, run_lengths):
+    """forward pass with scaling, over one batch made by make_run_batches.
+    Like forward, but each step is one run of repeats.
+
+    Parameters
+    ----------
+    tables : dict
+        as returned by kernel_tables, with run tables added by run_tables
+    run_symbols, num_runs, run_lengths : ndarray
+        batch of runs, as returned by make_run_batches
+
+    Returns
+    -------
+    entries : list
+        of ndarray, one per step t, scaled probabilities of entering each slot
+        at the start of run t, for sequences with more than t runs
+    exits : list
+        of ndarray, one per step t, scaled probabilities of leaving each slot
+        at the end of run t
+    scales : ndarray
+        max number of runs x num_sequences, scaling factor of each step.
+        1 after the end of a sequence.
+    end_scales : ndarray
+        probability of going to the end state after the last run
+        of each sequence, or from the start state for empty sequences.
+    """
+    run_exits = tables['run_exits']
+    num_seqs, max_runs = run_symbols.shape
+    entries, exits = [], []
+    scales = np.ones((max_runs, num_seqs))
+    end_scales = np.ones(num_seqs)
+    end_scales[num_runs == 0] = tables['empty_prob']
+    for t in range(max_runs):
+        num_live = np.count_nonzero(num_runs > t)
+        cur = run_symbols[:num_live, t]
+        if t == 0:
+            entry = tables['start_probs'][cur]
+        else:
+            prev = run_symbols[:num_live, t - 1]
+            entry = _enter_probs(tables, exits[t - 1][:num_live], prev, cur)
+        scale = entry.sum(axis=1)
+        scales[t, :num_live] = scale
+        entry /= np.where(scale > 0, scale, 1.)[:, np.newaxis]
+        entries.append(entry)
+        exit_ = np.einsum('ns,nsk->nk', entry, run_exits[cur, run_lengths[:num_live, t]])
+        exits.append(exit_)
+
+        num_next = np.count_nonzero(num_runs[:num_live] > t + 1)
+        if num_next < num_live:
+            # sequences that end after this run
+            end_scales[num_next:num_live] = (exit_[num_next:]
+                                             * tables['end_probs'][cur[num_next:]]).sum(axis=1)
+    return entries, exits, scales, end_scales
+
+
+def backward_runs(tables, run_symbols, num_runs, run_lengths,
+                  entries, exits, scales, end_scales, counts):
+    """backward pass over one batch made by make_run_batches, that accumulates
+    expected counts of transitions between runs, and the posterior probability
+    of entering and leaving each run in each pair of slots.
+    Counts within runs are added afterwards by run_counts.
+
+    Parameters
+    ----------
+    tables : dict
+        as returned by kernel_tables, with run tables added by run_tables
+    run_symbols, num_runs, run_lengths : ndarray
+        batch of runs, as passed to forward_runs
+    entries, exits, scales, end_scales :
+        as returned by forward_runs
+    counts : dict
+        as returned by empty_counts, with additional key 'runs',
+        a zeroed array with the same shape as tables['run_exits']. Modified in place.
+
+    Returns
+    -------
+    counts : dict
+    """
+    run_exits = tables['run_exits']
+    end_probs = tables['end_probs']
+    num_symbols, max_run, num_slots, _ = run_exits.shape
+    run_counts = counts['runs'].reshape((num_symbols * max_run, num_slots, num_slots))
+    safe_scales = np.where(scales > 0, scales, 1.)
+    safe_end_scales = np.where(end_scales > 0, end_scales, 1.)
+
+    entry_next = None
+    for t in range(run_symbols.shape[1] - 1, -1, -1):
+        num_live = entries[t].shape[0]
+        num_next = entry_next.shape[0] if entry_next is not None else 0
+        cur = run_symbols[:num_live, t]
+        beta_exit = np.zeros((num_live, num_slots))
+
+        if num_next < num_live:
+            # sequences that end after this run
+            last = cur[num_next:]
+            to_end = end_probs[last] / safe_end_scales[num_next:num_live, np.newaxis]
+            beta_exit[num_next:] = to_end
+            _add_at(counts['end'], last, exits[t][num_next:] * to_end)
+
+        if num_next:
+            nxt = run_symbols[:num_next, t + 1]
+            entry = entry_next / safe_scales[t + 1, :num_next, np.newaxis]
+            beta_exit[:num_next] = _leave_probs(tables, counts, exits[t][:num_next], entry,
+                                                cur[:num_next], nxt)
+
+        lengths = run_lengths[:num_live, t]
+        _add_at(run_counts, cur * max_run + lengths,
+                entries[t][:, :, np.newaxis] * beta_exit[:, np.newaxis, :])
+        entry_next = np.einsum('nsk,nk->ns', run_exits[cur, lengths], beta_exit)
+
+    if entries:
+        _add_at(counts['start'], run_symbols[:entries[0].shape[0], 0], entries[0] * entry_next)
+    counts['empty'] += np.count_nonzero((num_runs == 0) & (end_scales > 0))
+    return counts
+
+
+def run_counts(tables, counts):
+    """adds expected counts of repeats, visits, and transitions between states
+    of the same symbol within runs, to counts accumulated by backward_runs.
+
+    Every run of symbol a with length k that started in slot s0 and left from
+    slot s has the same expected counts within it, so instead of going through
+    each run, the posterior probabilities of (k, s0, s) summed over all runs
+    are passed backward once through the chain within runs of a (see run_tables).
+
+    Parameters
+    ----------
+    tables : dict
+        as returned by kernel_tables, with run tables added by run_tables
+    counts : dict
+        as accumulated by backward_runs. Modified in place.
+
+    Returns
+    -------
+    counts : dict
+    """
+    repeat_probs = tables['repeat_probs']
+    exit_probs = tables['exit_probs']
+    for symbol, forwards in enumerate(tables['run_forwards']):
+        within = tables['within_blocks'][symbol]
+        run_posteriors = counts['runs'][symbol]
+        beta_next = None
+        for j in range(len(forwards), 0, -1):
+            run_forward = forwards[j - 1]
+            width = run_forward.shape[2]
+            exit_j = exit_probs[symbol, :, :width]
+            # leave the run at position j, or keep going
+            beta = run_posteriors[j][:, :, np.newaxis] * exit_j
+            if beta_next is not None:
+                num_stay = min(width, beta_next.shape[2] - 1)
+                stay = repeat_probs[symbol, :, :num_stay] * beta_next[:, :, 1:num_stay + 1]
+                beta[:, :, :num_stay] += stay
+                counts['repeat'][symbol, :num_stay] += (run_forward[:, :, :num_stay]
+                                                        * stay).sum(axis=0).T
+                to_same = beta_next[:, :, 0] @ within.T
+                beta += exit_j * to_same[:, :, np.newaxis]
+                leaving = (run_forward * exit_j).sum(axis=2)
+                _add_within_counts(tables, counts, symbol,
+                                   np.einsum('os,st,ot->st', leaving, within, beta_next[:, :, 0]))
+            counts['visits'][symbol, :width] += (run_forward * beta).sum(axis=0).T
+            beta_next = beta
+    return counts
+
+
+def state_counts(state_model, tables, counts):
+    """converts expected counts from the kernel layout back to one
+    row and column per state
+
+    Returns
+    -------
+    trans_counts : ndarray or scipy.sparse.csr_matrix
+        num_states x num_states, expected number of transitions.
+        Sparse, with only the non-zero counts, if tables are of a state model
+        with sparse transitions.
+    repeat_counts : ndarray
+        num_states x max repeats, expected number of repeats after r + 1 emissions
+    visit_counts : ndarray
+        num_states x max repeats, expected number of visits after r + 1 emissions
+    """
+    num_states, max_repeat = state_model['repeat_probs'].shape
+    symbol_states = tables['symbol_states']
+    num_symbols = symbol_states.shape[0]
+    valid = symbol_states > -1
+    states = symbol_states[valid]
+
+    if 'trans_blocks' in tables:
+        trans_counts = np.zeros((num_states, num_states))
+        block_valid = valid[:, np.newaxis, :, np.newaxis] & valid[np.newaxis, :, np.newaxis, :]
+        src = np.broadcast_to(symbol_states[:, np.newaxis, :, np.newaxis], block_valid.shape)
+        dst = np.broadcast_to(symbol_states[np.newaxis, :, np.newaxis, :], block_valid.shape)
+        trans_counts[src[block_valid], dst[block_valid]] = counts['trans'][block_valid]
+        trans_counts[START_STATE, states] = counts['start'][valid]
+        trans_counts[states, END_STATE] = counts['end'][valid]
+        trans_counts[START_STATE, END_STATE] = counts['empty']
+    else:
+        pairs = np.repeat(np.arange(num_symbols ** 2), np.diff(tables['edge_ptr']))
+        src = symbol_states[pairs // num_symbols, tables['edge_src']]
+        dst = symbol_states[pairs % num_symbols, tables['edge_dst']]
+        rows = np.concatenate((src, np.full(states.shape[0], START_STATE), states, [START_STATE]))
+        cols = np.concatenate((dst, states, np.full(states.shape[0], END_STATE), [END_STATE]))
+        values = np.concatenate((counts['trans'], counts['start'][valid], counts['end'][valid],
+                                 [counts['empty']]))
+        nonzero = values > 0
+        trans_counts = sparse.csr_matrix((values[nonzero], (rows[nonzero], cols[nonzero])),
+                                         shape=(num_states, num_states))
+
+    repeat_counts = np.zeros((num_states, max_repeat))
+    repeat_counts[states] = counts['repeat'].transpose((0, 2, 1))[valid]
+    visit_counts = np.zeros((num_states, max_repeat))
+    visit_counts[states] = counts['visits'].transpose((0, 2, 1))[valid]
+    return trans_counts, repeat_counts, visit_counts
+
+
+def e_step(state_model, batches):
+    """Expectation step: expected counts under state_model, summed over batches
+
+    Parameters
+    ----------
+    state_model : dict
+        as returned by init_state_model
+    batches : list
+        as returned by make_batches or make_run_batches
+
+    Returns
+    -------
+    trans_counts, repeat_counts, visit_counts : ndarray
+        as returned by state_counts; trans_counts is a sparse matrix
+        if state_model stores transitions as one
+    log_likelihood : float
+        total log-likelihood of sequences in batches under state_model
+    """
+    tables = kernel_tables(state_model)
+    counts = empty_counts(tables)
+    run_batches = [batch for batch in batches if is_run_batch(batch)]
+    if run_batches:
+        run_tables(tables, max_run_lengths(run_batches, tables['repeat_probs'].shape[0]))
+        counts['runs'] = np.zeros(tables['run_exits'].shape)
+    log_likelihood = 0.
+    for batch in batches:
+        _, padded, lengths, layouts = batch
+        if is_run_batch(batch):
+            entries, exits, scales, end_scales = forward_runs(tables, padded, lengths, layouts)
+            backward_runs(tables, padded, lengths, layouts,
+                          entries, exits, scales, end_scales, counts)
+        else:
+            alphas, scales, end_scales, layouts = forward(tables, padded, lengths, layouts)
+            backward(tables, padded, lengths, alphas, scales, end_scales, layouts, counts)
+        log_likelihood += log_likelihoods(scales, end_scales).sum()
+    if run_batches:
+        run_counts(tables, counts)
+    return state_counts(state_model, tables, counts) + (log_likelihood,)
+
+
+def drop_small(trans, state_symbols, prob_small):
+    """sets transition probabilities less than prob_small to zero,
+    and re-normalizes.
+
+    The most probable transition from each state to each symbol is always kept,
+    even when it is less than prob_small. Otherwise, rare symbols become
+    unreachable and any sequence containing them becomes impossible.
+    If trans is sparse, only its non-zero transitions are gone through,
+    and the result is sparse too.
+    """
+    if sparse.issparse(trans):
+        edges = sparse.csr_matrix(trans).tocoo()
+        _, symbol_groups = np.unique(state_symbols, return_inverse=True)
+        groups = edges.row * (symbol_groups.max() + 1) + symbol_groups[edges.col]
+        _, groups = np.unique(groups, return_inverse=True)
+        group_max = np.zeros(groups.max() + 1 if groups.size else 0)
+        np.maximum.at(group_max, groups, edges.data)
+        keep = ((edges.data >= prob_small)
+                | ((edges.data == group_max[groups]) & (edges.data > 0)))
+        return normalize_rows(sparse.csr_matrix(
+            (edges.data[keep], (edges.row[keep], edges.col[keep])), shape=trans.shape))
+    order = np.argsort(state_symbols, kind='stable')
+    sorted_symbols = state_symbols[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_symbols[1:] != sorted_symbols[:-1]])
+    group_of_state = np.empty_like(order)
+    group_of_state[order] = np.cumsum(np.r_[True, sorted_symbols[1:] != sorted_symbols[:-1]]) - 1
+    group_max = np.maximum.reduceat(trans[:, order], group_starts, axis=1)
+    keep = (trans >= prob_small) | ((trans == group_max[:, group_of_state]) & (trans > 0))
+    return normalize_rows(np.where(keep, trans, 0.))
+
+
+def m_step(state_model, trans_counts, repeat_counts, visit_counts, prob_small=1e-3):
+    """Maximization step: re-estimates probabilities from expected counts
+
+    States that were never visited keep their previous probabilities.
+    Transition probabilities less than prob_small are set to zero
+    and the remaining probabilities are re-normalized, see drop_small.
+    If state_model stores transitions as a sparse matrix, so does new_state_model.
+    If trans_counts is sparse, as returned by e_step for such a state model,
+    transitions are re-estimated from its non-zero counts only.
+
+    Returns
+    -------
+    new_state_model : dict
+    """
+    unvisited = np.asarray(trans_counts.sum(axis=1)).ravel() == 0
+    if sparse.issparse(trans_counts):
+        trans = (normalize_rows(trans_counts)
+                 + sparse.diags(unvisited.astype(float)) @ sparse.csr_matrix(state_model['trans']))
+    else:
+        trans = normalize_rows(trans_counts)
+        trans[unvisited] = dense_trans(state_model['trans'])[unvisited]
+    trans = drop_small(trans, state_model['state_symbols'], prob_small)
+
+    repeat_probs = np.divide(repeat_counts, visit_counts,
+                             out=state_model['repeat_probs'].copy(),
+                             where=visit_counts > 0)
+    # ratios of very small expected counts can round to just over 1
+    np.clip(repeat_probs, 0., 1., out=repeat_probs)
+
+    if sparse.issparse(state_model['trans']):
+        trans = sparse.csr_matrix(trans)
+    else:
+        trans = dense_trans(trans)
+    new_state_model = dict(state_model)
+    new_state_model['trans'] = trans
+    new_state_model['repeat_probs'] = repeat_probs
+    return new_state_model
+
+
+def param_change(state_model, new_state_model):
+    """largest absolute change in any transition or repeat probability"""
+    trans, new_trans = state_model['trans'], new_state_model['trans']
+    if sparse.issparse(trans) and sparse.issparse(new_trans):
+        trans_change = abs(new_trans - trans).max()
+    else:
+        trans_change = np.abs(dense_trans(new_trans) - dense_trans(trans)).max()
+    return max(trans_change,
+               np.abs(new_state_model['repeat_probs'] - state_model['repeat_probs']).max())
+
+
+def em_steps(state_model, batches, num_steps, tolerance=1e-3, prob_small=1e-3, trace=None):
+    """runs at most num_steps steps of E-M, so that fitting can be resumed later
+
+    Parameters
+    ----------
+    state_model : dict
+        state model to start from
+    batches : list
+        as returned by make_batches
+    num_steps : int
+        maximum number of steps to run
+    tolerance : float
+        E-M stops when no transition or repeat probability changes
+        by more than tolerance. Default is 0.001.
+    prob_small : float
+        transition probabilities less than prob_small are set to zero.
+        Default is 0.001.
+    trace : callable
+        called after each step with a dict, see instrumentation.em_step_event.
+        Default is None, in which case nothing is reported.
+
+    Returns
+    -------
+    state_model : dict
+        state model after the last step
+    log_likelihood : float
+        log-likelihood of sequences under the state model before the last step.
+        Because E-M never decreases the log-likelihood, this is a lower bound
+        for the log-likelihood under the state model returned.
+    steps_taken : int
+        number of E-M steps taken
+    converged : bool
+        if True, E-M stopped because changes were less than tolerance
+    """
+    log_likelihood = -np.inf
+    converged = False
+    step = 0
+    for step in range(1, num_steps + 1):
+        start = time.perf_counter()
+        *counts, log_likelihood = e_step(state_model, batches)
+        e_step_done = time.perf_counter()
+        new_state_model = m_step(state_model, *counts, prob_small=prob_small)
+        change = param_change(state_model, new_state_model)
+        state_model = new_state_model
+        if trace is not None:
+            trace(em_step_event(step, log_likelihood, change, tolerance,
+                                e_step_done - start, time.perf_counter() - e_step_done))
+        if change < tolerance:
+            converged = True
+            break
+    return state_model, log_likelihood, step, converged
+
+
+def fit_em(state_model, batches, tolerance=1e-3, max_steps=10000, prob_small=1e-3,
+           trace=None):
+    """fits state model to sequences with E-M
+
+    Parameters
+    ----------
+    state_model : dict
+        initial state model, e.g. as returned by init_state_model
+    batches : list
+        as returned by make_batches
+    tolerance : float
+        E-M stops when no transition or repeat probability changes
+        by more than tolerance. Default is 0.001.
+    max_steps : int
+        Maximum number of steps during E-M. Default is 10,000.
+    prob_small : float
+        transition probabilities less than prob_small are set to zero.
+        Default is 0.001.
+    trace : callable
+        called after each step of E-M, see em_steps, and once at the end
+        with the log-likelihood of the fit model. Default is None.
+
+    Returns
+    -------
+    state_model : dict
+        fit state model
+    log_likelihood : float
+        log-likelihood of sequences under the fit model
+    num_steps : int
+        number of E-M steps taken
+    """
+    state_model, _, num_steps, converged = em_steps(state_model, batches, max_steps,
+                                                    tolerance, prob_small, trace)
+    log_likelihood = e_step(state_model, batches)[-1]
+    if trace is not None:
+        trace({'event': 'fit_em', 'log_likelihood': float(log_likelihood),
+               'num_steps': num_steps, 'converged': converged})
+    return state_model, log_likelihood, num_steps
+
+
+def batch_log_likelihoods(tables, batch):
+    """log-likelihood of each sequence in one batch, from a forward pass only.
+    This is the same forward pass e_step uses for its log-likelihood."""
+    _, padded, lengths, layouts = batch
+    if is_run_batch(batch):
+        _, _, scales, end_scales = forward_runs(tables, padded, lengths, layouts)
+    else:
+        _, scales, end_scales, _ = forward(tables, padded, lengths, layouts)
+    return log_likelihoods(scales, end_scales)
+
+
+def sequence_log_likelihoods(state_model, batches, n_jobs=1, tables=None):
+    """log-likelihood of each sequence under a state model
+
+    Parameters
+    ----------
+    state_model : dict
+        as returned by init_state_model or fit_em
+    batches : list
+        as returned by make_batches or make_run_batches
+    n_jobs : int
+        Number of threads that batches are spread over. Default is 1.
+        If -1, use all CPUs. Threads share the tables computed from state_model,
+        and most of the time of each batch is spent in numpy, which releases the GIL.
+    tables : dict
+        as returned by kernel_tables. Default is None,
+        in which case they are computed from state_model.
+
+    Returns
+    -------
+    log_likelihoods : ndarray
+        one per sequence, in the order of the sequences passed to make_batches.
+        -inf for sequences that are impossible under the model.
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    # copied, since run tables depend on batches and are added in place
+    tables = dict(kernel_tables(state_model) if tables is None else tables)
+    run_batches = [batch for batch in batches if is_run_batch(batch)]
+    if run_batches:
+        run_tables(tables, max_run_lengths(run_batches, tables['repeat_probs'].shape[0]))
+    num_seqs = sum(batch[0].shape[0] for batch in batches)
+    seq_log_likelihoods = np.empty(num_seqs)
+    if n_jobs == 1 or len(batches) < 2:
+        results = map(partial(batch_log_likelihoods, tables), batches)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(partial(batch_log_likelihoods, tables), batches))
+    for batch, batch_lls in zip(batches, results):
+        seq_log_likelihoods[batch[0]] = batch_lls
+    return seq_log_likelihoods
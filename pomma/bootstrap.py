@@ -0,0 +1,323 @@
+# split-half bootstrap estimates of how much sequence statistics differ by chance.
+# Used as upper bounds on errors when comparing statistics of sequences
+# generated by a model to statistics of the actual data.
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+from .baum_welch import normalize_rows
+from .encoding import encode_strings, ngram_keys
+
+# feature counts in each worker process, set once by _init_worker
+# so that they are not sent again with every job
+_worker_counts = None
+
+
+def feature_counts(flat, offsets, num_labels, n_range=range(2, 8), m_compare=30):
+    """counts every feature used by the statistics module, separately for each sequence.
+
+    Because counts add up, the statistics of any subset of sequences can be
+    computed by summing rows of the matrix returned, without going back
+    to the sequences.
+
+    Parameters
+    ----------
+    flat, offsets : ndarray
+        encoded sequences, as returned by encoding.encode_strings
+        or encoding.flatten_sequences
+    num_labels : int
+        number of labels. Codes >= num_labels are not labels, and are skipped.
+    n_range : range
+        sizes of n-grams to count. Default is range(2, 8).
+    m_compare : int
+        number of steps to count the step probabilities of labels. Default is 30.
+
+    Returns
+    -------
+    counts : scipy.sparse.csr_matrix
+        num_sequences x num_features
+    features : dict
+        with following key, value pairs, where each slice is a block of columns
+        in counts:
+            ngram : dict
+                where each key is n and the value is a tuple
+                (slice, keys), where keys are the n-gram keys of each column,
+                as returned by encoding.ngram_keys
+            step : slice
+                (num_labels + 1) x m_compare columns, number of times each label
+                occurs at each step. The last label is the end of the sequence.
+            step_totals : slice
+                num_labels + 1 columns, number of times each label occurs at any step
+            repeat : slice
+                num_labels x (max_run + 1) columns, number of runs of each length
+                for each label, for runs of 2 or more
+            max_run : int
+                length of the longest run of any label
+    """
+    num_seqs = offsets.shape[0] - 1
+    lengths = np.diff(offsets)
+    seq_of = np.repeat(np.arange(num_seqs), lengths)
+    positions = np.arange(flat.shape[0]) - offsets[seq_of]
+    is_label = flat < num_labels
+
+    rows, cols = [], []
+    features = {'ngram': {}}
+    num_cols = 0
+    for n in n_range:
+        keys, starts = ngram_keys(flat, offsets, num_labels, n)
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        rows.append(seq_of[starts])
+        cols.append(inverse + num_cols)
+        features['ngram'][n] = (slice(num_cols, num_cols + unique_keys.shape[0]), unique_keys)
+        num_cols += unique_keys.shape[0]
+
+    # step counts; the end of each sequence counts as one more label
+    early = is_label & (positions < m_compare)
+    rows.append(seq_of[early])
+    cols.append(num_cols + flat[early].astype(np.int64) * m_compare + positions[early])
+    ends_early = np.flatnonzero(lengths < m_compare)
+    rows.append(ends_early)
+    cols.append(num_cols + num_labels * m_compare + lengths[ends_early])
+    features['step'] = slice(num_cols, num_cols + (num_labels + 1) * m_compare)
+    num_cols += (num_labels + 1) * m_compare
+
+    rows.append(seq_of[is_label])
+    cols.append(num_cols + flat[is_label].astype(np.int64))
+    rows.append(np.arange(num_seqs))
+    cols.append(np.full(num_seqs, num_cols + num_labels))
+    features['step_totals'] = slice(num_cols, num_cols + num_labels + 1)
+    num_cols += num_labels + 1
+
+    # runs of repeated labels, which never continue from one sequence into the next
+    run_starts = np.flatnonzero((positions == 0)
+                                | np.r_[True, flat[1:] != flat[:-1]])
+    run_lengths = np.diff(np.r_[run_starts, flat.shape[0]])
+    max_run = run_lengths.max(initial=1)
+    repeats = (run_lengths > 1) & is_label[run_starts]
+    rows.append(seq_of[run_starts[repeats]])
+    cols.append(num_cols + flat[run_starts[repeats]].astype(np.int64) * (max_run + 1)
+                + run_lengths[repeats])
+    features['repeat'] = slice(num_cols, num_cols + num_labels * (max_run + 1))
+    features['max_run'] = max_run
+    num_cols += num_labels * (max_run + 1)
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    # duplicate (row, col) pairs are summed
+    counts = sparse.csr_matrix((np.ones(rows.shape[0]), (rows, cols)),
+                               shape=(num_seqs, num_cols))
+    return counts, features
+
+
+def statistic_diffs(first, second, features, num_labels):
+    """differences between the statistics of two groups of sequences
+
+    Parameters
+    ----------
+    first, second : ndarray
+        num_pairs x num_features, summed rows of counts returned by feature_counts
+    features : dict
+        as returned by feature_counts
+    num_labels : int
+        number of labels
+
+    Returns
+    -------
+    diffs : dict
+        with following key, value pairs, each a vector with one element per pair:
+            ngram : dict
+                where each key is n and the value is the sum of absolute differences
+                between the n-gram distributions
+            step_prob : ndarray
+                sum of absolute differences between step probabilities,
+                over all labels and steps
+            repeat : dict
+                where each key is a label that repeats and the value is
+                the sum of absolute differences between distributions of
+                the number of repeats
+    """
+    num_pairs = first.shape[0]
+    diffs = {'ngram': {}, 'repeat': {}}
+    for n, (columns, _) in features['ngram'].items():
+        diffs['ngram'][n] = np.abs(normalize_rows(first[:, columns])
+                                   - normalize_rows(second[:, columns])).sum(axis=1)
+
+    step_shape = (num_pairs, num_labels + 1, -1)
+    step_probs = []
+    for counts in (first, second):
+        steps = counts[:, features['step']].reshape(step_shape)
+        totals = counts[:, features['step_totals']][:, :, np.newaxis]
+        step_probs.append(np.divide(steps, totals, out=np.zeros_like(steps),
+                                    where=totals > 0))
+    diffs['step_prob'] = np.abs(step_probs[0] - step_probs[1]).sum(axis=(1, 2))
+
+    repeat_shape = (num_pairs, num_labels, features['max_run'] + 1)
+    first_repeats = first[:, features['repeat']].reshape(repeat_shape)
+    second_repeats = second[:, features['repeat']].reshape(repeat_shape)
+    repeat_diffs = np.abs(normalize_rows(first_repeats)
+                          - normalize_rows(second_repeats)).sum(axis=2)
+    repeating = np.flatnonzero((first_repeats.sum(axis=(0, 2))
+                                + second_repeats.sum(axis=(0, 2))) > 0)
+    for label in repeating:
+        diffs['repeat'][label] = repeat_diffs[:, label]
+    return diffs
+
+
+def replicate_seed(seed, replicate):
+    """seed for one bootstrap replicate, so results do not depend on n_jobs"""
+    return np.random.SeedSequence(seed, spawn_key=(replicate,))
+
+
+def split_half_diffs(counts, features, num_labels, replicates, percent_split=0.5, seed=0):
+    """differences between statistics of the two halves of random splits of sequences
+
+    Each split is just a permutation of sequence indices. Summing the rows of counts
+    for each half of all splits at once is a single sparse matrix product.
+
+    Parameters
+    ----------
+    counts, features :
+        as returned by feature_counts
+    num_labels : int
+        number of labels
+    replicates : range
+        indices of replicates. Each gets its own seed, derived from seed.
+    percent_split : float
+        fraction of sequences in the first half. Default is 0.5.
+    seed : int
+        Default is 0.
+
+    Returns
+    -------
+    diffs : dict
+        as returned by statistic_diffs, with one element per replicate
+    """
+    num_seqs = counts.shape[0]
+    num_first = int(round(percent_split * num_seqs))
+    perms = np.stack([np.random.default_rng(replicate_seed(seed, replicate)).permutation(num_seqs)
+                      for replicate in replicates])
+    # row 2 * i selects the first half of split i, row 2 * i + 1 the second half
+    halves = 2 * np.arange(len(replicates))[:, np.newaxis] + (np.arange(num_seqs) >= num_first)
+    selector = sparse.csr_matrix((np.ones(perms.size), (halves.ravel(), perms.ravel())),
+                                 shape=(2 * len(replicates), num_seqs))
+    sums = (selector @ counts).toarray()
+    return statistic_diffs(sums[0::2], sums[1::2], features, num_labels)
+
+
+def _init_worker(counts, features, num_labels):
+    global _worker_counts
+    _worker_counts = (counts, features, num_labels)
+
+
+def _split_half_diffs_in_worker(replicates, percent_split, seed):
+    return split_half_diffs(*_worker_counts, replicates, percent_split, seed)
+
+
+def _concatenate_diffs(chunks):
+    return {
+        'ngram': {n: np.concatenate([chunk['ngram'][n] for chunk in chunks])
+                  for n in chunks[0]['ngram']},
+        'step_prob': np.concatenate([chunk['step_prob'] for chunk in chunks]),
+        'repeat': {label: np.concatenate([chunk['repeat'][label] for chunk in chunks])
+                   for label in chunks[0]['repeat']},
+    }
+
+
+def bootstrap_error_bounds_encoded(flat, offsets, num_labels, num_boot=500, percent_split=0.5,
+                                   p_value=0.95, m_compare=30, n_range=range(2, 8),
+                                   seed=None, n_jobs=1, chunk_size=50):
+    """upper bounds on differences between statistics that are expected by chance,
+    from encoded sequences
+
+    Sequences are split num_boot times into two groups, statistics are computed
+    for each group, and the differences between groups are measured.
+    The upper bound is the p_value quantile of those differences.
+
+    Parameters
+    ----------
+    flat, offsets : ndarray
+        encoded sequences, as returned by encoding.encode_strings
+        or encoding.flatten_sequences
+    num_labels : int
+        number of labels. Codes >= num_labels are not labels, and are skipped.
+    num_boot : int
+        Number of times sequences are split and statistic measured. Default is 500.
+    percent_split : float
+        Percent of samples to put in one group when splitting into two groups.
+        Default is 0.5.
+    p_value : float
+        quantile of differences used as upper bound. Default is 0.95.
+    m_compare : int
+        Number of steps to compare the step probabilities of the labels. Default is 30.
+    n_range : range
+        sizes of n-grams to compare. Default is range(2, 8).
+    seed : int
+        Default is None.
+    n_jobs : int
+        Number of worker processes. Default is 1. If -1, use all CPUs.
+    chunk_size : int
+        Number of replicates per job. Default is 50.
+
+    Returns
+    -------
+    error_bounds : dict
+        with the same keys as returned by statistic_diffs, where each value
+        is the upper bound instead of a vector of differences
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    counts, features = feature_counts(flat, offsets, num_labels, n_range, m_compare)
+    chunks = [range(start, min(start + chunk_size, num_boot))
+              for start in range(0, num_boot, chunk_size)]
+    if n_jobs == 1:
+        results = [split_half_diffs(counts, features, num_labels, chunk, percent_split, seed)
+                   for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_worker,
+                                 initargs=(counts, features, num_labels)) as executor:
+            results = list(executor.map(_split_half_diffs_in_worker, chunks,
+                                        [percent_split] * len(chunks),
+                                        [seed] * len(chunks)))
+    diffs = _concatenate_diffs(results)
+    return {
+        'ngram': {n: np.quantile(diff, p_value) for n, diff in diffs['ngram'].items()},
+        'step_prob': np.quantile(diffs['step_prob'], p_value),
+        'repeat': {label: np.quantile(diff, p_value) for label, diff in diffs['repeat'].items()},
+    }
+
+
+def bootstrap_error_bounds(sequences, labelset, startchar='S', endchar='E', **kwargs):
+    """upper bounds on differences between statistics that are expected by chance
+
+    Parameters
+    ----------
+    sequences : list
+        of str, labels from actual song
+    labelset : str
+        set of labels used, may include characters that indicate
+        start and end of song bouts.
+    startchar : str
+        character that indicates start of bout, default is 'S'.
+    endchar : str
+        character that indicates end of bout, default is 'E'.
+    **kwargs
+        passed to bootstrap_error_bounds_encoded
+
+    Returns
+    -------
+    error_bounds : dict
+        as returned by bootstrap_error_bounds_encoded,
+        with labels as keys of 'repeat' instead of codes
+    """
+    labels = sorted(set(labelset) - {startchar, endchar})
+    flat, offsets = encode_strings(sequences, labels, startchar, endchar)
+    error_bounds = bootstrap_error_bounds_encoded(flat, offsets, len(labels), **kwargs)
+    error_bounds['repeat'] = {labels[code]: bound
+                              for code, bound in error_bounds['repeat'].items()}
+    return error_bounds
@@ -0,0 +1,96 @@
+# compact on-disk format for corpora of song sequences.
+# A corpus is a directory with three files:
+#     flat.npy : every symbol of every sequence, mapped to int and concatenated
+#     offsets.npy : sequence i is flat[offsets[i]:offsets[i+1]]
+#     symbols.json : list of symbols, where symbols[i] is the symbol mapped to i
+# The arrays are opened as memory maps, so a corpus takes one byte
+# per syllable (for fewer than 256 symbols) and is never copied into
+# Python objects.
+
+import json
+import os
+from itertools import chain
+
+import numpy as np
+
+from .encoding import encode_strings, flatten_sequences, strip_bout_chars
+
+FLAT_FILENAME = 'flat.npy'
+OFFSETS_FILENAME = 'offsets.npy'
+SYMBOLS_FILENAME = 'symbols.json'
+
+
+def write_corpus(corpus_dir, sequences, startchar='S', endchar='E'):
+    """writes sequences to a corpus directory, see open_corpus
+
+    Parameters
+    ----------
+    corpus_dir : str
+        directory to write corpus to. Created if it does not exist.
+    sequences : list
+        either of str, e.g. as returned by datasets.load or notmat_utils.load_labels,
+        or of lists of symbols, as passed to POMMAfitter.fit.
+        Symbols are mapped to int in sorted order.
+    startchar : str
+        character that indicates start of bout, default is 'S'.
+        Removed from the start of each str before writing.
+    endchar : str
+        character that indicates end of bout, default is 'E'.
+        Removed from the end of each str before writing.
+
+    Returns
+    -------
+    corpus : dict
+        as returned by open_corpus
+    """
+    if all(isinstance(sequence, str) for sequence in sequences):
+        symbols = sorted(set(''.join(strip_bout_chars(sequence, startchar, endchar)
+                                     for sequence in sequences)))
+        flat, offsets = encode_strings(sequences, symbols, startchar, endchar)
+    else:
+        symbols = sorted(set(chain.from_iterable(sequences)))
+        symbols_int_map = {symbol: symbol_int for symbol_int, symbol in enumerate(symbols)}
+        flat, offsets = flatten_sequences([[symbols_int_map[symbol] for symbol in sequence]
+                                           for sequence in sequences])
+    flat = flat.astype(np.min_scalar_type(max(len(symbols) - 1, 0)))
+
+    os.makedirs(corpus_dir, exist_ok=True)
+    np.save(os.path.join(corpus_dir, FLAT_FILENAME), flat)
+    np.save(os.path.join(corpus_dir, OFFSETS_FILENAME), offsets)
+    with open(os.path.join(corpus_dir, SYMBOLS_FILENAME), 'w') as fp:
+        # cast numpy ints so they can be written as json
+        json.dump([symbol.item() if isinstance(symbol, np.generic) else symbol
+                   for symbol in symbols], fp)
+    return open_corpus(corpus_dir)
+
+
+def open_corpus(corpus_dir, mmap_mode='r'):
+    """opens a corpus written by write_corpus
+
+    Parameters
+    ----------
+    corpus_dir : str
+        directory corpus was written to
+    mmap_mode : str
+        passed to numpy.load. Default is 'r', in which case arrays are opened
+        read-only as memory maps, and only the parts used are read from disk.
+        If None, arrays are read into memory.
+
+    Returns
+    -------
+    corpus : dict
+        with following key, value pairs:
+            flat : numpy.memmap
+                symbols of all sequences, mapped to int and concatenated
+            offsets : numpy.memmap
+                of length number of sequences + 1
+            symbols : list
+                symbols, in the order they are mapped to int
+    """
+    with open(os.path.join(corpus_dir, SYMBOLS_FILENAME)) as fp:
+        symbols = json.load(fp)
+    return {
+        'flat': np.load(os.path.join(corpus_dir, FLAT_FILENAME), mmap_mode=mmap_mode),
+        'offsets': np.load(os.path.join(corpus_dir, OFFSETS_FILENAME), mmap_mode=mmap_mode),
+        'symbols': symbols,
+    }
@@ -1 +1 @@
-from .base import load
\ No newline at end of file
+from .base import load, load_corpus, corpus_dirs, default_corpus_dir
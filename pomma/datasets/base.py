@@ -1,4 +1,8 @@
 import os
+import shutil
+import tempfile
+
+from ..corpus import write_corpus, open_corpus
 
 bird_IDs_and_data_filenames = [
     ('bl26lb16', 'bl26lb16_sequences.txt'),
@@ -15,4 +19,84 @@ def load():
             sequences = data.readlines()
         data_dict[bird_ID] = sequences
 
-    return data_dict
\ No newline at end of file
+    return data_dict
+
+def default_corpus_dir():
+    """directory datasets are written to as corpora when no other is given:
+    $POMMA_CORPUS_DIR if it is set, otherwise pomma/corpora in the user's
+    cache directory ($XDG_CACHE_HOME, or ~/.cache). Not inside the package,
+    which is often installed where it cannot be written to."""
+    if os.environ.get('POMMA_CORPUS_DIR'):
+        return os.environ['POMMA_CORPUS_DIR']
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'),
+                                                                 '.cache')
+    return os.path.join(cache_dir, 'pomma', 'corpora')
+
+
+def _convert_dataset(bird_corpus_dir, data_filename):
+    """writes one dataset as a corpus. The corpus is written to a temporary
+    directory next to bird_corpus_dir and then renamed, so a crash never
+    leaves a half-written corpus where a complete one is expected."""
+    parent_dir = os.path.dirname(bird_corpus_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir,
+                               prefix='.' + os.path.basename(bird_corpus_dir) + '.')
+    try:
+        with open(data_filename, 'r') as data:
+            sequences = data.readlines()
+        write_corpus(tmp_dir, sequences)
+        os.replace(tmp_dir, bird_corpus_dir)
+    except OSError:
+        # another process may have converted the same dataset first
+        if not os.path.isdir(bird_corpus_dir):
+            raise
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+
+def corpus_dirs(corpus_dir=None):
+    """directories of datasets written as corpora (see pomma.corpus),
+    converting each dataset the first time
+
+    Parameters
+    ----------
+    corpus_dir : str
+        directory where corpora are written, one subdirectory per bird.
+        Default is None, in which case default_corpus_dir() is used.
+
+    Returns
+    -------
+    corpus_dirs : dict
+        where keys are bird IDs and values are corpus directories
+    """
+    module_path = os.path.dirname(__file__)
+    if corpus_dir is None:
+        corpus_dir = default_corpus_dir()
+    dirs = {}
+    for bird_ID, data_filename in bird_IDs_and_data_filenames:
+        bird_corpus_dir = os.path.join(corpus_dir, bird_ID)
+        if not os.path.isdir(bird_corpus_dir):
+            _convert_dataset(bird_corpus_dir, os.path.join(module_path, 'data', data_filename))
+        dirs[bird_ID] = bird_corpus_dir
+    return dirs
+
+
+def load_corpus(corpus_dir=None):
+    """loads datasets as corpora (see pomma.corpus), converting each
+    dataset the first time it is loaded
+
+    Parameters
+    ----------
+    corpus_dir : str
+        directory where corpora are written, one subdirectory per bird.
+        Default is None, in which case default_corpus_dir() is used.
+
+    Returns
+    -------
+    corpus_dict : dict
+        where keys are bird IDs and values are corpora,
+        as returned by corpus.open_corpus
+    """
+    return {bird_ID: open_corpus(bird_corpus_dir)
+            for bird_ID, bird_corpus_dir in corpus_dirs(corpus_dir).items()}
@@ -1,17 +1,276 @@
 import logging
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 
+import numpy as np
 
-def derive_initial_state_model(max_repeats,
+from .baum_welch import (init_state_model, make_run_batches, fit_em, em_steps,
+                         sequence_log_likelihoods, smooth_state_model, dense_trans)
+from .encoding import flatten_sequences, split_flat
+from .instrumentation import collect_events, peak_memory, with_context
+
+# batches of sequences in each worker process, made once by _init_worker
+# so that sequences are not sent again with every job
+_worker_batches = None
+
+
+def num_free_params(state_model):
+    """number of free parameters in a state model: every non-zero
+    transition probability, minus one per row because rows sum to one,
+    plus every non-zero repeat probability"""
+    trans = dense_trans(state_model['trans'])
+    num_rows = np.count_nonzero(trans.sum(axis=1))
+    return (np.count_nonzero(trans) - num_rows
+            + np.count_nonzero(state_model['repeat_probs']))
+
+
+def bic(state_model, log_likelihood, num_observations):
+    """Bayesian Information Criterion of a fit state model. Lower is better."""
+    return (-2 * log_likelihood
+            + num_free_params(state_model) * np.log(num_observations))
+
+
+def state_symbols_and_max_repeat_nums(max_repeats,
+                                      num_symbols,
+                                      num_extra_states,
+                                      start_symbol=1000,
+                                      end_symbol=1001):
+    """symbol and maximum number of repeats for each state of a model
+    with 1 + num_extra_states states per symbol"""
+    state_symbols = [start_symbol, end_symbol]
+    max_repeat_nums = [0, 0]
+    for symbol in range(0, num_symbols):
+        number_states = 1 + num_extra_states
+        state_symbols.extend([symbol] * number_states)
+        max_repeat_nums.extend([max_repeats[symbol]] * number_states)
+    return state_symbols, max_repeat_nums
+
+
+
+def job_seed(seed, num_extra_states, random_start):
+    """seed for one random start. Derived from the seed and the job itself,
+    so results do not depend on the number of workers or the order jobs finish in."""
+    return np.random.SeedSequence(seed, spawn_key=(num_extra_states, random_start))
+
+
+def fit_random_start(batches, state_symbols, max_repeat_nums, seed,
+                     tolerance, max_steps, prob_small, trace=None):
+    """fits one state model with E-M, starting from random probabilities"""
+    rng = np.random.default_rng(seed)
+    state_model = init_state_model(state_symbols, max_repeat_nums, rng)
+    return fit_em(state_model, batches, tolerance, max_steps, prob_small, trace)
+
+
+def resume_em(batches, state_model, num_steps, tolerance, prob_small, trace=None):
+    """runs at most num_steps more steps of E-M on one state model"""
+    return em_steps(state_model, batches, num_steps, tolerance, prob_small, trace)
+
+
+def _init_worker(flat, offsets, batch_size):
+    global _worker_batches
+    flat.flags.writeable = False
+    _worker_batches = make_run_batches(split_flat(flat, offsets), batch_size)
+
+
+def _call_in_worker(func, *args):
+    return func(_worker_batches, *args)
+
+
+@contextmanager
+def job_runner(seqs_mapped, batch_size=256, n_jobs=1):
+    """context manager that yields a function to run jobs on sequences.
+
+    The function yielded takes a function and a list of argument tuples,
+    calls func(batches, *args) for each tuple, and returns the results in order.
+    When n_jobs > 1, jobs run on a pool of worker processes.
+    Sequences are sent to each worker once, as one flat array, when the worker starts.
+
+    It can also take a trace and a list of dicts, one per job. Then func is
+    also passed a trace, and each event it reports is passed to trace with
+    the dict of its job added, e.g. the random start it belongs to.
+    In worker processes, events are kept until the job is done,
+    and then passed to trace in this process, in the order jobs were submitted.
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs == 1:
+        batches = make_run_batches(seqs_mapped, batch_size)
+
+        def run(func, args_list, trace=None, contexts=None):
+            if trace is None:
+                return [func(batches, *args) for args in args_list]
+            return [func(batches, *args, trace=with_context(trace, **context))
+                    for args, context in zip(args_list, contexts)]
+
+        yield run
+    else:
+        flat, offsets = flatten_sequences(seqs_mapped)
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_worker,
+                                 initargs=(flat, offsets, batch_size)) as executor:
+
+            def run(func, args_list, trace=None, contexts=None):
+                if trace is None:
+                    futures = [executor.submit(_call_in_worker, func, *args)
+                               for args in args_list]
+                    return [future.result() for future in futures]
+
+                futures = [executor.submit(_call_in_worker, collect_events, func, *args)
+                           for args in args_list]
+                results = []
+                for future, context in zip(futures, contexts):
+                    result, events = future.result()
+                    for event in events:
+                        trace(dict(context, **event))
+                    results.append(result)
+                return results
+
+            yield run
+
+
+def successive_halving(run, state_models, tolerance=1e-3, max_steps=10000,
+                       prob_small=1e-3, halving_steps=10, halving_eta=2, trace=None):
+    """fits several state models with E-M, dropping the ones that fall behind.
+
+    Every model gets halving_steps steps of E-M. Then only the 1 / halving_eta
+    models with the highest log-likelihood are kept, and the number of steps
+    per round is multiplied by halving_eta. This repeats until one model is left,
+    which is then fit until E-M converges or it reaches max_steps.
+
+    Parameters
+    ----------
+    run : callable
+        as yielded by job_runner
+    state_models : list
+        of state models to start from, e.g. one per random start
+    tolerance, max_steps, prob_small :
+        as for baum_welch.fit_em
+    halving_steps : int
+        number of E-M steps in the first round. Default is 10.
+    halving_eta : int
+        fraction of models dropped after each round is 1 - 1 / halving_eta.
+        Default is 2, i.e., half.
+    trace : callable
+        passed every E-M step of every model, with the random start
+        (the index of the model in state_models) and round it belongs to,
+        and a 'halving_round' event after each round. Default is None.
+
+    Returns
+    -------
+    best : dict
+        with keys 'state_model', 'log_likelihood', 'num_steps' and 'converged'
+        for the model that was kept
+    total_steps : int
+        total number of E-M steps taken over all models
+    """
+    alive = [{'state_model': state_model,
+              'log_likelihood': -np.inf,
+              'num_steps': 0,
+              'converged': False,
+              'random_start': random_start}
+             for random_start, state_model in enumerate(state_models)]
+    round_steps = halving_steps
+    total_steps = 0
+    halving_round = 0
+    while True:
+        if len(alive) == 1:
+            round_steps = max_steps
+        to_run = [candidate for candidate in alive
+                  if not candidate['converged'] and candidate['num_steps'] < max_steps]
+        results = run(resume_em,
+                      [(candidate['state_model'],
+                        min(round_steps, max_steps - candidate['num_steps']),
+                        tolerance, prob_small)
+                       for candidate in to_run],
+                      trace,
+                      [{'random_start': candidate['random_start'], 'round': halving_round}
+                       for candidate in to_run])
+        for candidate, (state_model, log_likelihood, steps_taken, converged) in zip(to_run, results):
+            candidate['state_model'] = state_model
+            candidate['log_likelihood'] = log_likelihood
+            candidate['num_steps'] += steps_taken
+            candidate['converged'] = converged
+            total_steps += steps_taken
+
+        # stable sort, so ties are broken by the order of the random starts
+        alive.sort(key=lambda candidate: -candidate['log_likelihood'])
+        if trace is not None:
+            trace({'event': 'halving_round',
+                   'round': halving_round,
+                   'round_steps': round_steps,
+                   'restarts_alive': len(alive),
+                   'restarts_converged': sum(candidate['converged'] for candidate in alive),
+                   'log_likelihoods': [candidate['log_likelihood'] for candidate in alive],
+                   'random_starts': [candidate['random_start'] for candidate in alive],
+                   'peak_memory': peak_memory()})
+        finished = all(candidate['converged'] or candidate['num_steps'] >= max_steps
+                       for candidate in alive)
+        if len(alive) == 1 or finished:
+            return alive[0], total_steps
+        alive = alive[:max(1, math.ceil(len(alive) / halving_eta))]
+        round_steps *= halving_eta
+        halving_round += 1
+
+
+def held_out_split(num_seqs, held_out_frac, seed):
+    """indices of sequences used for fitting, and of sequences held out"""
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(0,)))
+    order = rng.permutation(num_seqs)
+    num_held_out = min(max(1, round(held_out_frac * num_seqs)), num_seqs - 1)
+    return np.sort(order[num_held_out:]), np.sort(order[:num_held_out])
+
+
+def derive_initial_state_model(seqs_mapped,
+                               max_repeats,
                                num_symbols,
                                max_extra_states=15,
                                start_symbol=1000,
                                end_symbol=1001,
-                               num_random_starts=20
+                               num_random_starts=20,
+                               tolerance=1e-3,
+                               max_steps=10000,
+                               prob_small=1e-3,
+                               seed=None,
+                               batch_size=256,
+                               n_jobs=1,
+                               search='grid',
+                               halving_steps=10,
+                               halving_eta=2,
+                               held_out_frac=0.2,
+                               patience=1,
+                               trace=None,
                                ):
     """derives initial state model using Expectation-Maximization (E-M) algorithm
 
+    With search='grid', for each number of extra states the model is fit
+    num_random_starts times from random initial probabilities, and the fit
+    with the highest log-likelihood is kept. Of those, the model with the lowest
+    Bayesian Information Criterion is returned.
+
+    With search='halving', a fraction held_out_frac of sequences is held out,
+    and for each number of extra states the random starts are fit to the other
+    sequences with successive_halving, so hopeless random starts are dropped
+    after a few steps of E-M. Adding extra states stops once the held-out
+    log-likelihood has not improved for patience numbers of extra states in a row.
+    The model with the best held-out log-likelihood is then fit to all sequences,
+    starting from the probabilities it already has (see baum_welch.smooth_state_model).
+
+    Every random start for every number of extra states is an independent job.
+    When n_jobs > 1, jobs run on a pool of worker processes, see job_runner.
+
     Parameters
     ----------
+    seqs_mapped : list
+        of lists of int, sequences with symbols mapped to 0,1,2,...,n
+        where n is the number of symbols
+    max_repeats : dict
+        where each key is a mapped symbol and the corresponding value is
+        the maximum number of consecutive repeats of that symbol
+        found in any of the sequences
+    num_symbols : int
+        number of unique symbols, i.e., len(symbols)
     max_extra_states : int
         Maximum number of states to allow for each symbol.
         Default is 15.
@@ -19,27 +278,196 @@ def derive_initial_state_model(max_repeats,
         Numerical symbol for the start state. Default is 1000.
     end_symbol : int
         Numerical symbol for the end state. Default is 1001.
-    max_repeats : dict
-        where each key is a symbol and the corresponding value is
-        the maximum number of consecutive repeats of that symbol
-        found in any of the sequences
-    num_symbols : int
-        number of unique symbols, i.e., len(symbols)
     num_random_starts : int
-        Number of random starts to derive the best model. Default is 20.    
-    
+        Number of random starts to derive the best model. Default is 20.
+    tolerance : float
+        Tolerance for the change of transition probabilities during E-M.
+        Default is 0.001.
+    max_steps : int
+        Maximum number of steps during E-M. Default is 10,000.
+    prob_small : float
+        Any probability less than prob_small is disregarded when deriving model states.
+        Default is 0.001.
+    seed : int
+        seed for random initial probabilities. Each random start gets its own
+        seed derived from this one, so results are the same for any n_jobs.
+        Default is None.
+    batch_size : int
+        Number of sequences per batch in forward-backward. Default is 256.
+    n_jobs : int
+        Number of worker processes. Default is 1, which fits every random start
+        in this process. If -1, use all CPUs.
+    search : str
+        one of {'grid', 'halving'}. Default is 'grid'.
+        'halving' needs at least 2 sequences, so some can be held out.
+    halving_steps : int
+        Number of E-M steps in the first round of successive halving. Default is 10.
+    halving_eta : int
+        After each round of successive halving, only 1 / halving_eta of random starts
+        are kept. Default is 2.
+    held_out_frac : float
+        Fraction of sequences held out when search is 'halving'. Default is 0.2.
+    patience : int
+        Number of extra states in a row without improvement in held-out
+        log-likelihood before search stops. Default is 1.
+    trace : callable
+        called with a dict for each event during search, e.g. instrumentation.JsonlTrace,
+        or the append method of a list. Events are each step of E-M of each random
+        start (see baum_welch.em_steps), with the number of extra states and the
+        random start they belong to, and one 'extra_states' event for each
+        number of extra states tried. With search='halving', there is also
+        a 'halving_round' event after each round (see successive_halving),
+        and the steps of the final fit to all sequences have stage 'refit'.
+        Default is None, in which case nothing is reported.
+
     Returns
     -------
-
+    state_model : dict
+        as returned by baum_welch.fit_em, with additional keys
+        'log_likelihood', 'num_extra_states', and 'num_em_steps',
+        the total number of E-M steps taken to derive the model
     """
+    if search not in ('grid', 'halving'):
+        raise ValueError(f"search must be 'grid' or 'halving', not {search}")
+    if search == 'halving' and len(seqs_mapped) < 2:
+        raise ValueError("search='halving' holds out sequences, so it needs at least "
+                         f"2 sequences, not {len(seqs_mapped)}; use search='grid'")
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    if search == 'grid':
+        return _grid_search(seqs_mapped, max_repeats, num_symbols, max_extra_states,
+                            start_symbol, end_symbol, num_random_starts, tolerance,
+                            max_steps, prob_small, seed, batch_size, n_jobs, trace)
+    else:
+        return _halving_search(seqs_mapped, max_repeats, num_symbols, max_extra_states,
+                               start_symbol, end_symbol, num_random_starts, tolerance,
+                               max_steps, prob_small, seed, batch_size, n_jobs,
+                               halving_steps, halving_eta, held_out_frac, patience, trace)
+
+
+def _grid_search(seqs_mapped, max_repeats, num_symbols, max_extra_states,
+                 start_symbol, end_symbol, num_random_starts, tolerance,
+                 max_steps, prob_small, seed, batch_size, n_jobs, trace=None):
+    # every symbol is one observation, and so is the end of every sequence
+    num_observations = sum(len(seq) + 1 for seq in seqs_mapped)
+
+    jobs = {}
+    for num_extra_states in range(1, max_extra_states+1):
+        state_symbols, max_repeat_nums = state_symbols_and_max_repeat_nums(
+            max_repeats, num_symbols, num_extra_states, start_symbol, end_symbol
+        )
+        for random_start in range(num_random_starts):
+            jobs[num_extra_states, random_start] = (
+                state_symbols, max_repeat_nums,
+                job_seed(seed, num_extra_states, random_start),
+                tolerance, max_steps, prob_small
+            )
+
+    with job_runner(seqs_mapped, batch_size, n_jobs) as run:
+        contexts = [{'num_extra_states': num_extra_states, 'random_start': random_start}
+                    for num_extra_states, random_start in jobs]
+        results = dict(zip(jobs.keys(),
+                           run(fit_random_start, list(jobs.values()), trace, contexts)))
+
+    total_steps = sum(num_steps for _, _, num_steps in results.values())
+    best_model = None
+    best_bic = np.inf
     for num_extra_states in range(1, max_extra_states+1):
         logging.info(f'Trying model with {num_extra_states} extra_states.')
 
-        state_symbols = [start_symbol, end_symbol]
-        max_repeat_nums = [0, 0]
-        for symbol in range(0,num_symbols):
-            number_states = 1 + num_extra_states
-            state_symbols.extend([symbol] * number_states)
-            max_repeat_nums.extend([max_repeats[symbol]] * number_states)
-        
-        
\ No newline at end of file
+        best_this_num = None
+        for random_start in range(num_random_starts):
+            state_model, log_likelihood, num_steps = results[num_extra_states, random_start]
+            logging.debug(f'Random start {random_start}: log-likelihood {log_likelihood:.2f} '
+                          f'after {num_steps} steps.')
+            if best_this_num is None or log_likelihood > best_this_num['log_likelihood']:
+                best_this_num = dict(state_model,
+                                     log_likelihood=log_likelihood,
+                                     num_extra_states=num_extra_states)
+
+        this_bic = bic(best_this_num, best_this_num['log_likelihood'], num_observations)
+        logging.info(f'Best log-likelihood with {num_extra_states} extra_states: '
+                     f'{best_this_num["log_likelihood"]:.2f}, BIC: {this_bic:.2f}')
+        if trace is not None:
+            trace({'event': 'extra_states',
+                   'num_extra_states': num_extra_states,
+                   'log_likelihood': best_this_num['log_likelihood'],
+                   'bic': this_bic,
+                   'restarts_alive': num_random_starts,
+                   'num_em_steps': sum(results[num_extra_states, random_start][2]
+                                       for random_start in range(num_random_starts)),
+                   'peak_memory': peak_memory()})
+        if this_bic < best_bic:
+            best_model, best_bic = best_this_num, this_bic
+
+    best_model['num_em_steps'] = total_steps
+    return best_model
+
+
+def _halving_search(seqs_mapped, max_repeats, num_symbols, max_extra_states,
+                    start_symbol, end_symbol, num_random_starts, tolerance,
+                    max_steps, prob_small, seed, batch_size, n_jobs,
+                    halving_steps, halving_eta, held_out_frac, patience, trace=None):
+    fit_inds, held_out_inds = held_out_split(len(seqs_mapped), held_out_frac, seed)
+    held_out_batches = make_run_batches([seqs_mapped[ind] for ind in held_out_inds], batch_size)
+
+    total_steps = 0
+    best = None
+    best_held_out = -np.inf
+    num_without_improvement = 0
+    with job_runner([seqs_mapped[ind] for ind in fit_inds], batch_size, n_jobs) as run:
+        for num_extra_states in range(1, max_extra_states+1):
+            logging.info(f'Trying model with {num_extra_states} extra_states.')
+            state_symbols, max_repeat_nums = state_symbols_and_max_repeat_nums(
+                max_repeats, num_symbols, num_extra_states, start_symbol, end_symbol
+            )
+            state_models = [
+                init_state_model(state_symbols, max_repeat_nums,
+                                 np.random.default_rng(job_seed(seed, num_extra_states, random_start)))
+                for random_start in range(num_random_starts)
+            ]
+            kept, steps_this_num = successive_halving(
+                run, state_models, tolerance, max_steps, prob_small, halving_steps,
+                halving_eta, with_context(trace, num_extra_states=num_extra_states))
+            total_steps += steps_this_num
+
+            # smooth, so held-out sequences with transitions never seen
+            # in the sequences used for fitting are not impossible
+            held_out = sequence_log_likelihoods(smooth_state_model(kept['state_model']),
+                                                held_out_batches).sum()
+            if np.isnan(held_out):
+                held_out = -np.inf
+            logging.info(f'Kept model with {num_extra_states} extra_states after '
+                         f'{steps_this_num} E-M steps: held-out log-likelihood '
+                         f'{held_out:.2f}')
+            if trace is not None:
+                trace({'event': 'extra_states',
+                       'num_extra_states': num_extra_states,
+                       'log_likelihood': kept['log_likelihood'],
+                       'held_out_log_likelihood': held_out,
+                       'restarts_alive': 1,
+                       'num_em_steps': steps_this_num,
+                       'peak_memory': peak_memory()})
+            # if no model can score the held-out sequences, the first one is kept
+            if best is None or held_out > best_held_out:
+                best = dict(kept['state_model'], num_extra_states=num_extra_states)
+                best_held_out = held_out
+                num_without_improvement = 0
+            else:
+                num_without_improvement += 1
+                if num_without_improvement >= patience:
+                    break
+
+    # re-fit best model to all sequences, starting from the probabilities it has.
+    # Smooth first, in case held-out sequences need transitions it does not have
+    num_extra_states = best.pop('num_extra_states')
+    refit_trace = with_context(trace, stage='refit', num_extra_states=num_extra_states)
+    state_model, log_likelihood, num_steps = fit_em(smooth_state_model(best),
+                                                    make_run_batches(seqs_mapped, batch_size),
+                                                    tolerance, max_steps, prob_small,
+                                                    refit_trace)
+    return dict(state_model,
+                log_likelihood=log_likelihood,
+                num_extra_states=num_extra_states,
+                num_em_steps=total_steps + num_steps)
@@ -1,5 +1,9 @@
 from itertools import groupby, chain
 
+import numpy as np
+
+from .encoding import split_flat
+
 
 def determine_symbols_and_max_repeats(sequences):
     """determines unique set of symbols used in sequences, and maximum number
@@ -28,7 +32,7 @@ def determine_symbols_and_max_repeats(sequences):
                 mapping from symbols to integers 0,1,2,...,n
                 where n is the number of symbols
             seqs_mapped : list
-                lList of lists of int. Result of "converting" sequences
+                list of lists of int. Result of "converting" sequences
                 to ints by applying symbols_int_map to it.
             max_repeats : dict
                 where each key is a symbol and the corresponding value is
@@ -45,7 +49,8 @@ def determine_symbols_and_max_repeats(sequences):
     seqs_concat = list(chain.from_iterable(sequences))
     # map unique set of symbols to consecutive integers starting from 0
     symbols = set(seqs_concat)
-    symbols_int_map = dict(zip(symbols,
+    # sort so the mapping does not depend on the order of iterating over a set
+    symbols_int_map = dict(zip(sorted(symbols),
                                range(len(symbols))))
     # apply mapping to sequences
     seqs_mapped = []
@@ -72,8 +77,49 @@ def determine_symbols_and_max_repeats(sequences):
 
     symbols_and_max_repeats = {
         'symbols': symbols,
+        'symbols_int_map': symbols_int_map,
         'seqs_mapped': seqs_mapped,
         'max_repeats': max_repeats,
         'repeat_symbols': repeat_symbols
     }
     return symbols_and_max_repeats
+
+
+def determine_symbols_and_max_repeats_encoded(flat, offsets, symbols):
+    """like determine_symbols_and_max_repeats, for sequences that are
+    already mapped to int and stored as one flat array, e.g. a corpus
+    opened with corpus.open_corpus. Sequences are not copied:
+    seqs_mapped is a list of views into flat.
+
+    Parameters
+    ----------
+    flat, offsets : ndarray
+        sequence i is flat[offsets[i]:offsets[i+1]]
+    symbols : list
+        where symbols[i] is the symbol mapped to i.
+        Every symbol should occur at least once.
+
+    Returns
+    -------
+    symbols_and_max_repeats: dict
+        with the same key, value pairs as determine_symbols_and_max_repeats
+    """
+    # runs start where the symbol changes, and where each sequence starts
+    new_run = np.ones(flat.shape[0], dtype=bool)
+    new_run[1:] = flat[1:] != flat[:-1]
+    new_run[offsets[:-1][offsets[:-1] < flat.shape[0]]] = True
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_starts, flat.shape[0]))
+    max_runs = np.zeros(len(symbols), dtype=np.int64)
+    np.maximum.at(max_runs, flat[run_starts], run_lengths)
+
+    max_repeats = dict(zip(symbols, max_runs.tolist()))
+    return {
+        'symbols': set(symbols),
+        'symbols_int_map': dict(zip(symbols, range(len(symbols)))),
+        'seqs_mapped': split_flat(flat, offsets),
+        'max_repeats': max_repeats,
+        'repeat_symbols': [symbol
+                           for symbol, max_repeat in max_repeats.items()
+                           if max_repeat > 1]
+    }
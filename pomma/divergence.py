@@ -0,0 +1,174 @@
+# measures of how much the statistics of sequences generated by models differ
+# from the statistics of the actual data, used to choose between models.
+# Counts are kept in arrays keyed by integer n-gram keys, so the statistics
+# of real data are counted once and then compared with any number of models.
+
+import numpy as np
+
+from .baum_welch import normalize_rows
+from .encoding import ngram_keys
+from .statistics import step_counts, repeat_counts
+
+
+def count_table(flat, offsets, num_labels, n_range=range(2, 8), m_compare=30):
+    """counts every statistic compared by compare_tables, for a set of sequences
+
+    Parameters
+    ----------
+    flat, offsets : ndarray
+        encoded sequences, as returned by encoding.encode_strings
+        or encoding.flatten_sequences, or by sampling.sample_sequences
+    num_labels : int
+        number of labels. Codes >= num_labels are not labels, and are skipped.
+    n_range : range
+        sizes of n-grams to count. Default is range(2, 8).
+    m_compare : int
+        number of steps to count labels at. Default is 30.
+
+    Returns
+    -------
+    table : dict
+        with following key, value pairs:
+            num_labels : int
+            ngram : dict
+                where each key is n and the value is a tuple (keys, counts),
+                with sorted keys as returned by encoding.ngram_keys
+            step : ndarray
+                (num_labels + 1) x m_compare, number of times each label occurs
+                at each step. The last row is the end of the sequence,
+                as in bootstrap.feature_counts.
+            step_totals : ndarray
+                number of times each label occurs at any step,
+                and the number of sequences in the last element
+            repeat : ndarray
+                num_labels x (length of longest run + 1), as returned by
+                statistics.repeat_counts
+    """
+    table = {'num_labels': num_labels, 'ngram': {}}
+    for n in n_range:
+        keys, _ = ngram_keys(flat, offsets, num_labels, n)
+        table['ngram'][n] = np.unique(keys, return_counts=True)
+
+    lengths = np.diff(offsets)
+    ends = np.bincount(lengths[lengths < m_compare], minlength=m_compare)
+    table['step'] = np.vstack((step_counts(flat, offsets, num_labels, m_compare), ends))
+    is_label = flat < num_labels
+    table['step_totals'] = np.append(
+        np.bincount(flat[is_label].astype(np.int64), minlength=num_labels), lengths.shape[0])
+    table['repeat'] = repeat_counts(flat, offsets, num_labels)
+    return table
+
+
+def align_counts(keys, counts):
+    """puts counts of several tables into one matrix with a column for each key
+    found in any table, so they can be compared with array operations
+
+    Parameters
+    ----------
+    keys, counts : list
+        of ndarray, keys and counts of each table
+
+    Returns
+    -------
+    all_keys : ndarray
+        sorted keys found in any table
+    aligned : ndarray
+        number of tables x number of keys, zero where a table does not have a key
+    """
+    all_keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    rows = np.repeat(np.arange(len(keys)), [table_keys.shape[0] for table_keys in keys])
+    aligned = np.bincount(rows * all_keys.shape[0] + inverse, weights=np.concatenate(counts),
+                          minlength=len(keys) * all_keys.shape[0])
+    return all_keys, aligned.reshape(len(keys), all_keys.shape[0])
+
+
+def _kl_divergence(p, q):
+    """KL divergence of each row of q from p, in nats, where p may be broadcast"""
+    terms = np.multiply(p, np.log(np.divide(p, q, out=np.ones(np.broadcast(p, q).shape),
+                                            where=p > 0)))
+    return terms.sum(axis=-1)
+
+
+def compare_tables(reference, tables, smoothing=0.5):
+    """compares the statistics of many sets of sequences, e.g. generated by
+    different models, with the statistics of one reference set, e.g. the actual data
+
+    Parameters
+    ----------
+    reference : dict
+        as returned by count_table, e.g. for the actual data.
+        Can be counted once and passed every time models are compared.
+    tables : list
+        of dicts, as returned by count_table with the same num_labels,
+        n_range and m_compare as reference, e.g. one for each model
+    smoothing : float
+        pseudo-count added to every n-gram found in the reference or any
+        of the tables, before computing KL divergences, so that n-grams that
+        a model never generates do not make the divergence infinite.
+        Default is 0.5.
+
+    Returns
+    -------
+    diffs : dict
+        with following key, value pairs, each a vector with one element per table.
+        The first three are the same differences as bootstrap.statistic_diffs,
+        so they can be compared with error bounds from bootstrap_error_bounds.
+            ngram : dict
+                where each key is n and the value is the sum of absolute differences
+                between the n-gram distributions
+            step_prob : ndarray
+                sum of absolute differences between step probabilities,
+                over all labels and steps
+            repeat : dict
+                where each key is a label that repeats in the reference or any table,
+                and the value is the sum of absolute differences between distributions
+                of the number of repeats
+            ngram_kl : dict
+                where each key is n and the value is the KL divergence,
+                in nats, of the smoothed n-gram distribution of each table
+                from the smoothed distribution of the reference
+            ngram_js : dict
+                where each key is n and the value is the Jensen-Shannon divergence,
+                in nats, between the n-gram distributions
+    """
+    num_labels = reference['num_labels']
+    for table in tables:
+        if (table['num_labels'] != num_labels
+                or table['ngram'].keys() != reference['ngram'].keys()
+                or table['step'].shape != reference['step'].shape):
+            raise ValueError('tables must be counted with the same num_labels, '
+                             'n_range and m_compare as reference')
+
+    diffs = {'ngram': {}, 'ngram_kl': {}, 'ngram_js': {}, 'repeat': {}}
+    for n, (ref_keys, ref_counts) in reference['ngram'].items():
+        _, aligned = align_counts([ref_keys] + [table['ngram'][n][0] for table in tables],
+                                  [ref_counts] + [table['ngram'][n][1] for table in tables])
+        probs = normalize_rows(aligned)
+        diffs['ngram'][n] = np.abs(probs[1:] - probs[:1]).sum(axis=1)
+        smoothed = normalize_rows(aligned + smoothing)
+        diffs['ngram_kl'][n] = _kl_divergence(smoothed[:1], smoothed[1:])
+        mixture = (probs[:1] + probs[1:]) / 2
+        diffs['ngram_js'][n] = (_kl_divergence(probs[:1], mixture)
+                                + _kl_divergence(probs[1:], mixture)) / 2
+
+    step_probs = [table['step'] / np.maximum(table['step_totals'], 1)[:, np.newaxis]
+                  for table in [reference] + tables]
+    diffs['step_prob'] = np.abs(np.stack(step_probs[1:]) - step_probs[0]).sum(axis=(1, 2))
+
+    max_run = max(table['repeat'].shape[1] for table in [reference] + tables)
+    repeats = np.zeros((len(tables) + 1, num_labels, max_run))
+    for ind, table in enumerate([reference] + tables):
+        # runs of 1 are not repeats
+        repeats[ind, :, 2:table['repeat'].shape[1]] = table['repeat'][:, 2:]
+    repeat_diffs = np.abs(normalize_rows(repeats[1:]) - normalize_rows(repeats[:1])).sum(axis=2)
+    for label in np.flatnonzero(repeats.sum(axis=(0, 2)) > 0):
+        diffs['repeat'][label] = repeat_diffs[:, label]
+    return diffs
+
+
+def select(diffs, ind):
+    """differences for one of the tables compared by compare_tables,
+    with the same nested keys and a float for each value"""
+    return {key: ({sub_key: float(diff[ind]) for sub_key, diff in value.items()}
+                  if isinstance(value, dict) else float(value[ind]))
+            for key, value in diffs.items()}
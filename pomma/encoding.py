@@ -0,0 +1,143 @@
+# functions to store sequences of symbols as one flat array of int,
+# instead of one Python object per sequence and per symbol
+
+import numpy as np
+
+
+def flatten_sequences(sequences, dtype=None):
+    """concatenates sequences of int into one flat array
+
+    Parameters
+    ----------
+    sequences : list
+        of lists (or 1-D arrays) of int, e.g. seqs_mapped
+        as returned by determine_symbols_and_max_repeats.
+    dtype : numpy.dtype
+        of flat array. Default is None, in which case the smallest
+        unsigned integer type that can hold every symbol is used.
+
+    Returns
+    -------
+    flat : ndarray
+        all sequences, concatenated
+    offsets : ndarray
+        of length len(sequences) + 1. Sequence i is flat[offsets[i]:offsets[i+1]].
+    """
+    lengths = np.asarray([len(seq) for seq in sequences], dtype=np.int64)
+    offsets = np.zeros(lengths.shape[0] + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if offsets[-1]:
+        flat = np.concatenate([np.asarray(seq, dtype=np.int64) for seq in sequences])
+    else:
+        flat = np.zeros(0, dtype=np.intp)
+    if dtype is None:
+        dtype = np.min_scalar_type(flat.max()) if flat.size else np.uint8
+    return flat.astype(dtype, copy=False), offsets
+
+
+def split_flat(flat, offsets):
+    """splits flat array back into one array per sequence.
+    The arrays returned are views into flat, not copies."""
+    return [flat[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+
+
+def strip_bout_chars(sequence, startchar='S', endchar='E'):
+    """removes newline, and characters that indicate start and end of bout, from a str"""
+    sequence = sequence.rstrip('\n')
+    if startchar and sequence.startswith(startchar):
+        sequence = sequence[len(startchar):]
+    if endchar and sequence.endswith(endchar):
+        sequence = sequence[:-len(endchar)]
+    return sequence
+
+
+def encode_strings(sequences, labels, startchar='S', endchar='E'):
+    """encodes sequences of characters as one flat array of int
+
+    Parameters
+    ----------
+    sequences : list
+        of str, e.g. labels from actual song or generated by model
+    labels : str
+        labels to encode. The label at index i is encoded as i.
+        Any other character is encoded as len(labels).
+    startchar : str
+        character that indicates start of bout, default is 'S'.
+        Removed from the start of each sequence before encoding.
+    endchar : str
+        character that indicates end of bout, default is 'E'.
+        Removed from the end of each sequence before encoding.
+
+    Returns
+    -------
+    flat : ndarray
+        all encoded sequences, concatenated
+    offsets : ndarray
+        of length len(sequences) + 1. Sequence i is flat[offsets[i]:offsets[i+1]].
+    """
+    trimmed = [strip_bout_chars(sequence, startchar, endchar) for sequence in sequences]
+    lengths = np.asarray([len(sequence) for sequence in trimmed], dtype=np.int64)
+    offsets = np.zeros(lengths.shape[0] + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    # encode every character at once, with a lookup table from code point to label index
+    chars = np.frombuffer(''.join(trimmed).encode('utf-32-le'), dtype=np.uint32)
+    label_points = [ord(label) for label in labels]
+    lookup = np.full(max([chars.max(initial=0)] + label_points) + 1, len(labels),
+                     dtype=np.min_scalar_type(len(labels)))
+    lookup[label_points] = np.arange(len(labels))
+    return lookup[chars], offsets
+
+
+def ngram_keys(flat, offsets, num_labels, n):
+    """integer key for every n-gram in encoded sequences.
+
+    The key of an n-gram is its labels read as a number in base num_labels,
+    e.g. with 3 labels the key of (2, 0, 1) is 2 * 9 + 0 * 3 + 1.
+    Because every key for a given n has the same number of "digits",
+    sorting keys sorts n-grams in the same order as sorting them as strings,
+    when labels are encoded in sorted order.
+
+    Parameters
+    ----------
+    flat, offsets : ndarray
+        as returned by encode_strings or flatten_sequences
+    num_labels : int
+        number of labels. Codes >= num_labels are not labels,
+        and n-grams that contain them are skipped.
+    n : int
+        length of n-grams
+
+    Returns
+    -------
+    keys : ndarray
+        of int64, key of each n-gram
+    starts : ndarray
+        index in flat where each n-gram starts
+    """
+    if num_labels ** n >= 2 ** 63:
+        raise ValueError(f'{n}-grams of {num_labels} labels do not fit in 64-bit keys')
+    num_windows = flat.shape[0] - n + 1
+    if num_windows <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.intp)
+    lengths = np.diff(offsets)
+    seq_ends = np.repeat(offsets[1:], lengths)[:num_windows]
+    # count non-labels up to each index, to find windows that contain any
+    not_label = np.zeros(flat.shape[0] + 1, dtype=np.int64)
+    np.cumsum(flat >= num_labels, out=not_label[1:])
+    valid = ((np.arange(num_windows) + n <= seq_ends)
+             & (not_label[n:] == not_label[:num_windows]))
+    starts = np.flatnonzero(valid)
+    keys = np.zeros(starts.shape[0], dtype=np.int64)
+    for j in range(n):
+        keys *= num_labels
+        keys += flat[starts + j]
+    return keys, starts
+
+
+def decode_ngram_keys(keys, n, labels):
+    """converts keys returned by ngram_keys back into strings of labels"""
+    labels = np.asarray(list(labels))
+    digits = np.asarray(keys, dtype=np.int64)[:, np.newaxis] // (
+        len(labels) ** np.arange(n - 1, -1, -1, dtype=np.int64)) % len(labels)
+    return [''.join(row) for row in labels[digits]]
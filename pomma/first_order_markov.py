@@ -1,60 +1,183 @@
 # code to create first-order Markov models of song syntax and generate output from models
 
-from collections import defaultdict
-
 import numpy as np
+from scipy import sparse
 
+from .encoding import encode_strings
 
-def make_trans_mat(labels, labelset, endchar='E'):
-    """compute first-order Markov transition matrix from labels (as returned by load_labels)
+
+def encode_labels(labels, labelset):
+    """encodes labels as integers for make_trans_mat, so that a corpus
+    can be encoded once and used for many transition matrices.
+    Unlike encoding.encode_strings with default arguments, the characters
+    that indicate start and end of bouts are kept, since make_trans_mat
+    counts transitions from start and to end.
 
     Parameters
     ----------
     labels : list
         of str
-    labelset : set
+    labelset : str
+        labels to encode. The label at index i is encoded as i.
+        Any other character is encoded as len(labelset).
+
+    Returns
+    -------
+    flat, offsets : ndarray
+        as returned by encoding.encode_strings
+    """
+    return encode_strings(labels, labelset, startchar='', endchar='')
+
+
+def make_trans_mat(labels, labelset, endchar='E', return_sparse=False, encoded=None):
+    """compute first-order Markov transition matrix from labels (as returned by load_labels)
+
+    Parameters
+    ----------
+    labels : list
+        of str. Ignored if encoded is provided.
+    labelset : str
         only compute transitions between labels in this set, ignore any other character in labels
     endchar : str
         character to denote end of a string, default is E.
         Used to discard this row since E by definition never transitions to anything else.
+    return_sparse : bool
+        if True, return a scipy.sparse.csr_matrix, for large label sets
+        where most transitions never occur. Default is False.
+    encoded : tuple
+        (flat, offsets), labels already encoded with encode_labels(labels, labelset).
+        Default is None, in which case labels are encoded.
 
     Returns
     -------
     trans_mat : ndarray
         Matrix of m rows of i elements x n rows of j elements,
         where each element i,j is the probability
-        of transitioning from labelset[i] to labelset[j]
+        of transitioning from labelset[i] to labelset[j].
+        Rows of labels that are never followed by another label are all zeros.
     """
-
     size = len(labelset)
-
-    trans = defaultdict(float)
-    for label in labels:
-        for ind in range(len(label) - 1):
-            if label[ind] in labelset and label[ind + 1] in labelset:
-                trans[label[ind], label[ind + 1]] += 1
-
-    trans_mat = np.zeros((size, size))
-    for i, i_char in enumerate(labelset):
-        for j, j_char in enumerate(labelset):
-            if (i_char, j_char) in trans:
-                trans_mat[i, j] = trans[(i_char, j_char)]
-
     # remove end row since there's no transitions from end to anything else
     end_row_ind = labelset.index(endchar)
-    trans_mat = np.delete(trans_mat, (end_row_ind,), 0)
-
-    # divide each row by sum of row.
-    # add np.newaxis to get broadcasting to work.
-    trans_mat = trans_mat / trans_mat.sum(axis=1)[:, np.newaxis]
 
-    return trans_mat
+    if encoded is None:
+        encoded = encode_labels(labels, labelset)
+    flat, offsets = encoded
+    flat = flat.astype(np.int64)
+    # pairs of consecutive characters, not crossing from one sequence to the next,
+    # where both characters are in labelset
+    is_pair = (flat[:-1] < size) & (flat[1:] < size)
+    boundaries = offsets[1:-1]
+    is_pair[boundaries[(boundaries > 0) & (boundaries < flat.shape[0])] - 1] = False
+    rows, cols = flat[:-1][is_pair], flat[1:][is_pair]
+    not_end = rows != end_row_ind
+    rows, cols = rows[not_end], cols[not_end]
+    rows -= rows > end_row_ind
+
+    # divide each row by sum of row, leaving rows that never occur as zeros
+    totals = np.bincount(rows, minlength=size - 1)
+    inv_totals = np.divide(1., totals, out=np.zeros(totals.shape), where=totals > 0)
+    if return_sparse:
+        # duplicate (row, col) pairs are summed when converting to csr
+        return sparse.coo_matrix((inv_totals[rows], (rows, cols)),
+                                 shape=(size - 1, size)).tocsr()
+    counts = np.bincount(rows * size + cols, minlength=(size - 1) * size)
+    return counts.reshape(size - 1, size) * inv_totals[:, np.newaxis]
 
 
 def generate_sequences(trans_mat, labelset, num=10000, startchar='S', endchar='E',
-                       model='Markov'):
+                       model='Markov', seed=None, reference=False):
     """uses transition matrix to generate sequences
+
+    Parameters
+    ----------
+    trans_mat : ndarray or scipy.sparse matrix
+        transition matrix, as returned by make_trans_mat.
+        A row that is all zeros, for a label never followed by another label
+        or the end of a bout, is treated as going to endchar.
+    labelset : str
+        labels used to make trans_mat, including startchar and endchar
+    num : int
+        number of sequences to generate. Default is 10000.
+    startchar : str
+        character that indicates start of bout, default is 'S'.
+    endchar : str
+        character that indicates end of bout, default is 'E'.
+    model : str
+        type of model. Only 'Markov' is implemented.
+    seed : int
+        seed for random number generator. Default is None.
+    reference : bool
+        if True, generate one sequence at a time, one label at a time,
+        reproducing the reference code by Jin and Kozhevnikov.
+        Default is False, in which case all sequences are generated at once.
+
+    Returns
+    -------
+    sequences : list
+        of str, without startchar and endchar
     """
+    if sparse.issparse(trans_mat):
+        trans_mat = trans_mat.toarray()
+    zero_rows = ~np.any(trans_mat > 0, axis=1)
+    if np.any(zero_rows):
+        trans_mat = np.array(trans_mat, dtype=float)
+        trans_mat[zero_rows, labelset.index(endchar)] = 1.
+    if reference:
+        return _generate_sequences_reference(trans_mat, labelset, num, startchar,
+                                             endchar, model, seed)
+
+    sequences = []
+    if model == 'Markov':
+        endchar_ind = labelset.index(endchar)
+        # trans_mat has no row for end state
+        row_of_label = np.arange(len(labelset))
+        row_of_label[endchar_ind + 1:] -= 1
+
+        # cumulative probabilities of each row, shifted by 2 * row so that
+        # one call to searchsorted finds next label for every row at once.
+        # Dividing by last element makes it exactly 1, so random numbers always fall in the row
+        cdfs = np.cumsum(trans_mat, axis=1)
+        cdfs = np.divide(cdfs, cdfs[:, -1:], out=np.zeros_like(cdfs), where=cdfs[:, -1:] > 0)
+        row_shifts = 2 * np.arange(cdfs.shape[0])
+        cdfs = (cdfs + row_shifts[:, np.newaxis]).ravel()
+        num_cols = trans_mat.shape[1]
+
+        rng = np.random.default_rng(seed)
+        dtype = np.min_scalar_type(len(labelset))
+        generated = np.zeros((num, 64), dtype=dtype)
+        lengths = np.zeros(num, dtype=np.int64)
+        live = np.arange(num)
+        rows = np.full(num, row_of_label[labelset.index(startchar)])
+        step = 0
+        while live.shape[0]:
+            r = rng.random(live.shape[0])
+            label_inds = (np.searchsorted(cdfs, r + row_shifts[rows], side='right')
+                          - rows * num_cols)
+            ended = label_inds == endchar_ind
+            lengths[live[ended]] = step
+            live, rows, label_inds = live[~ended], rows[~ended], label_inds[~ended]
+            if step == generated.shape[1]:
+                generated = np.concatenate((generated, np.zeros_like(generated)), axis=1)
+            generated[live, step] = label_inds
+            rows = row_of_label[label_inds]
+            step += 1
+
+        # decode all sequences at once, as one string
+        label_points = np.asarray([ord(label) for label in labelset], dtype=np.uint32)
+        keep = np.arange(generated.shape[1]) < lengths[:, np.newaxis]
+        concat = label_points[generated[keep]].tobytes().decode('utf-32-le')
+        offsets = np.concatenate(([0], np.cumsum(lengths))).tolist()
+        sequences = [concat[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+
+    return sequences
+
+
+def _generate_sequences_reference(trans_mat, labelset, num=10000, startchar='S',
+                                  endchar='E', model='Markov', seed=None):
+    """generates sequences one label at a time, as in reference code.
+    If seed is None, uses the global numpy random state."""
+    random_state = np.random if seed is None else np.random.RandomState(seed)
 
     # get index of end state so we know when we're in it
     endchar_ind = labelset.index(endchar)
@@ -82,7 +205,7 @@ def generate_sequences(trans_mat, labelset, num=10000, startchar='S', endchar='E
             while True:
                 # could just use np.random.choice to pick next state
                 # but trying to reproduce Jin Khozvenikov as closely as possible
-                r = np.random.uniform()
+                r = random_state.uniform()
                 probs = trans_mat_list[label_ind]['probs']
                 state_ind = np.where(r < probs)[0][0]
                 states = trans_mat_list[label_ind]['states']
@@ -0,0 +1,106 @@
+# hooks to follow fitting as it happens: E-M and model search report events,
+# e.g. one per E-M step, to a trace, which is any callable that takes a dict.
+# When no trace is passed, nothing is reported, and fitting costs the same
+# as without instrumentation.
+
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+from .serialization import to_json_value
+
+
+def peak_memory():
+    """peak resident memory of this process in bytes, or None where it is not available"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def with_context(trace, **context):
+    """trace that adds context to every event before passing it to trace,
+    e.g. the number of extra states and random start an E-M step belongs to.
+    If trace is None, returns None, so there is still nothing to report to."""
+    if trace is None:
+        return None
+
+    def traced(event):
+        trace(dict(context, **event))
+
+    return traced
+
+
+def collect_events(batches, func, *args):
+    """calls func(batches, *args) with a trace that keeps every event,
+    so that jobs run by derive_initial_state_model.job_runner in worker
+    processes can send events back with their results
+
+    Returns
+    -------
+    result
+        returned by func
+    events : list
+        of dicts, events func reported, in order
+    """
+    events = []
+    return func(batches, *args, trace=events.append), events
+
+
+class JsonlTrace:
+    """trace that writes each event as one line of JSON to a file,
+    with the time it was written. Lines are flushed as they are written,
+    so a trace of a long fit can be followed while it runs.
+
+    Parameters
+    ----------
+    filename : str
+        path to file
+    mode : str
+        'w' to start a new file, or 'a' to append to an existing one. Default is 'w'.
+
+    Examples
+    --------
+    >>> with JsonlTrace('fit_trace.jsonl') as trace:
+    ...     pf = POMMAfitter(trace=trace)
+    ...     pf.fit(sequences)
+    """
+
+    def __init__(self, filename, mode='w'):
+        self.filename = filename
+        self._file = open(filename, mode)
+
+    def __call__(self, event):
+        event = dict(event, time=time.time())
+        self._file.write(json.dumps(to_json_value(event)) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def em_step_event(step, log_likelihood, change, tolerance, e_step_time, m_step_time):
+    """event reported by baum_welch.em_steps after each step of E-M"""
+    return {'event': 'em_step',
+            'step': step,
+            'log_likelihood': float(log_likelihood),
+            'param_change': float(change),
+            'tolerance': tolerance,
+            'e_step_time': e_step_time,
+            'm_step_time': m_step_time,
+            'peak_memory': peak_memory(),
+            'pid': os.getpid()}
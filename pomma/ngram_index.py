@@ -0,0 +1,186 @@
+# index of every n-gram in a corpus up to some maximum n, built once
+# and then queried for counts of any n without scanning sequences again
+
+import numpy as np
+
+from .encoding import encode_strings, decode_ngram_keys
+
+
+class NgramIndex:
+    """index of n-grams in encoded sequences, up to length max_n.
+
+    Works like a suffix array cut off at depth max_n: every position in the
+    corpus gets the key of the (up to) max_n labels that start there, and keys
+    are sorted once. A suffix is cut short at the end of its sequence or at a
+    character that is not a label. Since the key of an n-gram starting at a
+    position is a prefix of the key of the longer n-gram, for every n <= max_n
+    the n-grams are already sorted, so counting them is one pass over sorted
+    keys, and counting a single n-gram is a binary search.
+
+    Keys use digit 0 for "cut short" and digit i + 1 for label i,
+    in base num_labels + 1.
+
+    Parameters
+    ----------
+    flat, offsets : ndarray
+        encoded sequences, as returned by encoding.encode_strings
+        or encoding.flatten_sequences
+    labels : str
+        labels used to encode sequences, where the label at index i is encoded as i.
+        Codes >= len(labels) are not labels, and no n-gram contains them.
+    max_n : int
+        length of longest n-gram that can be counted. Default is 7.
+
+    Examples
+    --------
+    >>> index = NgramIndex.from_strings(sequences, 'abcdefghijk', max_n=7)
+    >>> index.count('abc')
+    >>> index.top_k(n=3, k=10)
+    >>> index.save('bl26lb16_ngrams.npz')
+    """
+
+    def __init__(self, flat, offsets, labels, max_n=7):
+        self.labels = ''.join(labels)
+        self.max_n = max_n
+        self.base = len(self.labels) + 1
+        if self.base ** max_n >= 2 ** 63:
+            raise ValueError(f'{max_n}-grams of {len(self.labels)} labels '
+                             'do not fit in 64-bit keys')
+        self.sorted_keys = _sorted_prefix_keys(flat, offsets, len(self.labels), max_n, self.base)
+        self._counts_cache = {}
+
+    @classmethod
+    def from_strings(cls, sequences, labels, max_n=7, startchar='S', endchar='E'):
+        """builds index from sequences of characters, see encoding.encode_strings"""
+        flat, offsets = encode_strings(sequences, labels, startchar, endchar)
+        return cls(flat, offsets, labels, max_n)
+
+    @classmethod
+    def from_corpus(cls, corpus, max_n=7):
+        """builds index from a corpus opened with corpus.open_corpus,
+        where every symbol is a single character"""
+        return cls(corpus['flat'], corpus['offsets'], ''.join(corpus['symbols']), max_n)
+
+    def _check_n(self, n):
+        if not 1 <= n <= self.max_n:
+            raise ValueError(f'n must be between 1 and max_n={self.max_n}, got {n}')
+
+    def counts(self, n):
+        """counts of every n-gram that occurs
+
+        Parameters
+        ----------
+        n : int
+            length of n-grams, at most max_n
+
+        Returns
+        -------
+        keys : ndarray
+            sorted keys of n-grams, in base len(labels) as returned by encoding.ngram_keys
+        counts : ndarray
+            number of times each n-gram occurs
+        """
+        self._check_n(n)
+        if n not in self._counts_cache:
+            prefixes = self.sorted_keys // self.base ** (self.max_n - n)
+            # last digit is 0 when n-gram starting at position is shorter than n
+            prefixes = prefixes[prefixes % self.base != 0]
+            if prefixes.shape[0]:
+                firsts = np.flatnonzero(np.diff(prefixes)) + 1
+                firsts = np.concatenate(([0], firsts))
+                counts = np.diff(np.append(firsts, prefixes.shape[0]))
+                keys = self._to_label_keys(prefixes[firsts], n)
+            else:
+                keys = np.zeros(0, dtype=np.int64)
+                counts = np.zeros(0, dtype=np.int64)
+            self._counts_cache[n] = (keys, counts)
+        return self._counts_cache[n]
+
+    def _to_label_keys(self, prefixes, n):
+        """converts keys in base num_labels + 1 to keys in base num_labels"""
+        keys = np.zeros(prefixes.shape[0], dtype=np.int64)
+        for power in range(n - 1, -1, -1):
+            keys *= self.base - 1
+            keys += prefixes // self.base ** power % self.base - 1
+        return keys
+
+    def count_many(self, ngrams):
+        """counts of n-grams given as strings, all of the same length.
+        N-grams that contain characters not in labels have count 0.
+
+        Returns
+        -------
+        counts : ndarray
+            of int64, one count per n-gram
+        """
+        ngrams = list(ngrams)
+        if not ngrams:
+            return np.zeros(0, dtype=np.int64)
+        n = len(ngrams[0])
+        self._check_n(n)
+        flat, _ = encode_strings(ngrams, self.labels, startchar='', endchar='')
+        digits = flat.astype(np.int64).reshape(-1, n)
+        found = np.all(digits < len(self.labels), axis=1)
+        powers = self.base ** np.arange(self.max_n - 1, self.max_n - n - 1, -1, dtype=np.int64)
+        lower = (digits + 1) @ powers
+        # every key that starts with the n-gram is between lower and upper
+        upper = lower + self.base ** (self.max_n - n)
+        counts = (np.searchsorted(self.sorted_keys, upper)
+                  - np.searchsorted(self.sorted_keys, lower))
+        counts[~found] = 0
+        return counts
+
+    def count(self, ngram):
+        """number of times ngram (a str of labels) occurs"""
+        return int(self.count_many([ngram])[0])
+
+    def top_k(self, n, k):
+        """k most frequent n-grams, as (ngram, count) tuples sorted by count
+        then ngram, descending, like the 'counts' returned by
+        statistics.get_ngram_distribs"""
+        keys, counts = self.counts(n)
+        order = np.lexsort((keys, counts))[::-1][:k]
+        ngrams = decode_ngram_keys(keys[order], n, self.labels)
+        return list(zip(ngrams, counts[order].tolist()))
+
+    def save(self, filename):
+        """saves index to a .npz file, so it does not have to be built again"""
+        np.savez(filename, sorted_keys=self.sorted_keys,
+                 labels=np.asarray(self.labels), max_n=np.asarray(self.max_n))
+
+    @classmethod
+    def load(cls, filename):
+        """loads index saved with NgramIndex.save"""
+        with np.load(filename) as npz:
+            index = cls.__new__(cls)
+            index.labels = str(npz['labels'])
+            index.max_n = int(npz['max_n'])
+            index.base = len(index.labels) + 1
+            index.sorted_keys = npz['sorted_keys']
+            index._counts_cache = {}
+        return index
+
+
+def _sorted_prefix_keys(flat, offsets, num_labels, max_n, base):
+    """sorted keys of the (up to) max_n labels starting at each position
+    that holds a label, cut short at ends of sequences and at non-labels"""
+    num_positions = flat.shape[0]
+    positions = np.arange(num_positions)
+    lengths = np.diff(offsets)
+    seq_ends = np.repeat(offsets[1:], lengths)
+    is_label = flat < num_labels
+    # index of next non-label at or after each position
+    next_stop = np.where(is_label, num_positions, positions)
+    next_stop = np.minimum.accumulate(next_stop[::-1])[::-1]
+    run_lengths = np.minimum(np.minimum(seq_ends, next_stop) - positions, max_n)
+
+    starts = np.flatnonzero(run_lengths > 0)
+    run_lengths = run_lengths[starts]
+    digits = flat.astype(np.int64) + 1
+    keys = np.zeros(starts.shape[0], dtype=np.int64)
+    for j in range(max_n):
+        keys *= base
+        inside = run_lengths > j
+        keys[inside] += digits[starts[inside] + j]
+    keys.sort()
+    return keys
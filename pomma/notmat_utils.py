@@ -1,13 +1,16 @@
 # utility functions for working with .not.mat files generated by evsonganaly.m
 # that containing annotation of songs
 
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 
+import numpy as np
 from scipy.io import loadmat
 
 
-def load_notmat(filename):
+def load_notmat(filename, variable_names=None):
     """
     loads .not.mat files created by evsonganaly.m.
     wrapper around scipy.io.loadmat.
@@ -17,6 +20,10 @@ def load_notmat(filename):
     Argument
     --------
     filename : string, name of .not.mat file
+    variable_names : list
+        of str, names of variables to load. Default is None, load all variables.
+        Loading only the variables needed is much faster, since the rest
+        of the file is not parsed.
 
     Returns
     -------
@@ -31,14 +38,51 @@ def load_notmat(filename):
         raise ValueError("Filename should have extension .cbin.not.mat or"
                          " .cbin")
 
-    return loadmat(filename, squeeze_me=True)
+    return loadmat(filename, squeeze_me=True, variable_names=variable_names)
 
 
-def load_labels(data_dir, start_char='S', end_char='E'):
+def _file_key(filename):
+    """identifies version of a file by its modification time and size,
+    without reading it"""
+    stat = os.stat(filename)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _load_labels_if_changed(notmat, cached):
+    """loads 'labels' from notmat, unless cached entry is for the same version of file"""
+    key = _file_key(notmat)
+    if cached is not None and cached['key'] == key:
+        return cached
+    labels = load_notmat(notmat, variable_names=['labels'])['labels']
+    # with squeeze_me, labels is a str, or an empty array for a file with no labels
+    return {'key': key,
+            'labels': ''.join(np.atleast_1d(labels).tolist())}
+
+
+def _read_cache(cache_file):
+    if cache_file is None or not os.path.isfile(cache_file):
+        return {}
+    with open(cache_file) as fp:
+        return json.load(fp)
+
+
+def _write_cache(cache_file, cache):
+    # write to temporary file first so a crash never leaves a partial cache
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'w') as fp:
+        json.dump(cache, fp)
+    os.replace(tmp_file, cache_file)
+
+
+def load_labels(data_dir, start_char='S', end_char='E', max_workers=None, cache_file=None):
     """
     loads all 'labels' strings from .not.mat files into a list,
     to use for analyzing syntax.
 
+    Files are loaded by a pool of threads, since most of the time is spent
+    waiting on reads (e.g. from network storage), and only the 'labels'
+    variable of each file is parsed.
+
     Parameter
     ---------
     data_dir : str
@@ -47,23 +91,47 @@ def load_labels(data_dir, start_char='S', end_char='E'):
         character appended to start of each 'labels' str, default is 'S'
     end_char : str
         character appended to end of each 'labels' str, default is 'E'
+    max_workers : int
+        number of threads used to load files. Default is None, in which case
+        the default of concurrent.futures.ThreadPoolExecutor is used.
+        If 1, files are loaded one after another.
+    cache_file : str
+        path to a .json file where labels are cached, along with the
+        modification time and size of each .not.mat file.
+        If provided, only files that are new or changed since the cache
+        was written are loaded, and the cache is updated.
+        Default is None, in which case every file is loaded.
 
     Returns
     -------
     labels : list
-        of str, all 'labels' loaded from the .not.mat files
+        of str, all 'labels' loaded from the .not.mat files,
+        in sorted order of filenames
     """
 
     notmats = []
     subdirs = glob(os.path.join(data_dir, '*/'))
     for subdir in subdirs:
-        notmats.extend(glob(os.path.join(data_dir,
-                                         subdir,
-                                         '*.not.mat')))
+        notmats.extend(glob(os.path.join(subdir, '*.not.mat')))
+    notmats = sorted(notmats)
+
+    cache = _read_cache(cache_file)
+    cached = [cache.get(notmat) for notmat in notmats]
+    if max_workers == 1:
+        loaded = list(map(_load_labels_if_changed, notmats, cached))
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            loaded = list(executor.map(_load_labels_if_changed, notmats, cached))
+
+    if cache_file is not None:
+        # also drops files that no longer exist
+        new_cache = dict(zip(notmats, loaded))
+        if new_cache != cache:
+            _write_cache(cache_file, new_cache)
 
     labels = []
-    for notmat in notmats:
-        labels.append(start_char + load_notmat(notmat)['labels'] + end_char)
+    for entry in loaded:
+        labels.append(start_char + entry['labels'] + end_char)
 
     return labels
 
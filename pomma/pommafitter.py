@@ -2,8 +2,32 @@
 # adapted from Matlab code by Dezhe Jin
 
 import numpy as np
+from scipy import sparse
 
-from .determine_symbols_and_max_repeats import determine_symbols_and_max_repeats
+from .determine_symbols_and_max_repeats import (determine_symbols_and_max_repeats,
+                                                determine_symbols_and_max_repeats_encoded)
+from .derive_initial_state_model import derive_initial_state_model
+from .bootstrap import bootstrap_error_bounds_encoded
+from .encoding import flatten_sequences, split_flat
+from .baum_welch import (START_STATE, END_STATE, make_run_batches, kernel_tables,
+                         sequence_log_likelihoods, smooth_state_model, sparse_state_model)
+from .update_state_model import sufficient_stats, extend_state_model, warm_em
+from .sampling import sampling_tables, iter_sample_sequences, sample_sequences
+from .divergence import count_table, compare_tables, select
+from .viterbi import viterbi_tables, viterbi
+from .prune import prune_state_model
+from .serialization import flatten_arrays, unflatten_arrays, save_npz, load_npz
+from .instrumentation import JsonlTrace
+
+# tables derived from a state model, computed once per model, see POMMAfitter._tables
+TABLE_FUNCTIONS = {
+    'sampling': sampling_tables,
+    'kernel': kernel_tables,
+    'viterbi': viterbi_tables,
+}
+
+# keys of a state model that are not arrays
+STATE_MODEL_SCALARS = ['log_likelihood', 'num_extra_states', 'num_em_steps']
 
 class POMMAfitter:
     def __init__(self, **kwargs):
@@ -15,7 +39,14 @@ class POMMAfitter:
             Default is 0.01.
         frac_in_prune : float
             States with fraction of visits less than frac_in_prune are pruned at final step of fitting.
+            The fraction is out of all visits to states of the same symbol.
             Default is 0.01.
+        merge_tolerance : float
+            States of the same symbol whose outgoing probabilities all differ by less than
+            merge_tolerance are merged at final step of fitting. Default is 0.02.
+            If 0, no states are merged.
+        prune_em_steps : int
+            Maximum number of E-M steps after each round of pruning. Default is 10.
         prob_small : float
             Any probability less than prob_small is disregarded when deriving model states.
             Default is 0.001.
@@ -49,10 +80,43 @@ class POMMAfitter:
             Numerical symbol for the start state. Default is 1000.
         end_symbol : int
             Numerical symbol for the end state. Default is 1001.
+        seed : int
+            Seed for random starts of E-M. Default is None.
+        batch_size : int
+            Number of sequences per batch in the forward-backward algorithm.
+            Default is 256.
+        n_jobs : int
+            Number of worker processes used to fit random starts. Default is 1.
+            If -1, use all CPUs.
+        search : str
+            How to search for the initial state model, one of {'grid', 'halving'}.
+            'grid' fits every random start for every number of extra states.
+            'halving' drops random starts that fall behind after a few E-M steps,
+            and stops adding extra states once log-likelihood of held-out sequences
+            stops improving. Default is 'grid'.
+        halving_steps : int
+            Number of E-M steps before the first random starts are dropped
+            when search is 'halving'. Default is 10.
+        halving_eta : int
+            After each round, only 1 / halving_eta of random starts are kept
+            when search is 'halving'. Default is 2.
+        held_out_frac : float
+            Fraction of sequences held out when search is 'halving'. Default is 0.2.
+        patience : int
+            Number of extra states in a row without improvement in held-out
+            log-likelihood before search stops, when search is 'halving'. Default is 1.
+        trace : callable or str
+            Reports progress of E-M while deriving the initial state model:
+            a callable that is passed a dict for every event, e.g. every E-M step,
+            or the name of a file that events are written to as lines of JSON.
+            See derive_initial_state_model for events. Default is None.
+            Not saved by POMMAfitter.save.
         """
         prop_defaults = {
             'prob_prune': 0.01,
             'frac_in_prune': 0.01,
+            'merge_tolerance': 0.02,
+            'prune_em_steps': 10,
             'prob_small': 1e-3,
             'tolerance': 1e-3,
             'max_steps': 10000,
@@ -65,42 +129,299 @@ class POMMAfitter:
             'max_extra_states': 15,
             'start_symbol': 1000,
             'end_symbol': 1001,
+            'seed': None,
+            'batch_size': 256,
+            'n_jobs': 1,
+            'search': 'grid',
+            'halving_steps': 10,
+            'halving_eta': 2,
+            'held_out_frac': 0.2,
+            'patience': 1,
+            'trace': None,
         }
 
         props_for_other_methods = [
             'symbols',
-            'symbols_int_map'
+            'symbols_int_map',
             'seqs_mapped',
-            'repeat_syms',
+            'repeat_symbols',
             'max_repeats',
             'res_diff',
-            'initial_state_model'
+            'initial_state_model',
+            'error_bounds',
+            'sufficient_stats',
         ]
 
         for (prop, default) in prop_defaults.items():
             setattr(self, prop, kwargs.get(prop, default))
+        self._prop_names = list(prop_defaults)
 
         for prop_for_other_methods in props_for_other_methods:
             setattr(self, prop_for_other_methods, None)
 
+        # state model that tables were derived from, and the tables
+        self._tables_model = None
+        self._tables_cache = {}
+
     def _determine_symbols_and_max_repeats(self, sequences):
-        symbols_and_max_repeats = determine_symbols_and_max_repeats(sequences)
+        if isinstance(sequences, dict):
+            # corpus opened with corpus.open_corpus
+            symbols_and_max_repeats = determine_symbols_and_max_repeats_encoded(
+                sequences['flat'], sequences['offsets'], sequences['symbols'])
+        else:
+            symbols_and_max_repeats = determine_symbols_and_max_repeats(sequences)
         for key, val in symbols_and_max_repeats.items():
             setattr(self, key, val)
 
+    def _derive_initial_state_model(self):
+        if isinstance(self.trace, str):
+            with JsonlTrace(self.trace) as trace:
+                self._derive_initial_state_model_traced(trace)
+        else:
+            self._derive_initial_state_model_traced(self.trace)
+
+    def _derive_initial_state_model_traced(self, trace):
+        max_repeats = {self.symbols_int_map[symbol]: max_repeat
+                       for symbol, max_repeat in self.max_repeats.items()}
+        self.initial_state_model = derive_initial_state_model(
+            self.seqs_mapped,
+            max_repeats=max_repeats,
+            num_symbols=len(self.symbols),
+            max_extra_states=self.max_extra_states,
+            start_symbol=self.start_symbol,
+            end_symbol=self.end_symbol,
+            num_random_starts=self.num_random_starts,
+            tolerance=self.tolerance,
+            max_steps=self.max_steps,
+            prob_small=self.prob_small,
+            seed=self.seed,
+            batch_size=self.batch_size,
+            n_jobs=self.n_jobs,
+            search=self.search,
+            halving_steps=self.halving_steps,
+            halving_eta=self.halving_eta,
+            held_out_frac=self.held_out_frac,
+            patience=self.patience,
+            trace=trace,
+        )
+
+    def _bootstrap_error_bounds(self):
+        """estimates upper bounds of errors between statistics of sequences,
+        by splitting sequences into two groups num_boot times,
+        see bootstrap.bootstrap_error_bounds_encoded"""
+        flat, offsets = flatten_sequences(self.seqs_mapped)
+        self.error_bounds = bootstrap_error_bounds_encoded(
+            flat, offsets,
+            num_labels=len(self.symbols),
+            num_boot=self.num_boot,
+            percent_split=self.percent_split,
+            p_value=self.p_value,
+            m_compare=self.m_compare,
+            seed=self.seed,
+            n_jobs=self.n_jobs,
+        )
+        int_symbols_map = {symbol_int: symbol
+                           for symbol, symbol_int in self.symbols_int_map.items()}
+        self.error_bounds['repeat'] = {int_symbols_map[symbol_int]: bound
+                                       for symbol_int, bound in self.error_bounds['repeat'].items()}
+
+    def _sufficient_stats(self):
+        """expected counts of all sequences under the fit model,
+        kept so that partial_fit does not have to go through them again"""
+        self.sufficient_stats = sufficient_stats(
+            self.initial_state_model, make_run_batches(self.seqs_mapped, self.batch_size))
+
+    def _compare_statistics(self):
+        """differences between statistics of num_seq sequences generated by the
+        fit model and statistics of the sequences it was fit to, with the same
+        keys as error_bounds, see divergence.compare_tables"""
+        num_labels = len(self.symbols_int_map)
+        real_table = count_table(*flatten_sequences(self.seqs_mapped), num_labels,
+                                 m_compare=self.m_compare)
+        flat, offsets = sample_sequences(self.initial_state_model, self.num_seq, self.seed,
+                                         tables=self._tables('sampling'))
+        model_table = count_table(flat, offsets, num_labels, m_compare=self.m_compare)
+        self.res_diff = select(compare_tables(real_table, [model_table]), 0)
+        int_symbols = self._int_symbols()
+        self.res_diff['repeat'] = {int_symbols[symbol_int]: diff
+                                   for symbol_int, diff in self.res_diff['repeat'].items()}
+
     def _prune(self):
-        """prunes any transitions with probabilities less than prob_prune
-        final step of fitting POMMA.
-        """ 
+        """prunes any transitions with probabilities less than prob_prune,
+        and states with fraction of visits less than frac_in_prune,
+        and merges states with near-identical outgoing probabilities.
+        final step of fitting POMMA, see prune.prune_state_model.
+        """
+        self.initial_state_model = prune_state_model(
+            self.initial_state_model,
+            make_run_batches(self.seqs_mapped, self.batch_size),
+            prob_prune=self.prob_prune,
+            frac_in_prune=self.frac_in_prune,
+            merge_tolerance=self.merge_tolerance,
+            em_steps_per_round=self.prune_em_steps,
+            tolerance=self.tolerance,
+            prob_small=self.prob_small,
+        )
+
+    def _tables(self, kind):
+        """tables of kind 'sampling', 'kernel' or 'viterbi' derived from the fit model,
+        computed the first time they are needed and kept until the model changes"""
+        if self._tables_model is not self.initial_state_model:
+            self._tables_model = self.initial_state_model
+            self._tables_cache = {}
+        if kind not in self._tables_cache:
+            self._tables_cache[kind] = TABLE_FUNCTIONS[kind](self.initial_state_model)
+        return self._tables_cache[kind]
+
+    def _int_symbols(self):
+        """array that maps integers back to symbols, inverse of symbols_int_map"""
+        int_symbols = np.empty(len(self.symbols_int_map), dtype=object)
+        for symbol, symbol_int in self.symbols_int_map.items():
+            int_symbols[symbol_int] = symbol
+        return int_symbols
+
+    def generate_sequences(self, num_seq=None, seed=None, max_length=None):
+        """generates sequences from the fit model, see sampling.sample_sequences
+
+        Parameters
+        ----------
+        num_seq : int
+            Number of sequences to generate. Default is None, in which case
+            the num_seq attribute is used.
+        seed : int
+            Seed for random number generator. Default is None, in which case
+            the seed attribute is used.
+        max_length : int
+            Sequences are cut off after max_length symbols. Default is None, no limit.
+
+        Returns
+        -------
+        sequences : list
+            of lists of symbols, like the sequences passed to fit
+        """
+        return next(self.iter_generate_sequences(num_seq, chunk_size=None, seed=seed,
+                                                 max_length=max_length), [])
+
+    def iter_generate_sequences(self, num_seq=None, chunk_size=10000, seed=None,
+                                max_length=None):
+        """generates sequences from the fit model in chunks of chunk_size,
+        so sequences can be processed as they are generated
+        without keeping all of them in memory.
+        Parameters are the same as generate_sequences.
+
+        Yields
+        ------
+        sequences : list
+            of lists of symbols, at most chunk_size of them
+        """
+        if num_seq is None:
+            num_seq = self.num_seq
+        if seed is None:
+            seed = self.seed
+        if chunk_size is None:
+            chunk_size = max(num_seq, 1)
+        int_symbols = self._int_symbols()
+        for flat, offsets in iter_sample_sequences(self.initial_state_model, num_seq,
+                                                   chunk_size, seed, max_length,
+                                                   tables=self._tables('sampling')):
+            yield [seq.tolist() for seq in split_flat(int_symbols[flat], offsets)]
+
+    def _map_new_sequences(self, sequences):
+        """maps sequences to the ints of the fit model, with -1 for symbols
+        the model has never seen. Sequences can be a list or a corpus, as for fit."""
+        if isinstance(sequences, dict):
+            # corpus opened with corpus.open_corpus
+            corpus_int_map = np.asarray([self.symbols_int_map.get(symbol, -1)
+                                         for symbol in sequences['symbols']], dtype=np.intp)
+            return split_flat(corpus_int_map[sequences['flat']], sequences['offsets'])
+        return [np.asarray([self.symbols_int_map.get(symbol, -1) for symbol in seq],
+                           dtype=np.intp)
+                for seq in sequences]
+
+    def score_samples(self, sequences, n_jobs=None):
+        """log-likelihood of each sequence under the fit model,
+        e.g. to find bouts that the model explains poorly.
+
+        Sequences are batched by number of runs of repeats and scored with the
+        forward pass used by E-M, see baum_welch.sequence_log_likelihoods.
+
+        Parameters
+        ----------
+        sequences : list or dict
+            as for fit
+        n_jobs : int
+            Number of threads to spread batches over. Default is None,
+            in which case the n_jobs attribute is used. If -1, use all CPUs.
+
+        Returns
+        -------
+        log_likelihoods : ndarray
+            one per sequence. -inf for sequences that are impossible
+            under the model, including sequences with symbols it has never seen.
+        """
+        if n_jobs is None:
+            n_jobs = self.n_jobs
+        seqs_mapped = self._map_new_sequences(sequences)
+        lengths = np.asarray([seq.shape[0] for seq in seqs_mapped], dtype=np.intp)
+        known = np.asarray([seq.min(initial=0) >= 0 for seq in seqs_mapped], dtype=bool)
+        log_likelihoods = np.full(len(seqs_mapped), -np.inf)
+        with np.errstate(divide='ignore'):
+            # a sequence with no symbols goes straight from the start state to the end state
+            log_likelihoods[lengths == 0] = np.log(
+                self.initial_state_model['trans'][START_STATE, END_STATE])
+        scored_inds = np.flatnonzero(known & (lengths > 0))
+        if scored_inds.shape[0]:
+            batches = make_run_batches([seqs_mapped[ind] for ind in scored_inds],
+                                       self.batch_size)
+            log_likelihoods[scored_inds] = sequence_log_likelihoods(
+                self.initial_state_model, batches, n_jobs, tables=self._tables('kernel'))
+        return log_likelihoods
+
+    def score(self, sequences, n_jobs=None):
+        """total log-likelihood of sequences under the fit model,
+        e.g. of held-out sequences to compare models. See score_samples."""
+        return self.score_samples(sequences, n_jobs).sum()
+
+    def decode(self, sequences, n_jobs=None):
+        """most likely path through the states of the fit model for each sequence,
+        e.g. to see which of the states that emit a symbol each syllable came from.
+        See viterbi.viterbi.
+
+        Parameters
+        ----------
+        sequences : list or dict
+            as for fit
+        n_jobs : int
+            Number of threads to spread batches over. Default is None,
+            in which case the n_jobs attribute is used. If -1, use all CPUs.
+
+        Returns
+        -------
+        flat_states : ndarray
+            index of the state in initial_state_model of every symbol of every sequence,
+            concatenated. -1 for sequences that are impossible under the model.
+        offsets : ndarray
+            of length number of sequences + 1.
+            States of sequence i are flat_states[offsets[i]:offsets[i+1]].
+        log_probs : ndarray
+            log probability of the most likely path of each sequence
+        """
+        if n_jobs is None:
+            n_jobs = self.n_jobs
+        flat, offsets = flatten_sequences(self._map_new_sequences(sequences), dtype=np.intp)
+        return viterbi(self.initial_state_model, flat, offsets, self.batch_size, n_jobs,
+                       tables=self._tables('viterbi'))
 
     def fit(self, sequences):
         """
 
         Parameters
         ----------
-        sequences : list
+        sequences : list or dict
             List of lists, of type int or str.
             Sequences of ints where each int is a Symbol used to label a syllable in birdsong.
+            Can also be a corpus opened with corpus.open_corpus,
+            in which case sequences are used without copying them into lists.
 
         Returns
         -------
@@ -108,5 +429,175 @@ class POMMAfitter:
         """
 
         self._determine_symbols_and_max_repeats(sequences)
+        self._bootstrap_error_bounds()
+        self._derive_initial_state_model()
+        self._prune()
+        self._sufficient_stats()
+        self._compare_statistics()
+
+    def partial_fit(self, sequences, decay=1.):
+        """updates the fit model with new sequences, e.g. songs recorded since
+        the last fit, instead of fitting again from all sequences.
+
+        New symbols are added to symbols_int_map after the existing ones,
+        so symbols already mapped keep their integers. States are only added
+        for new symbols, and repeats are only extended for symbols that now
+        repeat more than before; see update_state_model.extend_state_model.
+        If no states are added but a new sequence is impossible under the fit model,
+        e.g. because it needs a transition that was pruned, the model is smoothed
+        first, see baum_welch.smooth_state_model. Then E-M runs on the new sequences only, starting from the fit model
+        and adding the expected counts kept from previous fits,
+        see update_state_model.warm_em.
+        If the model has not been fit yet, this is the same as fit.
+        Afterwards, initial_state_model['log_likelihood'] is the log-likelihood
+        of the new sequences.
+
+        Parameters
+        ----------
+        sequences : list or dict
+            new sequences, as for fit
+        decay : float
+            weight of previous sequences, between 0 and 1. Default is 1.,
+            where previous and new sequences count the same.
+
+        Returns
+        -------
+        None
+        """
+        if self.initial_state_model is None:
+            self.fit(sequences)
+            return
+
+        if isinstance(sequences, dict):
+            new = determine_symbols_and_max_repeats_encoded(
+                sequences['flat'], sequences['offsets'], sequences['symbols'])
+        else:
+            new = determine_symbols_and_max_repeats(sequences)
+        for symbol in sorted(new['symbols'] - self.symbols):
+            self.symbols_int_map[symbol] = len(self.symbols_int_map)
+        self.symbols = self.symbols | new['symbols']
+        for symbol, max_repeat in new['max_repeats'].items():
+            self.max_repeats[symbol] = max(self.max_repeats.get(symbol, 0), max_repeat)
+        self.repeat_symbols = [symbol
+                               for symbol, max_repeat in self.max_repeats.items()
+                               if max_repeat > 1]
+
+        # map new sequences from their own mapping to this one
+        new_int_map = np.empty(len(new['symbols_int_map']), dtype=np.intp)
+        for symbol, symbol_int in new['symbols_int_map'].items():
+            new_int_map[symbol_int] = self.symbols_int_map[symbol]
+        seqs_mapped = [new_int_map[np.asarray(seq, dtype=np.intp)].tolist()
+                       for seq in new['seqs_mapped']]
+        self.seqs_mapped = list(self.seqs_mapped) + seqs_mapped
+
+        max_repeats = {self.symbols_int_map[symbol]: max_repeat
+                       for symbol, max_repeat in self.max_repeats.items()}
+        state_model, stats, extended = extend_state_model(
+            self.initial_state_model, self.sufficient_stats, max_repeats,
+            num_states_per_symbol=1 + self.initial_state_model['num_extra_states'])
+        batches = make_run_batches(seqs_mapped, self.batch_size)
+        if not extended and np.isneginf(sequence_log_likelihoods(state_model, batches)).any():
+            # new sequences need a transition that was pruned,
+            # which E-M can only learn again if it is not zero
+            smoothed = smooth_state_model(state_model)
+            state_model = (sparse_state_model(smoothed) if sparse.issparse(state_model['trans'])
+                           else smoothed)
+        state_model, log_likelihood, num_steps, stats = warm_em(
+            state_model, batches, stats,
+            tolerance=self.tolerance, max_steps=self.max_steps, prob_small=self.prob_small,
+            decay=decay)
+        state_model['log_likelihood'] = log_likelihood
+        state_model['num_em_steps'] = num_steps
+        self.initial_state_model = state_model
+        self.sufficient_stats = stats
+        self._compare_statistics()
+
+    def save(self, filename):
+        """saves the fit model to a .npz file, see POMMAfitter.load
+
+        The file has the parameters, the symbol map, the state model, error bounds,
+        res_diff and sufficient statistics, and also every table derived from the
+        state model that generating, scoring and decoding use, so that a loaded
+        model does not have to compute them again.
+        Sequences the model was fit to are not saved.
+
+        Parameters
+        ----------
+        filename : str
+            path to save to. numpy adds the .npz extension if it is not there.
+        """
+        if self.initial_state_model is None:
+            raise ValueError('model has not been fit yet')
+        state_model = self.initial_state_model
+        arrays = flatten_arrays({key: value for key, value in state_model.items()
+                                 if key not in STATE_MODEL_SCALARS}, 'state_model')
+        if self.sufficient_stats is not None:
+            arrays.update(flatten_arrays(self.sufficient_stats, 'sufficient_stats'))
+        for kind in TABLE_FUNCTIONS:
+            arrays.update(flatten_arrays(self._tables(kind), f'tables/{kind}'))
+
+        int_symbols = self._int_symbols().tolist()
+        metadata = {
+            # a trace is for one fit, and can be any callable
+            'params': {prop: getattr(self, prop) for prop in self._prop_names
+                       if prop != 'trace'},
+            'symbols': int_symbols,
+            'max_repeats': [self.max_repeats[symbol] for symbol in int_symbols],
+            'state_model': {key: state_model[key]
+                            for key in STATE_MODEL_SCALARS if key in state_model},
+            # dicts are stored as lists of (key, value) pairs,
+            # since keys are ints or symbols and JSON keys are always str
+            'error_bounds': _dict_items(self.error_bounds),
+            'res_diff': _dict_items(self.res_diff),
+        }
+        save_npz(filename, arrays, metadata)
+
+    @classmethod
+    def load(cls, filename):
+        """loads a model saved with POMMAfitter.save, ready to generate, score
+        and decode sequences without fitting or computing any table again.
+
+        Since sequences the model was fit to are not saved, seqs_mapped is an
+        empty list, and after partial_fit, res_diff compares generated sequences
+        only with the new sequences.
+
+        Returns
+        -------
+        fitter : POMMAfitter
+        """
+        npz, metadata = load_npz(filename)
+        with npz:
+            fitter = cls(**metadata['params'])
+            fitter.symbols_int_map = {symbol: symbol_int
+                                      for symbol_int, symbol in enumerate(metadata['symbols'])}
+            fitter.symbols = set(fitter.symbols_int_map)
+            fitter.max_repeats = dict(zip(metadata['symbols'], metadata['max_repeats']))
+            fitter.repeat_symbols = [symbol
+                                     for symbol, max_repeat in fitter.max_repeats.items()
+                                     if max_repeat > 1]
+            fitter.seqs_mapped = []
+            fitter.initial_state_model = dict(unflatten_arrays(npz, 'state_model'),
+                                              **metadata['state_model'])
+            fitter.sufficient_stats = unflatten_arrays(npz, 'sufficient_stats') or None
+            fitter.error_bounds = _items_dict(metadata['error_bounds'])
+            fitter.res_diff = _items_dict(metadata['res_diff'])
+            fitter._tables_model = fitter.initial_state_model
+            fitter._tables_cache = unflatten_arrays(npz, 'tables')
+        return fitter
+
+
+def _dict_items(statistics):
+    """converts each dict in a dict of statistics, e.g. error_bounds,
+    to a list of (key, value) pairs"""
+    if statistics is None:
+        return None
+    return {key: list(value.items()) if isinstance(value, dict) else value
+            for key, value in statistics.items()}
 
 
+def _items_dict(statistics):
+    """inverse of _dict_items"""
+    if statistics is None:
+        return None
+    return {key: {item_key: item for item_key, item in value} if isinstance(value, list) else value
+            for key, value in statistics.items()}
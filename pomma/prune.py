@@ -0,0 +1,219 @@
+# final pruning of a fit state model: drops rare transitions and rarely
+# visited states, and merges states of the same symbol that behave the same,
+# so the model used to generate and score sequences is as small as it can be
+
+import numpy as np
+
+from .baum_welch import (START_STATE, END_STATE, dense_trans, drop_small, e_step, em_steps,
+                         normalize_rows, sequence_log_likelihoods, sparse_state_model)
+
+
+def _emitting(state_model):
+    num_states = np.asarray(state_model['state_symbols']).shape[0]
+    return (np.arange(num_states) != START_STATE) & (np.arange(num_states) != END_STATE)
+
+
+def prune_transitions(state_model, prob_prune):
+    """sets transition probabilities less than prob_prune to zero and
+    re-normalizes each row, with one mask over the whole matrix.
+    As in baum_welch.drop_small, the most probable transition from each state
+    to each symbol is kept, so no symbol becomes unreachable."""
+    trans = drop_small(dense_trans(state_model['trans']),
+                       np.asarray(state_model['state_symbols']), prob_prune)
+    return dict(state_model, trans=trans)
+
+
+def remove_states(state_model, remove):
+    """removes states, and re-normalizes the transitions into the ones left
+
+    Parameters
+    ----------
+    state_model : dict
+    remove : ndarray
+        boolean mask, True for each state to remove.
+        The start and end states are never removed.
+
+    Returns
+    -------
+    state_model : dict
+    """
+    keep = ~np.asarray(remove) | ~_emitting(state_model)
+    trans = dense_trans(state_model['trans'])
+    return dict(state_model,
+                state_symbols=np.asarray(state_model['state_symbols'])[keep],
+                max_repeat_nums=np.asarray(state_model['max_repeat_nums'])[keep],
+                trans=normalize_rows(trans[np.ix_(keep, keep)]),
+                repeat_probs=state_model['repeat_probs'][keep])
+
+
+def rare_states(state_model, visit_counts, frac_in_prune):
+    """mask of states with less than frac_in_prune of the visits to all states
+    of the same symbol. The most visited state of each symbol is never rare.
+
+    Parameters
+    ----------
+    state_model : dict
+    visit_counts : ndarray
+        as returned by baum_welch.e_step
+    frac_in_prune : float
+
+    Returns
+    -------
+    rare : ndarray
+        boolean mask, True for each rare state
+    """
+    state_symbols = np.asarray(state_model['state_symbols'])
+    emitting = np.flatnonzero(_emitting(state_model))
+    visits = visit_counts.sum(axis=1)[emitting]
+    symbols = state_symbols[emitting]
+    _, symbol_inds = np.unique(symbols, return_inverse=True)
+    symbol_visits = np.bincount(symbol_inds, weights=visits)
+    most_visited = np.zeros(symbol_visits.shape[0])
+    np.maximum.at(most_visited, symbol_inds, visits)
+    rare = np.zeros(state_symbols.shape[0], dtype=bool)
+    rare[emitting] = ((visits < frac_in_prune * symbol_visits[symbol_inds])
+                      & (visits < most_visited[symbol_inds]))
+    return rare
+
+
+def closest_pair(state_model):
+    """pair of states of the same symbol whose outgoing probabilities differ the least
+
+    Outgoing probabilities are the transitions to states of other symbols,
+    and the repeat probabilities. Transitions between states of the same symbol
+    are left out, since they become repeats when the two states are merged.
+
+    Returns
+    -------
+    pair : tuple
+        of two state indices, or None if no symbol has more than one state
+    difference : float
+        largest absolute difference between outgoing probabilities of the pair
+    """
+    state_symbols = np.asarray(state_model['state_symbols'])
+    trans = dense_trans(state_model['trans'])
+    repeat_probs = state_model['repeat_probs']
+    emitting = _emitting(state_model)
+    best_pair, best_difference = None, np.inf
+    for symbol in np.unique(state_symbols[emitting]):
+        states = np.flatnonzero(emitting & (state_symbols == symbol))
+        if states.shape[0] < 2:
+            continue
+        outgoing = np.hstack((trans[states][:, state_symbols != symbol], repeat_probs[states]))
+        differences = np.abs(outgoing[:, np.newaxis] - outgoing[np.newaxis]).max(axis=2)
+        differences[np.tril_indices(states.shape[0])] = np.inf
+        first, second = np.unravel_index(differences.argmin(), differences.shape)
+        if differences[first, second] < best_difference:
+            best_pair = (states[first], states[second])
+            best_difference = differences[first, second]
+    return best_pair, best_difference
+
+
+def merge_states(state_model, visit_counts, first, second):
+    """merges second state into first state, which must emit the same symbol.
+
+    The merged state gets every transition into either state, and the
+    average of their outgoing probabilities, weighted by visits.
+    Transitions between the two states become repeats of the merged state,
+    so they are dropped and the outgoing transitions re-normalized.
+
+    Returns
+    -------
+    state_model : dict
+    visit_counts : ndarray
+        with visits of the second state added to the first and its row removed
+    """
+    trans = dense_trans(state_model['trans']).copy()
+    repeat_probs = state_model['repeat_probs'].copy()
+    max_repeat_nums = np.asarray(state_model['max_repeat_nums']).copy()
+    visits = visit_counts.sum(axis=1)
+    weights = np.array([visits[first], visits[second]])
+    weights = weights / weights.sum() if weights.sum() > 0 else np.array([0.5, 0.5])
+
+    trans[first] = weights[0] * trans[first] + weights[1] * trans[second]
+    trans[first, [first, second]] = 0.
+    trans[:, first] += trans[:, second]
+    repeat_probs[first] = weights[0] * repeat_probs[first] + weights[1] * repeat_probs[second]
+    max_repeat_nums[first] = max(max_repeat_nums[first], max_repeat_nums[second])
+
+    remove = np.zeros(trans.shape[0], dtype=bool)
+    remove[second] = True
+    state_model = remove_states(dict(state_model, trans=normalize_rows(trans),
+                                     repeat_probs=repeat_probs,
+                                     max_repeat_nums=max_repeat_nums),
+                                remove)
+    visit_counts = visit_counts.copy()
+    visit_counts[first] += visit_counts[second]
+    return state_model, visit_counts[~remove]
+
+
+def _possible(state_model, batches):
+    return np.all(np.isfinite(sequence_log_likelihoods(state_model, batches)))
+
+
+def prune_state_model(state_model, batches, prob_prune=0.01, frac_in_prune=0.01,
+                      merge_tolerance=0.02, em_steps_per_round=10, max_rounds=10,
+                      tolerance=1e-3, prob_small=1e-3):
+    """prunes a fit state model, without fitting it again from scratch.
+
+    Each round drops transitions less than prob_prune (see prune_transitions),
+    removes states with less than frac_in_prune of the visits to their symbol
+    (see rare_states), and merges pairs of states of the same symbol whose
+    outgoing probabilities all differ by less than merge_tolerance
+    (see closest_pair and merge_states). Then a few steps of E-M start from
+    the pruned model, and rounds repeat until nothing is left to prune.
+    Changes that would make any sequence impossible are not made.
+
+    Parameters
+    ----------
+    state_model : dict
+        as returned by derive_initial_state_model
+    batches : list
+        sequences the model was fit to, as returned by baum_welch.make_run_batches
+    prob_prune : float
+        Default is 0.01.
+    frac_in_prune : float
+        Default is 0.01.
+    merge_tolerance : float
+        Default is 0.02. If 0, no states are merged.
+    em_steps_per_round : int
+        maximum number of E-M steps after each round. Default is 10.
+    max_rounds : int
+        Default is 10.
+    tolerance, prob_small :
+        as for baum_welch.fit_em
+
+    Returns
+    -------
+    state_model : dict
+        pruned state model, with transitions stored as a sparse matrix
+        (see baum_welch.sparse_state_model), and with log_likelihood updated
+    """
+    for _ in range(max_rounds):
+        pruned = prune_transitions(state_model, prob_prune)
+        if not _possible(pruned, batches):
+            break
+        *_, visit_counts, _ = e_step(pruned, batches)
+        candidate = remove_states(pruned, rare_states(pruned, visit_counts, frac_in_prune))
+        *_, visit_counts, _ = e_step(candidate, batches)
+        while True:
+            pair, difference = closest_pair(candidate)
+            if pair is None or difference >= merge_tolerance:
+                break
+            candidate, visit_counts = merge_states(candidate, visit_counts, *pair)
+        if _possible(candidate, batches):
+            pruned = candidate
+
+        changed = (pruned['trans'].shape != state_model['trans'].shape
+                   or np.any((pruned['trans'] > 0) != (dense_trans(state_model['trans']) > 0)))
+        state_model = pruned
+        if not changed:
+            break
+        state_model, *_ = em_steps(state_model, batches, em_steps_per_round,
+                                   tolerance, prob_small)
+
+    pruned = prune_transitions(state_model, prob_prune)
+    if _possible(pruned, batches):
+        state_model = pruned
+    state_model = dict(state_model, log_likelihood=e_step(state_model, batches)[-1])
+    return sparse_state_model(state_model)
@@ -0,0 +1,217 @@
+# generates sequences from POMMA state models by sampling paths through states
+
+import numpy as np
+from scipy import sparse
+
+from .baum_welch import START_STATE, END_STATE
+
+
+def sampling_tables(state_model):
+    """tables used to sample from a state model, computed once per model
+
+    Transitions are stored as in a sparse matrix, one entry per non-zero
+    transition probability, whether the state model stores transitions
+    dense or sparse (see baum_welch.sparse_state_model), so tables
+    and sampling cost grow with the number of transitions, not states squared.
+    States whose transition probabilities are all zero go to the end state,
+    as first_order_markov.generate_sequences does with labels that never go anywhere.
+
+    Parameters
+    ----------
+    state_model : dict
+        as returned by init_state_model or fit_em
+
+    Returns
+    -------
+    tables : dict
+        with following key, value pairs:
+            trans_cdfs : ndarray
+                cumulative probabilities of the non-zero transitions of each row,
+                where row i is shifted by 2 * i so that one call to searchsorted
+                finds the next state for every row at once
+            trans_states : ndarray
+                state that each element of trans_cdfs goes to
+            row_shifts : ndarray
+                2 * i for each state i
+            repeat_probs : ndarray
+                as in state_model, with one more column of zeros so that
+                a state never repeats more than its maximum number of repeats
+            state_symbols : ndarray
+                symbol emitted by each state
+    """
+    trans = sparse.csr_matrix(state_model['trans'])
+    trans.eliminate_zeros()
+    num_states = trans.shape[0]
+    # a state with no transitions, e.g. after pruning, ends the sequence
+    dead_ends = np.flatnonzero(np.diff(trans.indptr) == 0)
+    if dead_ends.shape[0]:
+        trans = trans + sparse.csr_matrix(
+            (np.ones(dead_ends.shape[0]), (dead_ends, np.full(dead_ends.shape[0], END_STATE))),
+            shape=trans.shape)
+    row_of_edge = np.repeat(np.arange(num_states), np.diff(trans.indptr))
+    cdfs = np.cumsum(trans.data)
+    row_starts = np.concatenate(([0.], cdfs))[trans.indptr[:-1]]
+    cdfs -= row_starts[row_of_edge]
+    row_totals = np.zeros(num_states)
+    has_edges = np.diff(trans.indptr) > 0
+    row_totals[has_edges] = cdfs[trans.indptr[1:][has_edges] - 1]
+    # dividing by the last element makes it exactly 1,
+    # so random numbers in [0, 1) always fall inside the row
+    cdfs /= row_totals[row_of_edge]
+    row_shifts = 2 * np.arange(num_states)
+    repeat_probs = state_model['repeat_probs']
+    return {
+        'trans_cdfs': cdfs + row_shifts[row_of_edge],
+        'trans_states': trans.indices.astype(np.intp),
+        'row_shifts': row_shifts,
+        'repeat_probs': np.hstack((repeat_probs, np.zeros((num_states, 1)))),
+        'state_symbols': np.asarray(state_model['state_symbols']),
+    }
+
+
+def _next_states(tables, states, r):
+    """draws next state for each of states, given one uniform random number each"""
+    return tables['trans_states'][np.searchsorted(tables['trans_cdfs'],
+                                                  r + tables['row_shifts'][states],
+                                                  side='right')]
+
+
+def sample_paths(state_model, num, rng=None, max_length=None, tables=None):
+    """samples paths through the states of a state model, all at once
+
+    At each step, every sequence that has not reached the end state emits the
+    symbol of its current state. It then either stays in the same state,
+    with the repeat probability for the number of times it has emitted in a row,
+    or leaves for another state.
+
+    Parameters
+    ----------
+    state_model : dict
+        as returned by init_state_model or fit_em
+    num : int
+        number of paths to sample
+    rng : numpy.random.Generator
+        Default is None, in which case a new Generator is created with no seed.
+    max_length : int
+        paths are cut off after max_length steps. Default is None, no limit.
+    tables : dict
+        as returned by sampling_tables. Default is None,
+        in which case they are computed from state_model.
+
+    Returns
+    -------
+    flat_states : ndarray
+        states of all paths, concatenated, without start and end states
+    offsets : ndarray
+        of length num + 1. Path i is flat_states[offsets[i]:offsets[i+1]].
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    if tables is None:
+        tables = sampling_tables(state_model)
+    repeat_probs = tables['repeat_probs']
+    num_states = repeat_probs.shape[0]
+
+    paths = np.zeros((num, 64), dtype=np.min_scalar_type(num_states))
+    lengths = np.zeros(num, dtype=np.int64)
+    live = np.arange(num)
+    states = _next_states(tables, np.full(num, START_STATE), rng.random(num))
+    reps = np.zeros(num, dtype=np.intp)
+    step = 0
+    while live.shape[0]:
+        ended = states == END_STATE
+        if max_length is not None and step == max_length:
+            ended[:] = True
+        lengths[live[ended]] = step
+        live, states, reps = live[~ended], states[~ended], reps[~ended]
+        if not live.shape[0]:
+            break
+        if step == paths.shape[1]:
+            paths = np.concatenate((paths, np.zeros_like(paths)), axis=1)
+        paths[live, step] = states
+
+        r = rng.random((2, live.shape[0]))
+        stay = r[0] < repeat_probs[states, np.minimum(reps, repeat_probs.shape[1] - 1)]
+        reps = np.where(stay, reps + 1, 0)
+        leave = ~stay
+        states[leave] = _next_states(tables, states[leave], r[1, leave])
+        step += 1
+
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    flat_states = paths[np.arange(paths.shape[1]) < lengths[:, np.newaxis]]
+    return flat_states, offsets
+
+
+def sample_sequences(state_model, num, seed=None, max_length=None, return_states=False,
+                     tables=None):
+    """generates sequences of symbols from a state model
+
+    Parameters
+    ----------
+    state_model : dict
+        as returned by init_state_model or fit_em
+    num : int
+        number of sequences to generate
+    seed : int
+        seed for random number generator. Default is None.
+    max_length : int
+        sequences are cut off after max_length symbols. Default is None, no limit.
+    return_states : bool
+        if True, also return the states that emitted each symbol. Default is False.
+    tables : dict
+        as returned by sampling_tables. Default is None,
+        in which case they are computed from state_model.
+
+    Returns
+    -------
+    flat : ndarray
+        symbols of all sequences, concatenated
+    offsets : ndarray
+        of length num + 1. Sequence i is flat[offsets[i]:offsets[i+1]].
+    flat_states : ndarray
+        only returned if return_states is True
+    """
+    rng = np.random.default_rng(seed)
+    if tables is None:
+        tables = sampling_tables(state_model)
+    flat_states, offsets = sample_paths(state_model, num, rng, max_length, tables)
+    flat = tables['state_symbols'][flat_states]
+    if return_states:
+        return flat, offsets, flat_states
+    return flat, offsets
+
+
+def iter_sample_sequences(state_model, num, chunk_size=10000, seed=None, max_length=None,
+                          tables=None):
+    """generates sequences of symbols from a state model in chunks,
+    so that any number of sequences can be generated with bounded memory
+
+    Parameters
+    ----------
+    state_model : dict
+        as returned by init_state_model or fit_em
+    num : int
+        total number of sequences to generate
+    chunk_size : int
+        number of sequences in each chunk. Default is 10000.
+    seed : int
+        seed for random number generator. Default is None.
+        Sequences generated with the same seed and chunk_size are the same.
+    max_length : int
+        sequences are cut off after max_length symbols. Default is None, no limit.
+    tables : dict
+        as returned by sampling_tables. Default is None,
+        in which case they are computed from state_model.
+
+    Yields
+    ------
+    flat, offsets : ndarray
+        chunk of sequences, as returned by sample_sequences
+    """
+    rng = np.random.default_rng(seed)
+    if tables is None:
+        tables = sampling_tables(state_model)
+    for start in range(0, num, chunk_size):
+        flat_states, offsets = sample_paths(state_model, min(chunk_size, num - start),
+                                            rng, max_length, tables)
+        yield tables['state_symbols'][flat_states], offsets
@@ -0,0 +1,93 @@
+# helpers to store fit models in a single .npz file: nested dicts of arrays
+# are flattened into "/"-separated keys, and everything that is not an array
+# is stored as one JSON string
+
+import json
+
+import numpy as np
+from scipy import sparse
+
+FORMAT_VERSION = 1
+
+
+def to_json_value(value):
+    """converts numpy scalars and arrays, and tuples, so value can be written as JSON"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [to_json_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: to_json_value(item) for key, item in value.items()}
+    return value
+
+
+def flatten_arrays(arrays, prefix):
+    """flattens a dict of arrays, and of dicts of arrays, into one dict
+    with keys prefix/key/sub_key. Sparse matrices are stored as their CSR arrays."""
+    flat = {}
+    for key, value in arrays.items():
+        name = f'{prefix}/{key}'
+        if isinstance(value, dict):
+            flat.update(flatten_arrays(value, name))
+        elif sparse.issparse(value):
+            value = sparse.csr_matrix(value)
+            flat[f'{name}/csr_data'] = value.data
+            flat[f'{name}/csr_indices'] = value.indices
+            flat[f'{name}/csr_indptr'] = value.indptr
+            flat[f'{name}/csr_shape'] = np.asarray(value.shape)
+        elif isinstance(value, list):
+            # lists of arrays, e.g. run tables, are not stored
+            continue
+        else:
+            flat[name] = np.asarray(value)
+    return flat
+
+
+def unflatten_arrays(npz, prefix):
+    """inverse of flatten_arrays, for arrays in an open .npz file"""
+    arrays = {}
+    start = f'{prefix}/'
+    for name in npz.files:
+        if not name.startswith(start):
+            continue
+        *keys, last = name[len(start):].split('/')
+        target = arrays
+        for key in keys:
+            target = target.setdefault(key, {})
+        target[last] = npz[name]
+
+    def restore(value):
+        if not isinstance(value, dict):
+            return value
+        if 'csr_data' in value:
+            return sparse.csr_matrix((value['csr_data'], value['csr_indices'], value['csr_indptr']),
+                                     shape=tuple(value['csr_shape']))
+        return {key: restore(item) for key, item in value.items()}
+
+    return restore(arrays)
+
+
+def save_npz(filename, arrays, metadata):
+    """saves arrays (see flatten_arrays) and metadata (a dict that can be written as JSON)"""
+    metadata = dict(metadata, format_version=FORMAT_VERSION)
+    np.savez(filename, metadata=np.asarray(json.dumps(to_json_value(metadata))), **arrays)
+
+
+def load_npz(filename):
+    """loads a file written by save_npz
+
+    Returns
+    -------
+    npz : numpy.lib.npyio.NpzFile
+        open file, to pass to unflatten_arrays. Should be closed after use.
+    metadata : dict
+    """
+    npz = np.load(filename, allow_pickle=False)
+    metadata = json.loads(str(npz['metadata']))
+    if metadata.get('format_version') != FORMAT_VERSION:
+        npz.close()
+        raise ValueError(f'{filename} was saved with format version '
+                         f'{metadata.get("format_version")}, expected {FORMAT_VERSION}')
+    return npz, metadata
@@ -1,12 +1,43 @@
 # module to calculate descriptive statistics of label sequences
 
-import re
-from collections import defaultdict
-
 import numpy as np
 
+from .encoding import encode_strings, decode_ngram_keys
+from .ngram_index import NgramIndex
+
+
+def repeat_counts(flat, offsets, num_labels):
+    """histogram of run lengths of each label in encoded sequences,
+    from one pass over the runs. Runs never continue from one sequence into the next.
+
+    Parameters
+    ----------
+    flat, offsets : ndarray
+        encoded sequences, as returned by encoding.encode_strings
+        or encoding.flatten_sequences, or from a corpus opened with corpus.open_corpus
+    num_labels : int
+        number of labels. Codes >= num_labels are not labels, and are skipped.
+
+    Returns
+    -------
+    counts : ndarray
+        num_labels x (length of longest run + 1), where element i,k is the
+        number of runs of exactly k consecutive label i
+    """
+    new_run = np.ones(flat.shape[0], dtype=bool)
+    new_run[1:] = flat[1:] != flat[:-1]
+    new_run[offsets[:-1][offsets[:-1] < flat.shape[0]]] = True
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_starts, flat.shape[0]))
+    run_labels = flat[run_starts].astype(np.int64)
+    is_label = run_labels < num_labels
+    max_run = run_lengths.max(initial=1)
+    counts = np.bincount(run_labels[is_label] * (max_run + 1) + run_lengths[is_label],
+                         minlength=num_labels * (max_run + 1))
+    return counts.reshape(num_labels, max_run + 1)
 
-def get_repeat_distribs(sequences, labels):
+
+def get_repeat_distribs(sequences, labels, return_strings=True):
     """gets distribution of repeats from a list of sequences,
     for each label in labelset
 
@@ -17,31 +48,41 @@ def get_repeat_distribs(sequences, labels):
     labels : str
         each label for which repeat distribution should be computed
         e.g. 'abcdefghjki' will return distributions for a, b, ..., i
+    return_strings : bool
+        if True, also return each repeat length as a string of repeats,
+        e.g. 'aaaa' for 4. Default is True.
 
     Returns
     -------
     distribs : dict
         where keys are labels and values are:
-            unique_repeats : ndarray
-                unique strings of repeats that occur,
-                e.g., array(['a', 'aa', 'aaaa', 'aaaaaa'])
+            run_lengths : ndarray
+                unique numbers of repeats that occur, 2 or more,
+                e.g., array([2, 4, 6])
             counts : ndarray
-                counts for each unique string of repeats in unique_repeats
-                e.g., array([2000, 1000, 59, 4])
+                counts for each number of repeats in run_lengths
+                e.g., array([1000, 59, 4])
+            unique_repeats : ndarray
+                unique strings of repeats that occur, only if return_strings is True
+                e.g., array(['aa', 'aaaa', 'aaaaaa'])
     """
-    # can just concatenate into one string, as long as S and E are at beginning and end
-    seqs_concat = ''.join(sequences)
+    # start and end characters are not labels, so they end runs like bout boundaries do
+    flat, offsets = encode_strings(sequences, labels, startchar='', endchar='')
+    return repeat_distribs_from_counts(labels, repeat_counts(flat, offsets, len(labels)),
+                                       return_strings)
+
+
+def repeat_distribs_from_counts(labels, counts, return_strings=True):
+    """distributions of repeats, as returned by get_repeat_distribs,
+    from run length counts as returned by repeat_counts"""
     distribs = {}
-    for label in labels:
-        pattern = '' + label + '{2,}'
-        seq_search = re.findall(pattern, seqs_concat)
-        unique_repeats, counts = np.unique(seq_search, return_counts=True)
-        if unique_repeats.shape[0] == 1 and unique_repeats[0] == label:
-            # i.e., if not actually a repeating syllable
-            continue
-        else:
-            distribs[label] = {'unique_repeats': unique_repeats,
-                               'counts': counts}
+    for label, label_counts in zip(labels, counts):
+        run_lengths = np.flatnonzero(label_counts[2:]) + 2
+        distribs[label] = {'run_lengths': run_lengths,
+                           'counts': label_counts[run_lengths]}
+        if return_strings:
+            distribs[label]['unique_repeats'] = np.asarray(
+                [label * run_length for run_length in run_lengths], dtype=str)
     return distribs
 
 
@@ -50,9 +91,13 @@ def switch_key_val(i):
 
 
 def get_ngram_distribs(sequences, labelset, n_range=range(2, 8),
-                       startchar='S', endchar='E', real_ngram_distribs=None):
+                       startchar='S', endchar='E', real_ngram_distribs=None,
+                       ngram_index=None):
     """get distributions of ngrams
 
+    Sequences are encoded as integers once, and all n-grams up to max(n_range)
+    are counted from one sorted index, see ngram_index.NgramIndex.
+
     Parameters
     ----------
     sequences : list
@@ -71,6 +116,10 @@ def get_ngram_distribs(sequences, labelset, n_range=range(2, 8),
         If provided, the function counts only the ngrams in sequences that
         occur in real_ngram_distribs.
         If None, the function counts all ngrams in sequences.
+    ngram_index : ngram_index.NgramIndex
+        index already built from sequences, e.g. loaded with NgramIndex.load.
+        If provided, sequences and labelset are ignored, and the index is used
+        instead of building a new one. Default is None.
 
     Returns
     -------
@@ -83,49 +132,85 @@ def get_ngram_distribs(sequences, labelset, n_range=range(2, 8),
             distrib : ndarray
                 counts, normalized by total number of ngrams of size n
     """
-    labelset = set(labelset)
-    labelset -= {startchar, }
-    labelset -= {endchar, }
+    if ngram_index is None:
+        labels = set(labelset) - {startchar, endchar}
+        if real_ngram_distribs:
+            # n-grams from real data can only match n-grams made of the same characters
+            for n in n_range:
+                for ngram, _ in real_ngram_distribs[n]['counts']:
+                    labels.update(ngram)
+        ngram_index = NgramIndex.from_strings(sequences, sorted(labels), max(n_range),
+                                              startchar, endchar)
 
     distribs = {}
     for n in n_range:
-
         if real_ngram_distribs:
-            ngrams_to_find = [ngram
-                              for ngram, count in real_ngram_distribs[n]['counts']]
-            ngram_dict = dict(zip(ngrams_to_find,
-                                  [0] * len(ngrams_to_find)))
+            # used when calculating ngram distribs for
+            # sequences generated by model
+            # and already have ngrams from data
+            ngrams = [ngram for ngram, count in real_ngram_distribs[n]['counts']]
+            ngram_counts = ngram_index.count_many(ngrams)
         else:
-            ngrams_to_find = None
-            ngram_dict = defaultdict(int)
-
-        for sequence in sequences:
-            for ind in range(len(sequence) - (n - 1)):
-                ngram = sequence[ind:ind + n]
-                if ngrams_to_find:
-                    # used when calculating ngram distribs for
-                    # sequences generated by model
-                    # and already have ngrams from data
-                    if ngram in ngrams_to_find:
-                        ngram_dict[ngram] += 1
-                else:
-                    # if ngrams_to_find is None, compute distribs
-                    # for all ngrams found, as long as 
-                    # all characters in ngram are in labelset
-                    if set(ngram) < labelset:
-                        # if all chars in ngram are in labelset
-                        ngram_dict[ngram] += 1
-
-        counts = sorted(ngram_dict.items(), key=switch_key_val, reverse=True)
-        counts_list = [tupl[1] for tupl in counts]
-        distrib = np.asarray(counts_list) / sum(counts_list)
-
-        distribs[n] = {'counts': counts,
-                       'distrib': distrib}
+            # compute distribs for all ngrams found,
+            # as long as all characters in ngram are in labelset
+            keys, ngram_counts = ngram_index.counts(n)
+            ngrams = decode_ngram_keys(keys, n, ngram_index.labels)
+
+        distribs[n] = ngram_distrib(ngrams, ngram_counts)
     return distribs
 
 
-def get_step_prob(sequences, labelset, startchar='S', endchar='E'):
+def ngram_distrib(ngrams, ngram_counts):
+    """distribution of n-grams of one size n, as returned by get_ngram_distribs,
+    from a list of n-grams and the count of each
+
+    Returns
+    -------
+    distrib : dict
+        with keys 'counts' and 'distrib', see get_ngram_distribs
+    """
+    # same order as sorting (ngram, count) tuples by count then ngram, descending
+    order = np.lexsort((np.asarray(ngrams, dtype=str), ngram_counts))[::-1]
+    counts_list = np.asarray(ngram_counts)[order].tolist()
+    counts = [(ngrams[ind], count) for ind, count in zip(order, counts_list)]
+    distrib = np.asarray(counts_list) / sum(counts_list)
+    return {'counts': counts,
+            'distrib': distrib}
+
+
+def step_counts(flat, offsets, num_labels, max_steps=None):
+    """number of times each label occurs at each step of encoded sequences
+
+    Parameters
+    ----------
+    flat, offsets : ndarray
+        encoded sequences, as returned by encoding.encode_strings
+        or encoding.flatten_sequences, or from a corpus opened with corpus.open_corpus
+    num_labels : int
+        number of labels. Codes >= num_labels are not labels, and are skipped.
+    max_steps : int
+        number of steps to count. Default is None, in which case
+        steps up to the end of the longest sequence are counted.
+
+    Returns
+    -------
+    counts : ndarray
+        num_labels x number of steps, where element i,j is the number of
+        sequences with label i at step j
+    """
+    lengths = np.diff(offsets)
+    if max_steps is None:
+        max_steps = int(lengths.max()) if lengths.size else 0
+    seq_starts = np.repeat(offsets[:-1], lengths)
+    steps = np.arange(flat.shape[0]) - seq_starts
+    counted = (flat < num_labels) & (steps < max_steps)
+    counts = np.bincount(flat[counted].astype(np.int64) * max_steps + steps[counted],
+                         minlength=num_labels * max_steps)
+    return counts.reshape(num_labels, max_steps)
+
+
+def get_step_prob(sequences, labelset, startchar='S', endchar='E', max_steps=None,
+                  as_matrix=False):
     """get probability of a given syllable occurring at each step in a sequence
     Parameters
     ----------
@@ -140,6 +225,15 @@ def get_step_prob(sequences, labelset, startchar='S', endchar='E'):
     endchar : str
         character that indicates end of bout, default is 'E'.  Needed
         to ensure these characters aren't counted as part of n-grams.    
+    max_steps : int
+        number of steps to compute probabilities for, e.g. m_compare.
+        Default is None, in which case every step up to the
+        length of the longest sequence is used. Setting max_steps keeps
+        a few very long bouts from making the arrays returned very long.
+        Probabilities are then normalized over the first max_steps steps.
+    as_matrix : bool
+        if True, return a matrix with one row per label
+        instead of a dict. Default is False.
 
     Returns
     -------
@@ -147,21 +241,28 @@ def get_step_prob(sequences, labelset, startchar='S', endchar='E'):
         where each key is a label from labelset
         and the value is a vector with length equal to the longest sequences
             and each element is the probability of the label occuring at that
-            step across seoquences
+            step across seoquences.
+            Labels that never occur have a vector of zeros.
+    If as_matrix is True, instead returns:
+    labels : str
+        label of each row of step_probs
+    step_probs : ndarray
+        number of labels x number of steps
     """
-    labelset = set(labelset) - set(startchar)
-    seq_lengths = [len(seq) for seq in sequences]
-    max_length = np.max(seq_lengths)
-    step_probs = {}
-    for label in labelset:
-        step_probs[label] = np.zeros((max_length,))
-
-    for sequence in sequences:
-        for ind, label in enumerate(sequence):
-            if label in step_probs:
-                step_probs[label][ind] += 1
-
-    for label in step_probs.keys():
-        step_probs[label] = step_probs[label] / step_probs[label].sum()
-
-    return step_probs
\ No newline at end of file
+    labels = ''.join(sorted(set(labelset) - set(startchar)))
+    if max_steps is None:
+        max_steps = max(len(seq) for seq in sequences)
+    # start characters are not stripped, so that steps are counted
+    # from the start of each str; they are not labels so they are not counted
+    flat, offsets = encode_strings(sequences, labels, startchar='', endchar='')
+    step_probs = step_probs_from_counts(step_counts(flat, offsets, len(labels), max_steps))
+    if as_matrix:
+        return labels, step_probs
+    return dict(zip(labels, step_probs))
+
+
+def step_probs_from_counts(counts):
+    """normalizes counts returned by step_counts into probabilities over steps,
+    leaving rows of labels that never occur as zeros"""
+    totals = counts.sum(axis=1, keepdims=True)
+    return np.divide(counts, totals, out=np.zeros(counts.shape), where=totals > 0)
@@ -0,0 +1,178 @@
+# functions to update a fit state model with new sequences,
+# without deriving the model again from all sequences
+
+import numpy as np
+from scipy import sparse
+
+from .baum_welch import (END_STATE, allowed_transitions, allowed_repeats, dense_trans,
+                         smooth_state_model, sparse_state_model, e_step, m_step,
+                         param_change)
+
+
+def _add_counts(old, new):
+    """sum of two count arrays, sparse if either is sparse"""
+    if sparse.issparse(old) or sparse.issparse(new):
+        return sparse.csr_matrix(old) + sparse.csr_matrix(new)
+    return old + new
+
+
+def sufficient_stats(state_model, batches):
+    """expected counts of sequences under a state model. Because counts add up,
+    these are all that is needed to re-estimate probabilities later
+    without going back to the sequences, see warm_em.
+
+    Returns
+    -------
+    stats : dict
+        with keys 'trans_counts', 'repeat_counts', 'visit_counts',
+        as returned by baum_welch.e_step
+    """
+    trans_counts, repeat_counts, visit_counts, _ = e_step(state_model, batches)
+    return {'trans_counts': trans_counts,
+            'repeat_counts': repeat_counts,
+            'visit_counts': visit_counts}
+
+
+def extend_state_model(state_model, stats, max_repeats, num_states_per_symbol):
+    """adds states for new symbols, and allows more repeats for symbols
+    that now repeat more, keeping every existing state where it is.
+
+    New states go after existing states, so sufficient statistics of the
+    existing states stay valid and are only padded with zeros.
+    Probabilities that were not allowed before start out uniform and
+    mixed into existing ones with baum_welch.smooth_state_model, so E-M can
+    learn them. If nothing new is needed, the state model is returned unchanged.
+    If state_model stores transitions as a sparse matrix, so does the extended model.
+
+    Parameters
+    ----------
+    state_model : dict
+        as returned by derive_initial_state_model
+    stats : dict
+        as returned by sufficient_stats
+    max_repeats : dict
+        where each key is a mapped symbol and the corresponding value is
+        the maximum number of consecutive repeats of that symbol, over old and new sequences
+    num_states_per_symbol : int
+        number of states to add for each new symbol
+
+    Returns
+    -------
+    state_model : dict
+    stats : dict
+    extended : bool
+        True if any state was added or any symbol can now repeat more
+    """
+    state_symbols = np.asarray(state_model['state_symbols'])
+    max_repeat_nums = np.asarray(state_model['max_repeat_nums']).copy()
+    emitting = np.arange(state_symbols.shape[0]) > END_STATE
+
+    known = set(state_symbols[emitting].tolist())
+    new_symbols = sorted(symbol for symbol in max_repeats if symbol not in known)
+    for symbol in known:
+        is_symbol = emitting & (state_symbols == symbol)
+        max_repeat_nums[is_symbol] = np.maximum(max_repeat_nums[is_symbol], max_repeats[symbol])
+    repeats_changed = np.flatnonzero(max_repeat_nums != state_model['max_repeat_nums'])
+    if not new_symbols and not repeats_changed.size:
+        return state_model, stats, False
+
+    num_old = state_symbols.shape[0]
+    new_states = np.repeat(np.asarray(new_symbols, dtype=state_symbols.dtype),
+                           num_states_per_symbol)
+    state_symbols = np.concatenate((state_symbols, new_states))
+    max_repeat_nums = np.concatenate((max_repeat_nums,
+                                      [max_repeats[symbol] for symbol in new_states]))
+    max_repeat_nums = max_repeat_nums.astype(state_model['max_repeat_nums'].dtype)
+    num_states = state_symbols.shape[0]
+    max_repeat = max(max_repeat_nums.max(), 1)
+
+    def pad(mat, shape):
+        if sparse.issparse(mat):
+            padded = sparse.csr_matrix(mat, copy=True)
+            padded.resize(shape)
+            return padded
+        padded = np.zeros(shape)
+        padded[:mat.shape[0], :mat.shape[1]] = mat
+        return padded
+
+    trans = pad(dense_trans(state_model['trans']), (num_states, num_states))
+    # rows of new states start out uniform over allowed transitions
+    allowed = allowed_transitions(num_states)
+    trans[num_old:] = allowed[num_old:] / allowed[num_old:].sum(axis=1, keepdims=True)
+    repeat_probs = pad(state_model['repeat_probs'], (num_states, max_repeat))
+    # repeats that were not allowed before start out at 0.5
+    old_allowed = pad(allowed_repeats(state_model['max_repeat_nums'],
+                                      state_model['repeat_probs'].shape[1]),
+                      (num_states, max_repeat)).astype(bool)
+    new_allowed = allowed_repeats(max_repeat_nums, max_repeat) & ~old_allowed
+    repeat_probs[new_allowed] = 0.5
+
+    extended_model = dict(state_model,
+                          state_symbols=state_symbols,
+                          max_repeat_nums=max_repeat_nums,
+                          trans=trans,
+                          repeat_probs=repeat_probs)
+    extended_model = smooth_state_model(extended_model)
+    if sparse.issparse(state_model['trans']):
+        extended_model = sparse_state_model(extended_model)
+    extended_stats = {
+        'trans_counts': pad(stats['trans_counts'], (num_states, num_states)),
+        'repeat_counts': pad(stats['repeat_counts'], (num_states, max_repeat)),
+        'visit_counts': pad(stats['visit_counts'], (num_states, max_repeat)),
+    }
+    return extended_model, extended_stats, True
+
+
+def warm_em(state_model, batches, stats, tolerance=1e-3, max_steps=10000,
+            prob_small=1e-3, decay=1.):
+    """fits a state model to new sequences with E-M, starting from the model
+    fit to old sequences, and adding the sufficient statistics of the old
+    sequences to the expected counts of the new ones at every M-step.
+
+    The old statistics are not re-computed under the new model,
+    so this is an approximation to fitting all sequences again,
+    that only needs to go through the new sequences.
+
+    Parameters
+    ----------
+    state_model : dict
+        state model fit to old sequences, e.g. as returned by extend_state_model
+    batches : list
+        new sequences, as returned by baum_welch.make_run_batches
+    stats : dict
+        sufficient statistics of old sequences, as returned by sufficient_stats
+    tolerance, max_steps, prob_small :
+        as for baum_welch.fit_em
+    decay : float
+        weight of old statistics, between 0 and 1. Default is 1.,
+        where old and new sequences count the same. Values less than 1
+        let the model follow recent sequences, e.g. over development.
+
+    Returns
+    -------
+    state_model : dict
+        state model fit to old and new sequences
+    log_likelihood : float
+        log-likelihood of new sequences under the state model returned
+    num_steps : int
+        number of E-M steps taken
+    stats : dict
+        sufficient statistics of old and new sequences
+    """
+    old_counts = [decay * stats['trans_counts'],
+                  decay * stats['repeat_counts'],
+                  decay * stats['visit_counts']]
+    num_steps = 0
+    for num_steps in range(1, max_steps + 1):
+        *new_counts, _ = e_step(state_model, batches)
+        new_state_model = m_step(state_model,
+                                 *map(_add_counts, old_counts, new_counts),
+                                 prob_small=prob_small)
+        change = param_change(state_model, new_state_model)
+        state_model = new_state_model
+        if change < tolerance:
+            break
+    *new_counts, log_likelihood = e_step(state_model, batches)
+    stats = dict(zip(('trans_counts', 'repeat_counts', 'visit_counts'),
+                     map(_add_counts, old_counts, new_counts)))
+    return state_model, log_likelihood, num_steps, stats
@@ -0,0 +1,242 @@
+# finds the most likely path through the states of a POMMA state model
+# for each sequence (the Viterbi path), e.g. to tell apart the states
+# that emit the same symbol
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from .baum_welch import kernel_tables, pair_edges
+
+
+def viterbi_tables(state_model):
+    """log probabilities of the tables returned by baum_welch.kernel_tables,
+    computed once per state model. If the state model stores transitions
+    as a sparse matrix, its edge lists are kept instead of dense blocks,
+    and viterbi_batch takes the max over the edges only."""
+    tables = kernel_tables(state_model)
+    with np.errstate(divide='ignore'):
+        log_tables = {
+            'symbol_states': tables['symbol_states'],
+            'log_start': np.log(tables['start_probs']),
+            'log_end': np.log(tables['end_probs']),
+            'log_empty': np.log(tables['empty_prob']),
+            'log_repeat': np.log(tables['repeat_probs']),
+            'log_exit': np.log(tables['exit_probs']),
+        }
+        if 'trans_blocks' in tables:
+            log_tables['log_blocks'] = np.log(tables['trans_blocks'])
+        else:
+            log_tables.update(edge_ptr=tables['edge_ptr'], edge_src=tables['edge_src'],
+                              edge_dst=tables['edge_dst'],
+                              log_edge_probs=np.log(tables['edge_probs']))
+    return log_tables
+
+
+def _enter_best(tables, leave_best, cur, nxt):
+    """log probability of the best slot to come from when entering each slot
+    of symbols nxt, from leave_best, the best log probabilities of leaving each
+    slot of symbols cur, and that slot. Ties go to the lowest slot."""
+    if 'log_blocks' in tables:
+        enter = leave_best[:, :, np.newaxis] + tables['log_blocks'][cur, nxt]
+        enter_slots = enter.argmax(axis=1)
+        return np.take_along_axis(enter, enter_slots[:, np.newaxis, :], axis=1)[:, 0], enter_slots
+    num_rows, num_slots = leave_best.shape
+    enter_best = np.full(num_rows * num_slots, -np.inf)
+    enter_slots = np.zeros(num_rows * num_slots, dtype=np.intp)
+    rows, edges = pair_edges(tables, cur, nxt)
+    if edges.size:
+        src = tables['edge_src'][edges]
+        values = leave_best[rows, src] + tables['log_edge_probs'][edges]
+        # edges of each symbol pair are sorted by destination, then source slot,
+        # so keys are sorted and each group's first maximum has the lowest source slot
+        keys = rows * num_slots + tables['edge_dst'][edges]
+        group_keys, group_starts, group_of = np.unique(keys, return_index=True,
+                                                       return_inverse=True)
+        best = np.maximum.reduceat(values, group_starts)
+        is_best = np.flatnonzero(values == best[group_of])
+        _, first_best = np.unique(keys[is_best], return_index=True)
+        enter_best[group_keys] = best
+        enter_slots[group_keys] = src[is_best[first_best]]
+    return enter_best.reshape((num_rows, num_slots)), enter_slots.reshape((num_rows, num_slots))
+
+
+def viterbi_batch(tables, padded, lengths):
+    """most likely path through states for one batch of sequences,
+    sorted by decreasing length, so the sequences still "alive" at any step
+    are the first rows.
+
+    At each step, only states of the symbol observed can be occupied, so the
+    dynamic programming is over (slot, number of repeats) pairs of that symbol,
+    as in baum_welch.forward. A path only stays in the same slot by repeating,
+    so back pointers are only needed when a path enters a slot.
+
+    Parameters
+    ----------
+    tables : dict
+        as returned by viterbi_tables
+    padded, lengths : ndarray
+        as returned by baum_welch.pad_sequences, sorted by decreasing length
+
+    Returns
+    -------
+    states : ndarray
+        num_sequences x max length, state of each step, -1 after the end
+        of each sequence and for sequences that are impossible under the model
+    log_probs : ndarray
+        log probability of the most likely path of each sequence, -inf for
+        sequences that are impossible under the model
+    """
+    log_repeat = tables['log_repeat']
+    log_exit = tables['log_exit']
+    num_seqs, max_length = padded.shape
+    _, num_slots, max_repeat = log_repeat.shape
+    rows = np.arange(num_seqs)
+
+    # number of repeats before each step can be at most its position in the run
+    # of the same symbol, so only that many columns of repeats are kept
+    steps = np.arange(max_length)
+    run_starts = np.ones(padded.shape, dtype=bool)
+    run_starts[:, 1:] = padded[:, 1:] != padded[:, :-1]
+    run_positions = steps - np.maximum.accumulate(np.where(run_starts, steps, 0), axis=1)
+    run_positions[steps >= lengths[:, np.newaxis]] = 0
+    widths = np.minimum(run_positions.max(axis=0) + 1, max_repeat)
+
+    # back pointers, as slot * max_repeat + repeats of the step before
+    back_pointers = []
+    end_slots = np.zeros(num_seqs, dtype=np.intp)
+    end_repeats = np.zeros(num_seqs, dtype=np.intp)
+    log_probs = np.full(num_seqs, -np.inf)
+
+    delta = tables['log_start'][padded[:, 0], :, np.newaxis]
+    for t in range(max_length):
+        num_live = np.count_nonzero(lengths > t)
+        num_next = np.count_nonzero(lengths > t + 1)
+        width = widths[t]
+        cur = padded[:num_live, t]
+        leave = delta[:num_live] + log_exit[cur, :, :width]
+        if num_next < num_live:
+            # sequences that end after this step
+            to_end = (leave[num_next:] + tables['log_end'][cur[num_next:], :, np.newaxis])
+            to_end = to_end.reshape(num_live - num_next, -1)
+            flat_best = to_end.argmax(axis=1)
+            ending = rows[num_next:num_live]
+            log_probs[ending] = to_end[np.arange(num_live - num_next), flat_best]
+            end_slots[ending], end_repeats[ending] = np.divmod(flat_best, width)
+        if not num_next:
+            break
+
+        nxt = padded[:num_next, t + 1]
+        leave = leave[:num_next]
+        leave_repeats = leave.argmax(axis=2)
+        leave_best = np.take_along_axis(leave, leave_repeats[:, :, np.newaxis], axis=2)[:, :, 0]
+        enter_best, enter_slots = _enter_best(tables, leave_best, cur[:num_next], nxt)
+        back_pointers.append(enter_slots * max_repeat
+                             + np.take_along_axis(leave_repeats, enter_slots, axis=1))
+
+        next_width = widths[t + 1]
+        next_delta = np.full((num_next, num_slots, next_width), -np.inf)
+        next_delta[:, :, 0] = enter_best
+        same = np.flatnonzero(nxt == cur[:num_next])
+        next_delta[same, :, 1:] = (delta[same, :, :next_width - 1]
+                                   + log_repeat[cur[same], :, :next_width - 1])
+        delta = next_delta
+
+    slots = np.zeros((num_seqs, max_length), dtype=np.intp)
+    slot = end_slots.copy()
+    repeats = end_repeats.copy()
+    for t in range(max_length - 1, -1, -1):
+        num_live = np.count_nonzero(lengths > t)
+        num_next = np.count_nonzero(lengths > t + 1)
+        slot[num_next:num_live] = end_slots[num_next:num_live]
+        repeats[num_next:num_live] = end_repeats[num_next:num_live]
+        slots[:num_live, t] = slot[:num_live]
+        if t == 0:
+            break
+        entered = np.flatnonzero(repeats[:num_live] == 0)
+        repeats[:num_live] -= 1
+        pointers = back_pointers[t - 1][entered, slot[entered]]
+        slot[entered], repeats[entered] = np.divmod(pointers, max_repeat)
+
+    states = tables['symbol_states'][padded, slots]
+    states[np.arange(max_length) >= lengths[:, np.newaxis]] = -1
+    states[np.isneginf(log_probs)] = -1
+    return states, log_probs
+
+
+def _decode_batch(tables, flat, offsets, inds):
+    lengths = np.diff(offsets)[inds]
+    mask = np.arange(lengths.max()) < lengths[:, np.newaxis]
+    positions = (offsets[inds][:, np.newaxis] + np.arange(mask.shape[1]))[mask]
+    padded = np.zeros(mask.shape, dtype=np.intp)
+    padded[mask] = flat[positions]
+    states, log_probs = viterbi_batch(tables, padded, lengths)
+    return positions, states[mask], log_probs
+
+
+def viterbi(state_model, flat, offsets, batch_size=256, n_jobs=1, tables=None):
+    """most likely path through the states of a state model
+    for each of many encoded sequences
+
+    Parameters
+    ----------
+    state_model : dict
+        as returned by init_state_model or fit_em, with dense or sparse transitions
+    flat, offsets : ndarray
+        sequences of symbols mapped to int, e.g. as returned by
+        encoding.flatten_sequences, or from a corpus opened with corpus.open_corpus
+    batch_size : int
+        number of sequences decoded at once. Default is 256.
+    n_jobs : int
+        Number of threads that batches are spread over. Default is 1.
+        If -1, use all CPUs.
+    tables : dict
+        as returned by viterbi_tables. Default is None,
+        in which case they are computed from state_model.
+
+    Returns
+    -------
+    flat_states : ndarray
+        state of each symbol of each sequence, in the same layout as flat.
+        -1 for every symbol of sequences that are impossible under the model,
+        including sequences with symbols that no state emits.
+    offsets : ndarray
+        same as offsets passed in
+    log_probs : ndarray
+        log probability of the most likely path of each sequence,
+        -inf for sequences that are impossible under the model
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    offsets = np.asarray(offsets)
+    if tables is None:
+        tables = viterbi_tables(state_model)
+    num_symbols = tables['symbol_states'].shape[0]
+    num_states = np.asarray(state_model['state_symbols']).shape[0]
+    lengths = np.diff(offsets)
+
+    flat = np.asarray(flat).astype(np.intp)
+    unknown = (flat < 0) | (flat >= num_symbols)
+    seq_of = np.repeat(np.arange(lengths.shape[0]), lengths)
+    has_unknown = np.bincount(seq_of[unknown], minlength=lengths.shape[0]) > 0
+    flat[unknown] = 0
+
+    flat_states = np.full(flat.shape[0], -1, dtype=np.min_scalar_type(-num_states))
+    log_probs = np.full(lengths.shape[0], -np.inf)
+    # a sequence with no symbols goes straight from the start state to the end state
+    log_probs[lengths == 0] = tables['log_empty']
+    decoded = np.flatnonzero((lengths > 0) & ~has_unknown)
+    order = decoded[np.argsort(-lengths[decoded], kind='stable')]
+    chunks = [order[start:start + batch_size] for start in range(0, order.shape[0], batch_size)]
+    decode = partial(_decode_batch, tables, flat, offsets)
+    if n_jobs == 1 or len(chunks) < 2:
+        results = map(decode, chunks)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(decode, chunks))
+    for inds, (positions, states, batch_log_probs) in zip(chunks, results):
+        flat_states[positions] = states
+        log_probs[inds] = batch_log_probs
+    return flat_states, offsets, log_probs
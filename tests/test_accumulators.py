@@ -0,0 +1,87 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from pomma.accumulators import (_Accumulator, NgramAccumulator, StepProbAccumulator,
+                                RepeatAccumulator)
+from pomma.statistics import get_ngram_distribs, get_repeat_distribs, get_step_prob
+
+SEQUENCES = [
+    'SaabcbbbcE',
+    'SabcaabcE',
+    'SbbbcaE',
+    'SaabbcbbbbcE',
+]
+LABELSET = 'SabcE'
+
+
+def chunks(sequences, chunk_size=1):
+    for start in range(0, len(sequences), chunk_size):
+        yield sequences[start:start + chunk_size]
+
+
+def assert_ngram_distribs_equal(distribs, expected):
+    assert distribs.keys() == expected.keys()
+    for n in expected:
+        assert distribs[n]['counts'] == expected[n]['counts']
+        assert np.allclose(distribs[n]['distrib'], expected[n]['distrib'], equal_nan=True)
+
+
+def test_ngram_accumulator():
+    expected = get_ngram_distribs(SEQUENCES, LABELSET, n_range=range(2, 5))
+    accumulator = NgramAccumulator(LABELSET, n_range=range(2, 5)).update_from(chunks(SEQUENCES))
+    assert accumulator.num_seq == 4
+    assert_ngram_distribs_equal(accumulator.finalize(), expected)
+
+    # none of the 4-grams from real data occur, so their distrib is NaN
+    generated = ['SaaaaE', 'ScccE', 'SabE']
+    expected_generated = get_ngram_distribs(generated, LABELSET, n_range=range(2, 5),
+                                            real_ngram_distribs=expected)
+    accumulator = NgramAccumulator(LABELSET, n_range=range(2, 5), real_ngram_distribs=expected)
+    accumulator.update_from(chunks(generated))
+    assert_ngram_distribs_equal(accumulator.finalize(), expected_generated)
+
+
+def test_merge():
+    # accumulators from worker processes are pickled back to the main process
+    first = pickle.loads(pickle.dumps(NgramAccumulator(LABELSET).update(SEQUENCES[:2])))
+    second = NgramAccumulator(LABELSET).update(SEQUENCES[2:])
+    assert_ngram_distribs_equal(first.merge(second).finalize(),
+                                get_ngram_distribs(SEQUENCES, LABELSET))
+
+    first = StepProbAccumulator(LABELSET).update(SEQUENCES[:2])
+    second = StepProbAccumulator(LABELSET).update(SEQUENCES[2:])
+    labels, step_probs = first.merge(second).finalize(as_matrix=True)
+    expected_labels, expected = get_step_prob(SEQUENCES, LABELSET, as_matrix=True)
+    assert labels == expected_labels
+    assert np.allclose(step_probs, expected)
+
+    first = RepeatAccumulator('abc').update(SEQUENCES[:2])
+    second = RepeatAccumulator('abc').update(SEQUENCES[2:])
+    distribs = first.merge(second).finalize()
+    for label, distrib in get_repeat_distribs(SEQUENCES, 'abc').items():
+        for key, value in distrib.items():
+            assert np.array_equal(distribs[label][key], value)
+
+    with pytest.raises(ValueError):
+        RepeatAccumulator('abc').merge(RepeatAccumulator('ab'))
+
+
+def test_step_prob_accumulator_max_steps():
+    accumulator = StepProbAccumulator(LABELSET, max_steps=3).update_from(chunks(SEQUENCES, 3))
+    step_probs = accumulator.finalize()
+    expected = get_step_prob(SEQUENCES, LABELSET, max_steps=3)
+    assert all(np.allclose(step_probs[label], expected[label]) for label in expected)
+
+
+def test_accumulator_missing_hook():
+    class NoMerge(_Accumulator):
+        def _config(self):
+            return ()
+
+        def _update(self, sequences):
+            pass
+
+    with pytest.raises(TypeError):
+        NoMerge()
@@ -0,0 +1,74 @@
+import csv
+import os
+
+import numpy as np
+
+from pomma.batch import fit_birds, find_corpora
+from pomma.corpus import write_corpus, FLAT_FILENAME
+from pomma.first_order_markov import generate_sequences
+from pomma.pommafitter import POMMAfitter
+
+PARAMS = dict(max_extra_states=1, num_random_starts=2, max_steps=30, num_boot=10,
+              num_seq=100, seed=0)
+
+
+def make_corpora(corpora_dir):
+    trans_mat = np.array([[0., .6, .4, 0., 0.],
+                          [0., .5, .3, .2, 0.],
+                          [0., .2, .3, .3, .2],
+                          [0., .1, .3, 0., .6]])
+    for bird_ID, num in (('bird_a', 40), ('bird_b', 20)):
+        sequences = generate_sequences(trans_mat, 'SabcE', num=num, seed=num)
+        write_corpus(os.path.join(corpora_dir, bird_ID), [seq for seq in sequences if seq])
+
+
+def test_find_corpora_registry(tmp_path):
+    corpus_dir = str(tmp_path / 'corpora')
+    assert find_corpora(corpus_dir=corpus_dir) == {
+        'bl26lb16': os.path.join(corpus_dir, 'bl26lb16')}
+    assert os.path.isfile(os.path.join(corpus_dir, 'bl26lb16', FLAT_FILENAME))
+
+
+def test_fit_birds(tmp_path):
+    corpora_dir = tmp_path / 'corpora'
+    make_corpora(str(corpora_dir))
+    assert list(find_corpora(str(corpora_dir))) == ['bird_a', 'bird_b']
+
+    output_dir = str(tmp_path / 'output')
+    rows = fit_birds(output_dir, str(corpora_dir), **PARAMS)
+    assert [row['bird_ID'] for row in rows] == ['bird_a', 'bird_b']
+    assert all(row['status'] == 'done' for row in rows)
+    with open(os.path.join(output_dir, 'summary.csv')) as fp:
+        table = list(csv.DictReader(fp))
+    assert [row['bird_ID'] for row in table] == ['bird_a', 'bird_b']
+
+    fitter = POMMAfitter.load(os.path.join(output_dir, 'bird_a', 'model.npz'))
+    assert fitter.error_bounds is not None and fitter.res_diff is not None
+    assert np.isclose(fitter.initial_state_model['log_likelihood'], rows[0]['log_likelihood'])
+
+    # as if the run crashed after fitting bird_b, before comparing statistics
+    os.remove(os.path.join(output_dir, 'bird_b', 'summary.json'))
+    fit_time = os.path.getmtime(os.path.join(output_dir, 'bird_b', 'fit.npz'))
+    resumed = fit_birds(output_dir, str(corpora_dir), **PARAMS)
+    assert os.path.getmtime(os.path.join(output_dir, 'bird_b', 'fit.npz')) == fit_time
+    assert resumed[1]['log_likelihood'] == rows[1]['log_likelihood']
+    assert resumed[0] == rows[0]
+
+
+def test_fit_birds_pool_with_failing_bird(tmp_path):
+    corpora_dir = tmp_path / 'corpora'
+    make_corpora(str(corpora_dir))
+    # a corpus that cannot be read, e.g. one whose conversion was cut short
+    os.makedirs(corpora_dir / 'bird_c')
+    (corpora_dir / 'bird_c' / FLAT_FILENAME).write_bytes(b'not a numpy file')
+
+    output_dir = str(tmp_path / 'output')
+    rows = fit_birds(output_dir, str(corpora_dir), n_jobs=2, **PARAMS)
+    assert [row['bird_ID'] for row in rows] == ['bird_a', 'bird_b', 'bird_c']
+    assert [row['status'] for row in rows] == ['done', 'done', 'failed']
+    assert rows[2]['error']
+    assert os.path.isfile(os.path.join(output_dir, 'bird_a', 'model.npz'))
+    assert not os.path.isfile(os.path.join(output_dir, 'bird_c', 'summary.json'))
+    with open(os.path.join(output_dir, 'summary.csv')) as fp:
+        table = list(csv.DictReader(fp))
+    assert [row['status'] for row in table] == ['done', 'done', 'failed']
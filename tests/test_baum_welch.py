@@ -0,0 +1,162 @@
+import itertools
+
+import numpy as np
+import scipy.sparse
+
+from pomma.baum_welch import (init_state_model, make_batches, make_run_batches, kernel_tables,
+                              forward, log_likelihoods, e_step, m_step, fit_em,
+                              sequence_log_likelihoods, sparse_state_model, drop_small)
+
+STATE_SYMBOLS = [1000, 1001, 0, 0, 1, 1, 2]
+MAX_REPEAT_NUMS = [0, 0, 3, 3, 1, 1, 2]
+
+SEQS_MAPPED = [
+    [0, 0, 1, 2, 2],
+    [0, 1],
+    [2, 2, 0, 0, 0, 1],
+    [1, 0, 0, 2],
+]
+
+
+def brute_force_likelihood(state_model, seq):
+    """sums probability of every path through states that emits seq"""
+    trans = state_model['trans']
+    repeat_probs = state_model['repeat_probs']
+    candidates = [[state for state, symbol in enumerate(STATE_SYMBOLS) if symbol == x]
+                  for x in seq]
+    total = 0.
+    for path in itertools.product(*candidates):
+        prob = trans[0, path[0]]
+        num_repeats = 0
+        for state, next_state in zip(path, path[1:]):
+            if state == next_state:
+                prob *= repeat_probs[state, num_repeats]
+                num_repeats += 1
+            else:
+                prob *= (1 - repeat_probs[state, num_repeats]) * trans[state, next_state]
+                num_repeats = 0
+        prob *= (1 - repeat_probs[path[-1], num_repeats]) * trans[path[-1], 1]
+        total += prob
+    return total
+
+
+def test_forward_matches_brute_force():
+    state_model = init_state_model(STATE_SYMBOLS, MAX_REPEAT_NUMS, np.random.default_rng(0))
+    tables = kernel_tables(state_model)
+    for inds, padded, lengths, layouts in make_batches(SEQS_MAPPED, batch_size=3):
+        _, scales, end_scales, _ = forward(tables, padded, lengths, layouts)
+        for ind, log_likelihood in zip(inds, log_likelihoods(scales, end_scales)):
+            expected = np.log(brute_force_likelihood(state_model, SEQS_MAPPED[ind]))
+            assert np.isclose(log_likelihood, expected)
+
+
+def test_e_step_counts():
+    state_model = init_state_model(STATE_SYMBOLS, MAX_REPEAT_NUMS, np.random.default_rng(1))
+    trans_counts, repeat_counts, visit_counts, _ = e_step(state_model,
+                                                          make_batches(SEQS_MAPPED))
+    # every symbol is one visit, and is followed by either a repeat or a transition
+    assert np.isclose(visit_counts.sum(), sum(len(seq) for seq in SEQS_MAPPED))
+    assert np.isclose(trans_counts.sum() + repeat_counts.sum(),
+                      sum(len(seq) + 1 for seq in SEQS_MAPPED))
+    assert np.isclose(trans_counts[0].sum(), len(SEQS_MAPPED))
+
+
+def test_em_increases_log_likelihood():
+    state_model = init_state_model(STATE_SYMBOLS, MAX_REPEAT_NUMS, np.random.default_rng(2))
+    batches = make_batches(SEQS_MAPPED)
+    log_likelihoods_by_step = []
+    for _ in range(20):
+        *counts, log_likelihood = e_step(state_model, batches)
+        log_likelihoods_by_step.append(log_likelihood)
+        state_model = m_step(state_model, *counts, prob_small=0.)
+    assert np.all(np.diff(log_likelihoods_by_step) > -1e-9)
+
+
+def test_fit_em():
+    state_model = init_state_model(STATE_SYMBOLS, MAX_REPEAT_NUMS, np.random.default_rng(3))
+    state_model, log_likelihood, num_steps = fit_em(state_model, make_batches(SEQS_MAPPED),
+                                                    max_steps=200)
+    assert np.isfinite(log_likelihood)
+    assert num_steps <= 200
+    trans = state_model['trans']
+    assert np.allclose(trans[np.arange(len(STATE_SYMBOLS)) != 1].sum(axis=1), 1.)
+    assert np.all(np.diag(trans) == 0.)
+    # symbol 1 never repeats
+    assert np.all(state_model['repeat_probs'][4:6] == 0.)
+
+
+def test_run_batches_match_batches():
+    state_model = init_state_model(STATE_SYMBOLS, MAX_REPEAT_NUMS, np.random.default_rng(4))
+    batches = make_batches(SEQS_MAPPED, batch_size=3)
+    run_batches = make_run_batches(SEQS_MAPPED, batch_size=3)
+    assert np.allclose(sequence_log_likelihoods(state_model, run_batches),
+                       sequence_log_likelihoods(state_model, batches))
+    for counts, run_counts in zip(e_step(state_model, batches), e_step(state_model, run_batches)):
+        assert np.allclose(counts, run_counts)
+
+
+def test_run_batches_long_runs():
+    # runs longer than the maximum number of repeats of one state
+    # can go through more than one state of the same symbol
+    state_model = init_state_model(STATE_SYMBOLS, MAX_REPEAT_NUMS, np.random.default_rng(5))
+    seqs = [[0, 0, 0, 0, 0, 2], [2, 2, 0, 0, 0, 0, 1]]
+    padded_model = dict(state_model,
+                        repeat_probs=np.hstack((state_model['repeat_probs'], np.zeros((7, 4)))))
+    expected = [np.log(brute_force_likelihood(padded_model, seq)) for seq in seqs]
+    assert np.allclose(sequence_log_likelihoods(state_model, make_run_batches(seqs)), expected)
+
+
+def test_empty_sequences():
+    # an empty sequence goes straight from the start state to the end state
+    state_model = init_state_model(STATE_SYMBOLS, MAX_REPEAT_NUMS, np.random.default_rng(6))
+    seqs = SEQS_MAPPED + [[], []]
+    expected = [np.log(brute_force_likelihood(state_model, seq)) for seq in SEQS_MAPPED]
+    expected += [np.log(state_model['trans'][0, 1])] * 2
+    for batches in (make_batches(seqs, batch_size=3), make_run_batches(seqs, batch_size=3)):
+        assert np.allclose(sequence_log_likelihoods(state_model, batches), expected)
+        trans_counts, _, _, log_likelihood = e_step(state_model, batches)
+        assert np.isclose(trans_counts[0, 1], 2.)
+        assert np.isclose(trans_counts[0].sum(), len(seqs))
+        assert np.isclose(log_likelihood, sum(expected))
+    state_model, _, _ = fit_em(state_model, make_run_batches(seqs), max_steps=200)
+    assert np.isclose(state_model['trans'][0, 1], 2 / len(seqs))
+
+
+def test_sparse_state_model():
+    state_model = init_state_model(STATE_SYMBOLS, MAX_REPEAT_NUMS, np.random.default_rng(1))
+    # prune, so some transitions are zero
+    state_model['trans'] = drop_small(state_model['trans'], np.asarray(STATE_SYMBOLS), 0.15)
+    sparse_model = sparse_state_model(state_model)
+    assert sparse_model['trans'].nnz < state_model['trans'].size
+    assert 'trans_blocks' not in kernel_tables(sparse_model)
+    for batches in (make_batches(SEQS_MAPPED), make_run_batches(SEQS_MAPPED)):
+        dense_counts = e_step(state_model, batches)
+        sparse_counts = e_step(sparse_model, batches)
+        # transition counts stay sparse, and only cover the model's edges
+        assert scipy.sparse.issparse(sparse_counts[0])
+        assert np.allclose(sparse_counts[0].toarray(), dense_counts[0])
+        assert all(np.allclose(dense, sparse) for dense, sparse in zip(dense_counts[1:],
+                                                                      sparse_counts[1:]))
+        assert np.allclose(sequence_log_likelihoods(sparse_model, batches),
+                           sequence_log_likelihoods(state_model, batches))
+    # E-M steps work on sparse models too, and keep them sparse
+    fit_model, log_likelihood, _ = fit_em(sparse_model, make_run_batches(SEQS_MAPPED),
+                                          max_steps=3)
+    assert np.isfinite(log_likelihood)
+    assert scipy.sparse.issparse(fit_model['trans'])
+
+
+def test_fit_em_trace():
+    state_model = init_state_model(STATE_SYMBOLS, MAX_REPEAT_NUMS, np.random.default_rng(3))
+    events = []
+    _, log_likelihood, num_steps = fit_em(state_model, make_batches(SEQS_MAPPED),
+                                          max_steps=200, trace=events.append)
+    steps = [event for event in events if event['event'] == 'em_step']
+    assert [event['step'] for event in steps] == list(range(1, num_steps + 1))
+    # E-M never decreases the log-likelihood
+    assert np.all(np.diff([event['log_likelihood'] for event in steps]) >= -1e-8)
+    assert all(event['e_step_time'] >= 0 and event['m_step_time'] >= 0 for event in steps)
+    if num_steps < 200:
+        assert steps[-1]['param_change'] < steps[-1]['tolerance']
+    assert events[-1] == {'event': 'fit_em', 'log_likelihood': log_likelihood,
+                          'num_steps': num_steps, 'converged': num_steps < 200}
@@ -0,0 +1,55 @@
+import numpy as np
+
+from pomma.bootstrap import bootstrap_error_bounds, feature_counts
+from pomma.encoding import encode_strings, decode_ngram_keys, flatten_sequences
+from pomma.statistics import get_ngram_distribs, get_repeat_distribs
+
+SEQUENCES = [
+    'SaabcbbbcE',
+    'SabcaabcE',
+    'SbbbcaE',
+    'SaabbcbbbbcE',
+    'SabcE',
+    'ScabbE',
+]
+LABELSET = 'SabcdE'
+
+
+def test_feature_counts_match_statistics():
+    labels = 'abcd'
+    flat, offsets = encode_strings(SEQUENCES, labels)
+    counts, features = feature_counts(flat, offsets, len(labels), n_range=range(2, 4))
+    totals = np.asarray(counts.sum(axis=0)).ravel()
+
+    ngram_distribs = get_ngram_distribs(SEQUENCES, LABELSET, n_range=range(2, 4))
+    for n, (columns, keys) in features['ngram'].items():
+        ngram_counts = dict(zip(decode_ngram_keys(keys, n, labels), totals[columns]))
+        assert ngram_counts == dict(ngram_distribs[n]['counts'])
+
+    repeat_counts = totals[features['repeat']].reshape(len(labels), -1)
+    for label, distrib in get_repeat_distribs(SEQUENCES, 'ab').items():
+        for repeat, count in zip(distrib['unique_repeats'], distrib['counts']):
+            assert repeat_counts[labels.index(label), len(repeat)] == count
+
+
+def test_feature_counts_empty_sequence():
+    flat, offsets = flatten_sequences([[0, 0, 1], [], [1, 2]])
+    assert flat.dtype == np.uint8
+    assert offsets.tolist() == [0, 3, 3, 5]
+    counts, features = feature_counts(flat, offsets, 3, n_range=range(2, 3))
+    columns, keys = features['ngram'][2]
+    totals = np.asarray(counts.sum(axis=0)).ravel()
+    assert dict(zip(decode_ngram_keys(keys, 2, 'abc'), totals[columns])) == {
+        'aa': 1, 'ab': 1, 'bc': 1}
+
+
+def test_bootstrap_error_bounds():
+    kwargs = dict(num_boot=20, n_range=range(2, 4), seed=3, chunk_size=7)
+    error_bounds = bootstrap_error_bounds(SEQUENCES, LABELSET, n_jobs=1, **kwargs)
+    assert set(error_bounds['ngram'].keys()) == {2, 3}
+    assert set(error_bounds['repeat'].keys()) == {'a', 'b'}
+    assert error_bounds['step_prob'] >= 0
+
+    parallel = bootstrap_error_bounds(SEQUENCES, LABELSET, n_jobs=2, **kwargs)
+    assert parallel['step_prob'] == error_bounds['step_prob']
+    assert parallel['ngram'] == error_bounds['ngram']
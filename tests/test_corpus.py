@@ -0,0 +1,53 @@
+import numpy as np
+
+from pomma.corpus import write_corpus, open_corpus
+from pomma.ngram_index import NgramIndex
+from pomma.pommafitter import POMMAfitter
+
+SEQUENCES = [
+    'SaabcbbbcE\n',
+    'SabcaabcE\n',
+    'SbbbcaE\n',
+]
+LOL = [
+    [1, 1, 2, 3],
+    [1, 1, 1, 1, 2, 3],
+    [1, 1, 2, 3],
+]
+
+
+def test_write_and_open_corpus(tmp_path):
+    written = write_corpus(str(tmp_path / 'corpus'), SEQUENCES)
+    corpus = open_corpus(str(tmp_path / 'corpus'))
+    assert isinstance(corpus['flat'], np.memmap)
+    assert corpus['flat'].dtype == np.uint8
+    assert corpus['symbols'] == ['a', 'b', 'c']
+    assert list(corpus['offsets']) == [0, 8, 15, 20]
+    assert np.array_equal(corpus['flat'], written['flat'])
+    assert NgramIndex.from_corpus(corpus, max_n=2).count('bb') == 4
+
+
+def test_fit_corpus(tmp_path):
+    corpus = write_corpus(str(tmp_path / 'corpus'), LOL)
+    assert corpus['symbols'] == [1, 2, 3]
+    pf_corpus = POMMAfitter()
+    pf_corpus._determine_symbols_and_max_repeats(corpus)
+    pf = POMMAfitter()
+    pf._determine_symbols_and_max_repeats(LOL)
+    for attr in ('symbols', 'symbols_int_map', 'max_repeats', 'repeat_symbols'):
+        assert getattr(pf_corpus, attr) == getattr(pf, attr)
+    assert [list(seq) for seq in pf_corpus.seqs_mapped] == pf.seqs_mapped
+
+
+def test_load_corpus_dataset(tmp_path, monkeypatch):
+    from pomma import datasets
+
+    monkeypatch.setenv('POMMA_CORPUS_DIR', str(tmp_path / 'corpora'))
+    assert datasets.default_corpus_dir() == str(tmp_path / 'corpora')
+    corpora = datasets.load_corpus()
+    sequences = datasets.load()['bl26lb16']
+    assert corpora['bl26lb16']['offsets'].shape[0] == len(sequences) + 1
+    # only the finished corpus is left, no temporary directory
+    assert sorted(path.name for path in (tmp_path / 'corpora').iterdir()) == ['bl26lb16']
+    # opened again, not converted again
+    assert datasets.corpus_dirs() == {'bl26lb16': str(tmp_path / 'corpora' / 'bl26lb16')}
@@ -0,0 +1,94 @@
+import numpy as np
+
+from pomma.derive_initial_state_model import derive_initial_state_model
+
+SEQS_MAPPED = [
+    [0, 0, 1, 2, 2],
+    [0, 1],
+    [2, 2, 0, 0, 0, 1],
+    [1, 0, 0, 2],
+    [0, 0, 0, 1, 2],
+]
+MAX_REPEATS = {0: 3, 1: 1, 2: 2}
+
+
+def test_derive_initial_state_model_n_jobs():
+    kwargs = dict(max_repeats=MAX_REPEATS, num_symbols=3, max_extra_states=2,
+                  num_random_starts=3, max_steps=50, seed=42)
+    serial = derive_initial_state_model(SEQS_MAPPED, n_jobs=1, **kwargs)
+    parallel = derive_initial_state_model(SEQS_MAPPED, n_jobs=2, **kwargs)
+    assert serial['num_extra_states'] == parallel['num_extra_states']
+    assert serial['log_likelihood'] == parallel['log_likelihood']
+    assert np.array_equal(serial['trans'], parallel['trans'])
+    assert np.array_equal(serial['repeat_probs'], parallel['repeat_probs'])
+
+
+def test_derive_initial_state_model_halving():
+    kwargs = dict(max_repeats=MAX_REPEATS, num_symbols=3, max_extra_states=2,
+                  num_random_starts=4, max_steps=50, seed=42)
+    grid = derive_initial_state_model(SEQS_MAPPED, search='grid', **kwargs)
+    halving = derive_initial_state_model(SEQS_MAPPED, search='halving',
+                                         halving_steps=5, **kwargs)
+    assert np.isfinite(halving['log_likelihood'])
+    assert halving['num_em_steps'] < grid['num_em_steps']
+
+
+def test_successive_halving_keeps_best():
+    from pomma.baum_welch import init_state_model
+    from pomma.derive_initial_state_model import (job_runner, successive_halving,
+                                                  state_symbols_and_max_repeat_nums)
+
+    state_symbols, max_repeat_nums = state_symbols_and_max_repeat_nums(MAX_REPEATS, 3, 1)
+    state_models = [init_state_model(state_symbols, max_repeat_nums, np.random.default_rng(seed))
+                    for seed in range(4)]
+    with job_runner(SEQS_MAPPED) as run:
+        best, total_steps = successive_halving(run, state_models, max_steps=40,
+                                               halving_steps=2)
+    # 4 models x 2 steps, then 2 models x 4 steps, then at most 40 - 6 steps
+    assert total_steps <= 4 * 2 + 2 * 4 + 34
+    assert best['num_steps'] <= 40
+    assert np.isfinite(best['log_likelihood'])
+
+
+def test_derive_initial_state_model_trace():
+    kwargs = dict(max_repeats=MAX_REPEATS, num_symbols=3, max_extra_states=2,
+                  num_random_starts=3, max_steps=50, seed=42)
+    serial, parallel = [], []
+    derive_initial_state_model(SEQS_MAPPED, n_jobs=1, trace=serial.append, **kwargs)
+    derive_initial_state_model(SEQS_MAPPED, n_jobs=2, trace=parallel.append, **kwargs)
+    untimed = [{key: value for key, value in event.items()
+                if key not in ('e_step_time', 'm_step_time', 'peak_memory', 'pid')}
+               for event in serial]
+    assert untimed == [{key: value for key, value in event.items()
+                        if key not in ('e_step_time', 'm_step_time', 'peak_memory', 'pid')}
+                       for event in parallel]
+    steps = [event for event in serial if event['event'] == 'em_step']
+    assert {(event['num_extra_states'], event['random_start']) for event in steps} == {
+        (num_extra_states, random_start)
+        for num_extra_states in (1, 2) for random_start in range(3)}
+    assert [event['num_extra_states'] for event in serial
+            if event['event'] == 'extra_states'] == [1, 2]
+
+    halving = []
+    derive_initial_state_model(SEQS_MAPPED, search='halving', halving_steps=5,
+                               trace=halving.append, **kwargs)
+    rounds = [event for event in halving if event['event'] == 'halving_round']
+    assert rounds[0]['restarts_alive'] == 3
+    assert any(event.get('stage') == 'refit' for event in halving)
+
+
+def test_derive_initial_state_model_halving_edge_cases(monkeypatch):
+    import pytest
+    from pomma import derive_initial_state_model as derive_module
+
+    kwargs = dict(max_repeats=MAX_REPEATS, num_symbols=3, max_extra_states=2,
+                  num_random_starts=2, max_steps=20, seed=42, search='halving')
+    with pytest.raises(ValueError):
+        derive_initial_state_model(SEQS_MAPPED[:1], **kwargs)
+
+    # held-out sequences that no model can score
+    monkeypatch.setattr(derive_module, 'sequence_log_likelihoods',
+                        lambda state_model, batches: np.full(1, np.nan))
+    state_model = derive_initial_state_model(SEQS_MAPPED, patience=2, **kwargs)
+    assert state_model['num_extra_states'] == 1
+    assert np.isfinite(state_model['log_likelihood'])
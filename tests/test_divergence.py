@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from pomma.bootstrap import feature_counts, statistic_diffs
+from pomma.divergence import align_counts, count_table, compare_tables, select
+from pomma.encoding import encode_strings
+
+SEQUENCES = [
+    'SaabcbbbcE',
+    'SabcaabcE',
+    'SbbbcaE',
+    'SaabbcbbbbcE',
+]
+LABELS = 'abc'
+
+
+def test_align_counts():
+    keys, aligned = align_counts([np.array([1, 4]), np.array([0, 4, 7])],
+                                 [np.array([2, 3]), np.array([1, 1, 5])])
+    assert keys.tolist() == [0, 1, 4, 7]
+    assert aligned.tolist() == [[0, 2, 3, 0], [1, 0, 1, 5]]
+
+
+def test_compare_tables():
+    flat, offsets = encode_strings(SEQUENCES, LABELS)
+    reference = count_table(flat, offsets, len(LABELS), m_compare=10)
+    first = count_table(flat[:offsets[2]], offsets[:3], len(LABELS), m_compare=10)
+    second = count_table(flat[offsets[2]:], offsets[2:] - offsets[2], len(LABELS), m_compare=10)
+    diffs = compare_tables(first, [second, first, reference])
+
+    # same differences as the bootstrap, for the same split
+    counts, features = feature_counts(flat, offsets, len(LABELS), m_compare=10)
+    expected = statistic_diffs(np.asarray(counts[:2].sum(axis=0)),
+                               np.asarray(counts[2:].sum(axis=0)), features, len(LABELS))
+    for n in expected['ngram']:
+        assert np.isclose(diffs['ngram'][n][0], expected['ngram'][n][0])
+    assert np.isclose(diffs['step_prob'][0], expected['step_prob'][0])
+    assert diffs['repeat'].keys() == expected['repeat'].keys()
+    for label in expected['repeat']:
+        assert np.isclose(diffs['repeat'][label][0], expected['repeat'][label][0])
+
+    # a table does not differ from itself
+    same = select(diffs, 1)
+    assert all(diff == 0 for diff in same['ngram'].values())
+    assert all(diff == 0 for diff in same['ngram_kl'].values())
+    assert same['step_prob'] == 0
+    # smoothing keeps KL finite for n-grams the second half never has
+    assert all(np.isfinite(diff).all() and (diff >= 0).all()
+               for diff in diffs['ngram_kl'].values())
+    assert all((diff <= np.log(2) + 1e-12).all() for diff in diffs['ngram_js'].values())
+
+    with pytest.raises(ValueError):
+        compare_tables(reference, [count_table(flat, offsets, len(LABELS), m_compare=5)])
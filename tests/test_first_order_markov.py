@@ -0,0 +1,58 @@
+import numpy as np
+
+from pomma.first_order_markov import make_trans_mat, generate_sequences, encode_labels
+
+SEQUENCES = [
+    'SaabcbbbcE',
+    'SabcaabcE',
+    'SbbbcaE',
+    'SaabbcbbbbcE',
+]
+LABELSET = 'SabcE'
+
+
+def test_generate_sequences():
+    trans_mat = make_trans_mat(SEQUENCES, LABELSET)
+    sequences = generate_sequences(trans_mat, LABELSET, num=2000, seed=42)
+    assert len(sequences) == 2000
+    assert sequences == generate_sequences(trans_mat, LABELSET, num=2000, seed=42)
+    assert all(set(sequence) <= set('abc') for sequence in sequences)
+    # same transition probabilities as reference implementation, within sampling error
+    generated_trans_mat = make_trans_mat(['S' + seq + 'E' for seq in sequences], LABELSET)
+    reference = generate_sequences(trans_mat, LABELSET, num=2000, seed=42, reference=True)
+    reference_trans_mat = make_trans_mat(['S' + seq + 'E' for seq in reference], LABELSET)
+    assert np.allclose(generated_trans_mat, trans_mat, atol=0.05)
+    assert np.allclose(reference_trans_mat, trans_mat, atol=0.05)
+
+
+def test_generate_sequences_deterministic():
+    # S -> a -> b -> c -> E with probability 1
+    trans_mat = np.zeros((4, 5))
+    trans_mat[0, 1] = trans_mat[1, 2] = trans_mat[2, 3] = trans_mat[3, 4] = 1.
+    assert generate_sequences(trans_mat, LABELSET, num=3) == ['abc'] * 3
+    assert generate_sequences(trans_mat, LABELSET, num=3, reference=True) == ['abc'] * 3
+
+
+def test_generate_sequences_zero_rows():
+    # c is never followed by anything, so its row is all zeros, and bouts end after it
+    trans_mat = make_trans_mat(['SabE', 'Sac'], LABELSET)
+    assert np.array_equal(trans_mat[3], np.zeros(5))
+    for reference in (False, True):
+        sequences = generate_sequences(trans_mat, LABELSET, num=200, seed=0,
+                                       reference=reference)
+        assert set(sequences) == {'ab', 'ac'}
+
+
+def test_make_trans_mat():
+    trans_mat = make_trans_mat(['SabcE', 'SbbE'], 'SabEzc')
+    # no row for E, and z never occurs so its row is all zeros
+    assert trans_mat.shape == (5, 6)
+    assert np.array_equal(trans_mat[3], np.zeros(6))
+    assert np.allclose(trans_mat[2], [0, 0, 1 / 3, 1 / 3, 0, 1 / 3])
+
+    encoded = encode_labels(SEQUENCES, LABELSET)
+    trans_mat = make_trans_mat(SEQUENCES, LABELSET)
+    assert np.array_equal(make_trans_mat(None, LABELSET, encoded=encoded), trans_mat)
+    sparse_trans_mat = make_trans_mat(SEQUENCES, LABELSET, return_sparse=True)
+    assert np.allclose(sparse_trans_mat.toarray(), trans_mat)
+    assert np.allclose(trans_mat.sum(axis=1), 1.)
@@ -0,0 +1,17 @@
+import json
+
+from pomma.instrumentation import JsonlTrace, with_context
+
+
+def test_jsonl_trace(tmp_path):
+    filename = tmp_path / 'trace.jsonl'
+    with JsonlTrace(filename) as trace:
+        traced = with_context(trace, random_start=2)
+        traced({'event': 'em_step', 'step': 1})
+        traced({'event': 'em_step', 'step': 2, 'random_start': 3})
+    events = [json.loads(line) for line in open(filename)]
+    assert [event['step'] for event in events] == [1, 2]
+    # context is added, but does not replace what the event reports
+    assert [event['random_start'] for event in events] == [2, 3]
+    assert all('time' in event for event in events)
+    assert with_context(None, random_start=2) is None
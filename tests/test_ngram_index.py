@@ -0,0 +1,40 @@
+import numpy as np
+
+from pomma.encoding import encode_strings, ngram_keys
+from pomma.ngram_index import NgramIndex
+
+SEQUENCES = [
+    'SaabcbbbcE',
+    'SabcaabcE',
+    'SbbbcaE',
+    'SaabbcbbbbcE',
+]
+LABELS = 'abc'
+
+
+def test_counts_match_ngram_keys():
+    flat, offsets = encode_strings(SEQUENCES, LABELS)
+    index = NgramIndex(flat, offsets, LABELS, max_n=4)
+    for n in range(1, 5):
+        keys, counts = index.counts(n)
+        expected_keys, expected_counts = np.unique(ngram_keys(flat, offsets, len(LABELS), n)[0],
+                                                   return_counts=True)
+        assert np.array_equal(keys, expected_keys)
+        assert np.array_equal(counts, expected_counts)
+
+
+def test_queries(tmp_path):
+    index = NgramIndex.from_strings(SEQUENCES, LABELS, max_n=3)
+    assert index.count('bb') == 8
+    assert index.count('abc') == 3
+    # never crosses the end of a bout, and unknown characters are never counted
+    assert index.count('ca') == 2
+    assert index.count('cx') == 0
+    assert list(index.count_many(['aa', 'cc'])) == [3, 0]
+    assert index.top_k(n=2, k=3) == [('bb', 8), ('bc', 7), ('ab', 4)]
+
+    filename = tmp_path / 'index.npz'
+    index.save(filename)
+    loaded = NgramIndex.load(filename)
+    assert loaded.top_k(n=2, k=3) == index.top_k(n=2, k=3)
+    assert loaded.count('abc') == 3
@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+from scipy.io import savemat
+
+from pomma import notmat_utils
+
+
+def make_notmats(data_dir, labels_by_day):
+    for day, labels in labels_by_day.items():
+        os.makedirs(os.path.join(data_dir, day))
+        for ind, label in enumerate(labels):
+            filename = os.path.join(data_dir, day, f'song_{ind}.cbin.not.mat')
+            savemat(filename, {'labels': label, 'onsets': np.arange(len(label))})
+
+
+def test_load_labels(tmp_path):
+    make_notmats(str(tmp_path), {'day1': ['abc', 'aab'], 'day2': ['iiab']})
+    labels = notmat_utils.load_labels(str(tmp_path))
+    assert labels == ['SabcE', 'SaabE', 'SiiabE']
+    assert notmat_utils.load_labels(str(tmp_path), max_workers=1) == labels
+
+
+def test_load_labels_cache(tmp_path, monkeypatch):
+    data_dir = str(tmp_path / 'data')
+    cache_file = str(tmp_path / 'labels_cache.json')
+    make_notmats(data_dir, {'day1': ['abc', 'aab'], 'day2': ['iiab']})
+    assert notmat_utils.load_labels(data_dir, cache_file=cache_file) == ['SabcE', 'SaabE', 'SiiabE']
+
+    # change one file, so only that file is loaded again
+    changed = os.path.join(data_dir, 'day2', 'song_0.cbin.not.mat')
+    savemat(changed, {'labels': 'iiiabc'})
+    stat = os.stat(changed)
+    os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    loaded = []
+    load_notmat = notmat_utils.load_notmat
+
+    def counting_load_notmat(filename, variable_names=None):
+        loaded.append(filename)
+        return load_notmat(filename, variable_names)
+
+    monkeypatch.setattr(notmat_utils, 'load_notmat', counting_load_notmat)
+    labels = notmat_utils.load_labels(data_dir, cache_file=cache_file)
+    assert labels == ['SabcE', 'SaabE', 'SiiiabcE']
+    assert loaded == [changed]
+
+
+def test_load_labels_empty(tmp_path):
+    make_notmats(str(tmp_path), {'day1': ['abc', '']})
+    cache_file = str(tmp_path / 'labels_cache.json')
+    assert notmat_utils.load_labels(str(tmp_path), cache_file=cache_file) == ['SabcE', 'SE']
+    # and from the cache
+    assert notmat_utils.load_labels(str(tmp_path), cache_file=cache_file) == ['SabcE', 'SE']
@@ -1,3 +1,6 @@
+import numpy as np
+import scipy.sparse
+
 from pomma.pommafitter import POMMAfitter
 
 # list of lists to test
@@ -14,4 +17,115 @@ def test_determine_symbols_and_max_repeats():
     assert pf.symbols == {1,2,3}
     assert pf.seqs_mapped == LOL
     assert pf.max_repeats == {1:4, 2:1, 3:1}
-    assert pf.repeat_symbols == [1]
\ No newline at end of file
+    assert pf.repeat_symbols == [1]
+
+def test_fit():
+    pf = POMMAfitter(max_extra_states=2, num_random_starts=2, max_steps=50, seed=0)
+    pf.fit(sequences=LOL)
+    state_symbols = pf.initial_state_model['state_symbols']
+    assert state_symbols[0] == pf.start_symbol
+    assert state_symbols[1] == pf.end_symbol
+    assert set(state_symbols[2:]) == {0, 1, 2}
+    assert np.isfinite(pf.initial_state_model['log_likelihood'])
+    # generated sequences are compared with the same statistics as error bounds
+    assert pf.res_diff.keys() >= pf.error_bounds.keys()
+    assert pf.res_diff['repeat'].keys() >= pf.error_bounds['repeat'].keys()
+
+
+def test_fit_empty_bout():
+    pf = POMMAfitter(max_extra_states=1, num_random_starts=2, max_steps=50, seed=0)
+    pf.fit(sequences=LOL + [[]])
+    assert np.isfinite(pf.initial_state_model['log_likelihood'])
+    assert np.isclose(pf.score_samples([[]])[0], np.log(1 / 4))
+
+
+def test_generate_sequences():
+    pf = POMMAfitter(max_extra_states=1, num_random_starts=2, max_steps=50, seed=0, num_seq=100)
+    pf.fit(sequences=LOL)
+    sequences = pf.generate_sequences()
+    assert len(sequences) == 100
+    assert all(set(seq) <= {1, 2, 3} for seq in sequences)
+    assert sequences == pf.generate_sequences()
+    chunks = list(pf.iter_generate_sequences(chunk_size=40))
+    assert [len(chunk) for chunk in chunks] == [40, 40, 20]
+
+
+def test_partial_fit():
+    pf = POMMAfitter(max_extra_states=1, num_random_starts=2, max_steps=50, seed=0)
+    pf.fit(sequences=LOL)
+    symbols_int_map = dict(pf.symbols_int_map)
+    num_states = pf.initial_state_model['state_symbols'].shape[0]
+
+    # same symbols and repeats, so no states are added
+    pf.partial_fit(sequences=LOL)
+    assert pf.initial_state_model['state_symbols'].shape[0] == num_states
+    # one transition from start state per sequence, old and new
+    assert np.isclose(pf.sufficient_stats['trans_counts'][0].sum(), 2 * len(LOL))
+
+    # new symbol 4, and symbol 1 repeats more
+    pf.partial_fit(sequences=[[1, 1, 1, 1, 1, 4, 3], [4, 2, 3]])
+    assert all(pf.symbols_int_map[symbol] == symbol_int
+               for symbol, symbol_int in symbols_int_map.items())
+    assert pf.max_repeats == {1: 5, 2: 1, 3: 1, 4: 1}
+    state_model = pf.initial_state_model
+    state_symbols = state_model['state_symbols']
+    assert np.count_nonzero(state_symbols == pf.symbols_int_map[4]) == 2
+    assert np.all(state_model['max_repeat_nums'][state_symbols == pf.symbols_int_map[1]] == 5)
+    assert np.isfinite(state_model['log_likelihood'])
+    # pruned model stays sparse
+    assert scipy.sparse.issparse(state_model['trans'])
+    assert len(pf.seqs_mapped) == 2 * len(LOL) + 2
+    assert {4} <= {symbol for seq in pf.generate_sequences(200) for symbol in seq}
+
+
+def test_partial_fit_impossible_bouts():
+    pf = POMMAfitter(max_extra_states=1, num_random_starts=2, max_steps=50, seed=0)
+    pf.fit(sequences=LOL + [[1, 2, 3], [2, 1, 3]])
+    assert pf.score_samples([[3, 2, 1]])[0] == -np.inf
+    # same symbols and repeats, but transitions the fit model never takes
+    pf.partial_fit(sequences=[[3, 2, 1]] * 20)
+    assert np.isfinite(pf.initial_state_model['log_likelihood'])
+    assert pf.score_samples([[3, 2, 1]])[0] > np.log(0.1)
+
+
+def test_score_samples():
+    pf = POMMAfitter(max_extra_states=1, num_random_starts=2, max_steps=50, seed=0)
+    pf.fit(sequences=LOL)
+    log_likelihoods = pf.score_samples(LOL)
+    assert log_likelihoods.shape == (len(LOL),)
+    assert np.isclose(log_likelihoods.sum(), pf.initial_state_model['log_likelihood'])
+    assert np.isclose(pf.score(LOL), log_likelihoods.sum())
+    assert np.allclose(pf.score_samples(LOL, n_jobs=2), log_likelihoods)
+    # symbol the model has never seen, and no symbols at all
+    assert np.all(pf.score_samples([[1, 4, 2, 3], []]) == -np.inf)
+
+
+def test_decode():
+    pf = POMMAfitter(max_extra_states=1, num_random_starts=2, max_steps=50, seed=0)
+    pf.fit(sequences=LOL)
+    flat_states, offsets, log_probs = pf.decode(LOL)
+    assert offsets.tolist() == [0, 4, 10, 14]
+    state_symbols = pf.initial_state_model['state_symbols']
+    int_symbols = pf._int_symbols()
+    assert int_symbols[state_symbols[flat_states]].tolist() == sum(LOL, [])
+    # the most likely path is no more likely than all paths together
+    assert np.all(log_probs <= pf.score_samples(LOL) + 1e-12)
+
+
+def test_save_load(tmp_path):
+    pf = POMMAfitter(max_extra_states=1, num_random_starts=2, max_steps=50, seed=0)
+    pf.fit(sequences=LOL)
+    filename = tmp_path / 'model.npz'
+    pf.save(filename)
+    loaded = POMMAfitter.load(filename)
+    assert loaded.symbols_int_map == pf.symbols_int_map
+    assert loaded.max_repeats == pf.max_repeats
+    assert loaded.error_bounds == pf.error_bounds
+    assert loaded.res_diff == pf.res_diff
+    assert np.allclose(loaded.score_samples(LOL), pf.score_samples(LOL))
+    assert loaded.generate_sequences(10, seed=1) == pf.generate_sequences(10, seed=1)
+    assert np.array_equal(loaded.decode(LOL)[0], pf.decode(LOL)[0])
+    # derived tables are loaded, not computed again
+    assert set(loaded._tables_cache) == {'sampling', 'kernel', 'viterbi'}
+    loaded.partial_fit(LOL)
+    assert np.isfinite(loaded.initial_state_model['log_likelihood'])
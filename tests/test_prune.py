@@ -0,0 +1,58 @@
+import numpy as np
+from scipy import sparse
+
+from pomma.baum_welch import init_state_model, make_run_batches, fit_em, e_step
+from pomma.prune import closest_pair, merge_states, prune_state_model, rare_states
+
+STATE_SYMBOLS = [1000, 1001, 0, 0, 1, 1, 2]
+MAX_REPEAT_NUMS = [0, 0, 3, 3, 1, 1, 2]
+
+SEQS_MAPPED = [
+    [0, 0, 1, 2, 2],
+    [0, 1],
+    [2, 2, 0, 0, 0, 1],
+    [1, 0, 0, 2],
+]
+
+
+def test_merge_states():
+    state_model = init_state_model(STATE_SYMBOLS, MAX_REPEAT_NUMS, np.random.default_rng(0))
+    # make states 4 and 5 of symbol 1 go to the same places
+    state_model['trans'][5] = state_model['trans'][4]
+    state_model['trans'][5, 4] = 0.
+    state_model['trans'][4, 5] = 0.
+    state_model['trans'][4:6] /= state_model['trans'][4:6].sum(axis=1, keepdims=True)
+    pair, difference = closest_pair(state_model)
+    assert pair == (4, 5)
+
+    visit_counts = np.ones((7, 2))
+    merged, merged_visits = merge_states(state_model, visit_counts, *pair)
+    assert merged['state_symbols'].tolist() == [1000, 1001, 0, 0, 1, 2]
+    assert merged_visits[4].tolist() == [2., 2.]
+    # transitions into either state go to the merged state
+    assert np.allclose(merged['trans'][2, 4], state_model['trans'][2, 4:6].sum())
+    assert np.allclose(merged['trans'].sum(axis=1)[np.arange(6) != 1], 1.)
+    assert merged['trans'][4, 4] == 0.
+
+
+def test_prune_state_model():
+    state_model = init_state_model(STATE_SYMBOLS, MAX_REPEAT_NUMS, np.random.default_rng(0))
+    batches = make_run_batches(SEQS_MAPPED)
+    state_model, _, _ = fit_em(state_model, batches, max_steps=5)
+    pruned = prune_state_model(state_model, batches, prob_prune=0.05, frac_in_prune=0.05)
+    assert sparse.issparse(pruned['trans'])
+    assert pruned['trans'].nnz < np.count_nonzero(state_model['trans'])
+    assert pruned['state_symbols'].shape[0] <= len(STATE_SYMBOLS)
+    # every symbol keeps at least one state
+    assert set(pruned['state_symbols'][2:].tolist()) == {0, 1, 2}
+    # pruning never makes the sequences the model was fit to impossible
+    assert np.isfinite(pruned['log_likelihood'])
+    _, _, visit_counts, _ = e_step(pruned, batches)
+    assert not rare_states(pruned, visit_counts, 0.05).any()
+
+    # when nothing can be pruned, the state model passed is still not modified;
+    # symbol 2 repeats at most twice, so the last sequence is already impossible
+    impossible = make_run_batches(SEQS_MAPPED + [[2, 2, 2]])
+    kept = prune_state_model(state_model, impossible, max_rounds=0)
+    assert kept['log_likelihood'] == -np.inf
+    assert 'log_likelihood' not in state_model
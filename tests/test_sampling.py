@@ -0,0 +1,73 @@
+from collections import Counter
+from itertools import groupby
+
+import numpy as np
+
+from pomma.baum_welch import (init_state_model, make_batches, sequence_log_likelihoods,
+                              sparse_state_model)
+from pomma.encoding import split_flat
+from pomma.sampling import sample_sequences, iter_sample_sequences
+
+
+def make_state_model():
+    rng = np.random.default_rng(1)
+    state_model = init_state_model([1000, 1001, 0, 1, 1, 2], [0, 0, 3, 1, 1, 2], rng)
+    # make end state more likely, so sequences are short
+    trans = state_model['trans']
+    trans[2:, 1] += 1.
+    state_model['trans'] = trans / np.where(trans.sum(axis=1) > 0, trans.sum(axis=1), 1.)[:, np.newaxis]
+    return state_model
+
+
+def test_sample_sequences_frequencies():
+    state_model = make_state_model()
+    num = 100000
+    flat, offsets = sample_sequences(state_model, num, seed=0)
+    counts = Counter(tuple(seq.tolist()) for seq in split_flat(flat, offsets))
+    most_common = [list(seq) for seq, _ in counts.most_common(5)]
+    probs = np.exp(sequence_log_likelihoods(state_model, make_batches(most_common)))
+    freqs = np.array([counts[tuple(seq)] for seq in most_common]) / num
+    assert np.allclose(freqs, probs, rtol=0.05)
+
+
+def test_sample_sequences_states():
+    state_model = make_state_model()
+    flat, offsets, flat_states = sample_sequences(state_model, 1000, seed=0, return_states=True)
+    assert np.array_equal(flat, state_model['state_symbols'][flat_states])
+    assert offsets.shape == (1001,)
+    # symbol 0 has one state, with at most 3 repeats
+    runs = [len(list(run)) for seq in split_flat(flat, offsets)
+            for symbol, run in groupby(seq.tolist()) if symbol == 0]
+    assert max(runs) == 3
+    # same sequences from the same seed, in chunks
+    chunks = list(iter_sample_sequences(state_model, 1000, chunk_size=300, seed=0))
+    assert [offsets.shape[0] - 1 for _, offsets in chunks] == [300, 300, 300, 100]
+    again = list(iter_sample_sequences(state_model, 1000, chunk_size=300, seed=0))
+    assert all(np.array_equal(a[0], b[0]) for a, b in zip(chunks, again))
+
+
+def test_sample_sequences_sparse():
+    state_model = make_state_model()
+    state_model['trans'][state_model['trans'] < 0.1] = 0.
+    state_model['trans'] /= state_model['trans'].sum(axis=1, keepdims=True).clip(min=1e-12)
+    # sampling only goes through non-zero transitions, so the same seed gives the same sequences
+    flat, offsets = sample_sequences(state_model, 1000, seed=0)
+    sparse_flat, sparse_offsets = sample_sequences(sparse_state_model(state_model), 1000, seed=0)
+    assert np.array_equal(flat, sparse_flat)
+    assert np.array_equal(offsets, sparse_offsets)
+
+
+def test_sample_sequences_zero_row():
+    state_model = make_state_model()
+    trans = state_model['trans']
+    trans[3] = 0.
+    # the next row does not go to the end state, so that a zero row
+    # cannot end sequences by drawing from the next row by chance
+    trans[4, 1] = 0.
+    trans[4] /= trans[4].sum()
+    for model in (state_model, sparse_state_model(state_model)):
+        flat, offsets, flat_states = sample_sequences(model, 2000, seed=0, return_states=True)
+        paths = split_flat(flat_states, offsets)
+        assert any(3 in path for path in paths)
+        # a state with no transitions ends the sequence
+        assert all(path[-1] == 3 for path in paths if 3 in path)
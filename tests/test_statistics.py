@@ -0,0 +1,65 @@
+import numpy as np
+
+from pomma.statistics import get_ngram_distribs, get_repeat_distribs, get_step_prob
+
+SEQUENCES = [
+    'SaabcbbbcE',
+    'SabcaabcE',
+    'SbbbcaE',
+    'SaabbcbbbbcE',
+]
+LABELSET = 'SabcE'
+
+
+def test_get_ngram_distribs():
+    distribs = get_ngram_distribs(SEQUENCES, LABELSET, n_range=range(2, 4))
+    assert distribs[2]['counts'] == [('bb', 8), ('bc', 7), ('ab', 4), ('aa', 3),
+                                     ('cb', 2), ('ca', 2)]
+    assert np.allclose(distribs[2]['distrib'], np.array([8, 7, 4, 3, 2, 2]) / 26)
+    # n-grams that contain every label are counted too
+    assert ('abc', 3) in distribs[3]['counts']
+
+
+def test_get_ngram_distribs_real_ngram_distribs():
+    real_ngram_distribs = get_ngram_distribs(SEQUENCES, LABELSET, n_range=range(2, 3))
+    generated = ['SaaaaE', 'ScccE', 'SabE']
+    distribs = get_ngram_distribs(generated, LABELSET, n_range=range(2, 3),
+                                  real_ngram_distribs=real_ngram_distribs)
+    # only n-grams in real data are counted, including ones that never occur
+    assert distribs[2]['counts'] == [('aa', 3), ('ab', 1), ('cb', 0), ('ca', 0),
+                                     ('bc', 0), ('bb', 0)]
+
+
+def test_get_step_prob():
+    step_probs = get_step_prob(SEQUENCES, LABELSET)
+    assert set(step_probs) == set('abcE')
+    # longest sequence has 12 characters, including S and E
+    assert all(step_prob.shape == (12,) for step_prob in step_probs.values())
+    # 'a' is first label of 3 of 4 sequences, out of 8 'a's in all
+    assert np.isclose(step_probs['a'][1], 3 / 8)
+    # only 'SbbbcaE' ends at step 6
+    assert np.isclose(step_probs['E'][6], 1 / 4)
+    assert np.allclose([step_prob.sum() for step_prob in step_probs.values()], 1.)
+
+    labels, step_probs_mat = get_step_prob(SEQUENCES, LABELSET, max_steps=3, as_matrix=True)
+    assert labels == 'Eabc'
+    assert step_probs_mat.shape == (4, 3)
+    assert np.allclose(step_probs_mat[1], np.array([0, 3, 2]) / 5)
+
+
+def test_get_repeat_distribs():
+    distribs = get_repeat_distribs(SEQUENCES, 'abc')
+    assert distribs['a']['run_lengths'].tolist() == [2]
+    assert distribs['a']['counts'].tolist() == [3]
+    assert distribs['b']['run_lengths'].tolist() == [2, 3, 4]
+    assert distribs['b']['counts'].tolist() == [1, 2, 1]
+    assert distribs['b']['unique_repeats'].tolist() == ['bb', 'bbb', 'bbbb']
+    # labels that never repeat still get an entry
+    assert distribs['c']['run_lengths'].shape == (0,)
+
+    # runs do not continue from one sequence into the next,
+    # even without start and end characters
+    distribs = get_repeat_distribs(['aab', 'baa'], 'ab', return_strings=False)
+    assert distribs['a']['counts'].tolist() == [2]
+    assert distribs['b']['counts'].shape == (0,)
+    assert 'unique_repeats' not in distribs['a']
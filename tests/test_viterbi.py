@@ -0,0 +1,79 @@
+import itertools
+
+import numpy as np
+
+from pomma.baum_welch import init_state_model, sparse_state_model, drop_small
+from pomma.encoding import flatten_sequences, split_flat
+from pomma.viterbi import viterbi, viterbi_tables
+
+STATE_SYMBOLS = [1000, 1001, 0, 0, 1, 1, 2]
+MAX_REPEAT_NUMS = [0, 0, 3, 3, 1, 1, 2]
+
+SEQS_MAPPED = [
+    [0, 0, 1, 2, 2],
+    [0, 1],
+    [2, 2, 0, 0, 0, 1],
+    [1, 0, 0, 2],
+    [0, 0, 0, 0, 0, 0, 1],
+    # symbol 2 repeats at most twice, so this is impossible
+    [2, 2, 2],
+    [],
+]
+
+
+def path_prob(state_model, path):
+    """probability of one path through states"""
+    trans = state_model['trans']
+    # more repeats than allowed have probability zero
+    repeat_probs = np.hstack((state_model['repeat_probs'], np.zeros((len(STATE_SYMBOLS), 10))))
+    prob = trans[0, path[0]]
+    num_repeats = 0
+    for state, next_state in zip(path, path[1:]):
+        if state == next_state:
+            prob *= repeat_probs[state, num_repeats]
+            num_repeats += 1
+        else:
+            prob *= (1 - repeat_probs[state, num_repeats]) * trans[state, next_state]
+            num_repeats = 0
+    return prob * (1 - repeat_probs[path[-1], num_repeats]) * trans[path[-1], 1]
+
+
+def brute_force_viterbi(state_model, seq):
+    """largest probability of any path through states that emits seq"""
+    candidates = [[state for state, symbol in enumerate(STATE_SYMBOLS) if symbol == x]
+                  for x in seq]
+    return max(path_prob(state_model, path) for path in itertools.product(*candidates))
+
+
+def test_viterbi_matches_brute_force():
+    state_model = init_state_model(STATE_SYMBOLS, MAX_REPEAT_NUMS, np.random.default_rng(0))
+    flat, offsets = flatten_sequences(SEQS_MAPPED)
+    flat_states, states_offsets, log_probs = viterbi(state_model, flat, offsets, batch_size=3)
+    assert np.array_equal(states_offsets, offsets)
+    for seq, states, log_prob in zip(SEQS_MAPPED[:-1], split_flat(flat_states, offsets),
+                                     log_probs):
+        prob = brute_force_viterbi(state_model, seq)
+        if prob == 0:
+            assert log_prob == -np.inf
+            assert np.all(states == -1)
+        else:
+            assert np.isclose(log_prob, np.log(prob))
+            # paths can tie, so check the path decoded is one of the most likely
+            assert np.isclose(path_prob(state_model, states.tolist()), prob)
+    # an empty sequence goes straight from the start state to the end state
+    assert np.isclose(log_probs[-1], np.log(state_model['trans'][0, 1]))
+
+    # same paths from sparse transitions, decoded on threads
+    sparse_states, _, sparse_log_probs = viterbi(sparse_state_model(state_model), flat, offsets,
+                                                 batch_size=2, n_jobs=2)
+    assert np.array_equal(sparse_states, flat_states)
+    assert np.allclose(sparse_log_probs, log_probs)
+
+    # and from a pruned model, where the max is only over the remaining edges
+    state_model['trans'] = drop_small(state_model['trans'], np.asarray(STATE_SYMBOLS), 0.15)
+    pruned_states, _, pruned_log_probs = viterbi(state_model, flat, offsets)
+    sparse_model = sparse_state_model(state_model)
+    assert 'log_blocks' not in viterbi_tables(sparse_model)
+    sparse_states, _, sparse_log_probs = viterbi(sparse_model, flat, offsets, batch_size=2)
+    assert np.array_equal(sparse_states, pruned_states)
+    assert np.allclose(sparse_log_probs, pruned_log_probs)